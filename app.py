@@ -3,10 +3,9 @@ Face Detection API - Flask Backend
 Converts the Jupyter notebook face detection logic into a web service
 """
 
-from flask import Flask, request, jsonify, send_file, send_from_directory
+from flask import Flask, request, jsonify, send_file, send_from_directory, Response
 from flask_cors import CORS
 import pandas as pd
-import requests
 import cv2
 import sys
 try:
@@ -22,189 +21,3089 @@ except ImportError:
     print("="*60 + "\n")
     sys.exit(1)
 
+import inference_worker
+from inference_worker import DNN_INPUT_SIZE, DNN_MEAN, dnn_confidence
 import numpy as np
+import aiohttp
+import asyncio
+import abc
+import concurrent.futures
+import multiprocessing
+from multiprocessing import shared_memory
 import os
+import random
+import bisect
+import hashlib
+import base64
+import binascii
+import functools
+import sqlite3
 import uuid
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit, urlunsplit
 from datetime import datetime
+from collections import OrderedDict, deque
+from contextlib import contextmanager, ExitStack
 import zipfile
+import shutil
 import io
+import csv
+import codecs
+import json
+import socket
 import threading
+import queue
 import time
+import atexit
+try:
+    import fcntl  # Cleanup scheduler lock (POSIX); on Windows every process runs it
+except ImportError:
+    fcntl = None
 
 app = Flask(__name__, static_folder='static')
-# Security: Limit upload size to 100MB
-app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024
+# Security: Limit upload size (100MB default, raise via MAX_UPLOAD_MB for huge audits)
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_MB', 100)) * 1024 * 1024
 CORS(app)
 
 # ==========================================
 # ============== CONFIGURATION =============
 # ==========================================
-UPLOAD_FOLDER = 'uploads'
-RESULTS_FOLDER = 'results'
-NO_FACE_FOLDER = 'no_face_images'
-MODEL_FOLDER = 'Model'
-
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-os.makedirs(RESULTS_FOLDER, exist_ok=True)
-os.makedirs(NO_FACE_FOLDER, exist_ok=True)
-
 from apscheduler.schedulers.background import BackgroundScheduler
-import shutil
 import time
 
-# Configuration
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DATA_DIR = os.path.join(BASE_DIR, 'jobs_data') # Parent folder for all dynamic data
+# Configuration
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(BASE_DIR, 'jobs_data') # Parent folder for all dynamic data
+
+UPLOAD_FOLDER = os.path.join(DATA_DIR, 'uploads')
+RESULTS_FOLDER = os.path.join(DATA_DIR, 'results')
+NO_FACE_FOLDER = os.path.join(DATA_DIR, 'no_face_images')
+MODEL_FOLDER = os.path.join(BASE_DIR, 'Model') # Model stays in root
+MAX_FILE_AGE_HOURS = 24  # Default retention, files of finished jobs are deleted after this
+MAX_RETENTION_HOURS = 24 * 30  # Upper bound for a job's retention_hours
+
+# Verdict cache: URL + detector thresholds -> Face_Status (no image data stored)
+RESULT_CACHE_PATH = os.path.join(DATA_DIR, 'result_cache.sqlite3')
+RESULT_CACHE_MAX_ENTRIES = 2_000_000
+RESULT_CACHE_TTL_HOURS = 7 * 24
+
+def ensure_data_dirs():
+    """Create the data directories (and the parent DATA_DIR implicitly)"""
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    os.makedirs(RESULTS_FOLDER, exist_ok=True)
+    os.makedirs(NO_FACE_FOLDER, exist_ok=True)
+
+# Processing configuration (DEFAULTS)
+DEFAULT_DOWNLOAD_TIMEOUT = 20
+DEFAULT_MEDIAPIPE_CONF_THRESH = 0.80
+DEFAULT_DNN_CONF_THRESH = 0.70
+DEFAULT_NUM_THREADS = 6
+DEFAULT_BATCH_SIZE = 50
+STREAM_CHUNK_ROWS = 10_000  # Rows per chunk when streaming large CSVs
+STREAMING_AUTO_BYTES = 20 * 1024 * 1024  # Uploads at least this big stream by default
+DEFAULT_DOWNLOAD_WORKERS = 64  # In-flight downloads per job (async, not threads)
+DEFAULT_DECODE_WORKERS = 2
+DEFAULT_PIPELINE_QUEUE_SIZE = 64  # Bounded hand-off between stages (backpressure)
+CPU_COUNT = os.cpu_count() or DEFAULT_NUM_THREADS
+
+# Image fetcher (shared connection pool for all jobs)
+FETCH_MAX_CONNECTIONS = 512
+FETCH_MAX_PER_HOST = 64  # Be polite to a single bucket/host
+FETCH_MAX_IMAGE_BYTES = 25 * 1024 * 1024  # Hard cap on a single response body
+FETCH_RETRIES = 2  # Extra attempts for 5xx / timeouts / dropped connections
+FETCH_BACKOFF_SECONDS = 0.5
+DEFAULT_MAX_DIMENSION = 0  # Working resolution cap in pixels (0 = full resolution)
+DEFAULT_EXECUTION_MODE = 'threads'  # 'threads' or 'processes' (inference outside the GIL)
+DEFAULT_DNN_BATCH_SIZE = 8  # DNN fallback images per forward() (1 = per row)
+DEFAULT_DNN_BATCH_WAIT_MS = 5  # Max time the first image waits for a batch to fill
+DNN_BATCH_RESULT_TIMEOUT = 60  # Seconds a row waits on its batch before it fails
+DEFAULT_DETECTOR_POOL_MAX_IDLE = 16  # Idle detector sets kept warm across jobs
+DEFAULT_ARTIFACT_MODE = 'original'  # NO FACE evidence: 'original' bytes, 'compact' re-encode, 'full' frame
+DEFAULT_ARTIFACT_MAX_DIMENSION = 1024  # 'compact' evidence is downscaled to this (px)
+DEFAULT_ARTIFACT_QUALITY = 80  # 'compact' JPEG quality
+DEFAULT_ARTIFACT_BACKPRESSURE = 'block'  # Writer queue full: 'block', 'drop' the image or write 'inline'
+ARTIFACT_QUEUE_SIZE = 64  # Frames waiting for the background writer (bounds memory)
+ARTIFACT_WRITER_THREADS = 2
+DEFAULT_PREFILTER = False  # Reject hopeless frames before the detectors run
+DEFAULT_PREFILTER_MIN_DIM = 40  # Shorter side below this (px) -> NO FACE (TINY)
+DEFAULT_PREFILTER_MIN_STD = 6.0  # Grayscale std-dev below this -> NO FACE (BLANK)
+DEFAULT_PREFILTER_DARK_MEAN = 15.0  # Mean brightness below this -> NO FACE (DARK)
+DEFAULT_PREFILTER_MIN_BLUR = 4.0  # Laplacian variance (128px thumbnail) below this -> NO FACE (BLURRY), 0 = off
+
+# Live state of jobs running in THIS process (durable copy lives in job_store)
+jobs = {}
+jobs_lock = threading.Lock()
+
+# Scheduler: caps shared by every job in this process
+MAX_CONCURRENT_JOBS = 4  # Jobs processing at once, the rest wait in a FIFO queue
+MAX_QUEUED_JOBS = 50  # Uploads beyond this backlog are rejected (503)
+GLOBAL_MAX_DOWNLOADS = 256  # In-flight image downloads across all jobs
+GLOBAL_MAX_INFERENCES = CPU_COUNT  # Concurrent detections across all jobs
+
+# Synchronous /api/detect: own warm detectors and limits, outside the job scheduler
+DETECT_MAX_CONCURRENT = int(os.environ.get('DETECT_MAX_CONCURRENT', min(4, CPU_COUNT)))  # Images in inference
+DETECT_MAX_REQUESTS = DETECT_MAX_CONCURRENT * 4  # Requests in flight before new ones get 503
+DETECT_ADMISSION_WAIT_MS = 100  # How long a request may wait for admission
+DETECT_MAX_BATCH = 32  # Images per request
+DETECT_DOWNLOAD_TIMEOUT = 5
+DETECT_P99_TARGET_MS = float(os.environ.get('DETECT_P99_TARGET_MS', 300))  # Single-image latency goal
+
+# Durable job store (shared by all gunicorn workers on this host)
+JOB_STORE_PATH = os.environ.get('JOB_STORE_PATH', os.path.join(DATA_DIR, 'jobs.sqlite3'))
+JOB_LEASE_SECONDS = 120  # Running job with no heartbeat for this long is resumable
+JOB_HEARTBEAT_SECONDS = 30
+JOB_INTAKE_POLL_SECONDS = 1  # How often the job runner looks for uploads handed over by other processes
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"  # Re-set by start_worker() after a fork
+
+# Sharded jobs: this server coordinates, shard_worker.py processes/nodes run the rows
+DEFAULT_SHARD_ROWS = 0  # Rows per shard (0 = run the whole job in this process)
+SHARD_LEASE_SECONDS = 60  # A shard whose worker stops heartbeating is handed out again
+SHARD_POLL_SECONDS = 0.5  # Coordinator checks for finished shards this often
+SHARD_COLUMNS = ['idx', 'id', 'url', 'cache_key', 'dedup_key']  # Shard files (keys are only read back here)
+SHARD_TOKEN = os.environ.get('SHARD_TOKEN')  # Shared secret workers send as X-Shard-Token (optional)
+
+# Progress push (SSE / long-poll)
+PROGRESS_FLUSH_SECONDS = 0.25  # Job threads publish counters at most this often
+EVENTS_MAX_PER_SECOND = 4  # Cap on SSE messages per client
+EVENTS_KEEPALIVE_SECONDS = 15
+# Each open SSE stream holds a server thread; past this many (per process) clients get 503 and long-poll
+EVENTS_MAX_STREAMS = int(os.environ.get('EVENTS_MAX_STREAMS', 4))
+EVENTS_RETRY_AFTER_SECONDS = 30
+LONG_POLL_TIMEOUT_SECONDS = 25
+REMOTE_JOB_POLL_SECONDS = 2  # Jobs owned by another worker are re-read from the store
+TERMINAL_JOB_STATUSES = ('completed', 'failed', 'cancelled')
+
+# Job history (/api/jobs)
+JOBS_PAGE_SIZE = 50
+JOBS_PAGE_MAX = 200
+JOB_SUMMARY_FIELDS = ('id', 'status', 'original_filename', 'uploaded_at', 'started_at', 'completed_at',
+                      'total_rows', 'rows_to_process', 'processed', 'good_count', 'noface_count',
+                      'download_error_count', 'message', 'error')
+
+# ==========================================
+# ========== AUTO-CLEANUP SYSTEM ===========
+# ==========================================
+
+# Each job's files are listed in the store (job_artifacts) and finished jobs
+# carry an expires_at deadline, so cleanup reads the expiry index instead of
+# walking every saved image on disk.
+CLEANUP_INTERVAL_MINUTES = 10
+CLEANUP_BATCH_SIZE = 200  # Expired jobs handled per pass, soonest deadline first
+JOB_ID_LENGTH = 36  # uuid4 prefix on every upload, result and no-face folder name
+
+def delete_job_artifacts(artifacts):
+    """Remove a job's files and folders (whole directories at once), returns count"""
+    deleted = 0
+    for path, kind in artifacts:
+        try:
+            if kind == 'dir':
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+            deleted += 1
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Error deleting {path}: {e}")
+    return deleted
+
+def cleanup_expired_jobs(now=None):
+    """Delete jobs whose retention ran out, skipping anything still running"""
+    now = now or time.time()
+    removed = 0
+    for job_id, heartbeat in job_store.expired_jobs(now, CLEANUP_BATCH_SIZE):
+        with jobs_lock:
+            active = jobs.get(job_id, {}).get('status') in ACTIVE_JOB_STATUSES
+        if active or job_scheduler.is_running(job_id):
+            continue
+        # Touched by some worker very recently (e.g. cancelled but not yet stopped)
+        if heartbeat and now - heartbeat < JOB_LEASE_SECONDS:
+            continue
+        delete_job_artifacts(job_store.job_artifacts(job_id))
+        job_store.delete_job(job_id)
+        with jobs_lock:
+            jobs.pop(job_id, None)
+        job_events.forget(job_id)
+        removed += 1
+    return removed
+
+def cleanup_orphaned_files(now=None):
+    """Old top-level entries with no job record (crashes, pre-manifest jobs).
+
+    Only the first level of each folder is listed, so no-face images inside
+    a job folder are never stat'ed one by one.
+    """
+    cutoff = (now or time.time()) - MAX_FILE_AGE_HOURS * 3600
+    deleted = 0
+    for folder in (UPLOAD_FOLDER, RESULTS_FOLDER, NO_FACE_FOLDER):
+        if not os.path.exists(folder):
+            continue
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                job_id = entry.name[:JOB_ID_LENGTH]
+                try:
+                    if entry.stat().st_mtime >= cutoff:
+                        continue
+                except FileNotFoundError:
+                    continue
+                with jobs_lock:
+                    if job_id in jobs:
+                        continue
+                if job_store.get_job(job_id) is not None:
+                    continue
+                deleted += delete_job_artifacts([(entry.path, 'dir' if entry.is_dir() else 'file')])
+    return deleted
+
+def cleanup_old_files():
+    """Scheduled cleanup: expired jobs from the index, then orphaned files"""
+    try:
+        removed = cleanup_expired_jobs()
+        orphans = cleanup_orphaned_files()
+    except Exception as e:
+        print(f"[{datetime.now().isoformat()}] Auto-cleanup failed: {e}")
+        return
+    if removed or orphans:
+        print(f"[{datetime.now().isoformat()}] Cleanup complete. Removed {removed} expired jobs, "
+              f"{orphans} orphaned files.")
+
+def lock_host_role(path):
+    """Take a host-wide role if no other process holds it (the lock file, or None).
+
+    The lock dies with its process, so callers retry from the job lease
+    loop and another worker takes the role over. Without fcntl (Windows)
+    every process gets the role.
+    """
+    if fcntl is None:
+        return True
+    os.makedirs(DATA_DIR, exist_ok=True)
+    lock_file = open(path, 'a')
+    try:
+        # lockf (not flock): a forked child process never inherits the lock
+        fcntl.lockf(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+# One cleanup scheduler per host, not one per gunicorn worker
+CLEANUP_LOCK_PATH = os.path.join(DATA_DIR, 'cleanup.lock')
+scheduler = None
+_scheduler_lock_file = None
+
+def start_cleanup_scheduler():
+    """Start the cleanup scheduler in this process if no other process runs it.
+
+    The first process to lock CLEANUP_LOCK_PATH runs it. The lock dies with
+    that process, and the job lease loop calls this again so another worker
+    takes over. Returns True when this process runs the scheduler.
+    """
+    global scheduler, _scheduler_lock_file
+    if scheduler is not None:
+        return True
+    _scheduler_lock_file = lock_host_role(CLEANUP_LOCK_PATH)
+    if _scheduler_lock_file is None:
+        return False
+
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(func=cleanup_old_files, trigger="interval", minutes=CLEANUP_INTERVAL_MINUTES)
+    scheduler.start()
+    # Ensure scheduler shuts down when app exits
+    atexit.register(lambda: scheduler.shutdown())
+    print(f"Cleanup scheduler running in process {os.getpid()}")
+    return True
+
+# ==========================================
+# ========== INITIALIZE MODELS =============
+# ==========================================
+mp_face_detection = mp.solutions.face_detection
+
+prototxt_path = os.path.join(MODEL_FOLDER, "deploy.prototxt.txt")
+model_path = os.path.join(MODEL_FOLDER, "res10_300x300_ssd_iter_140000.caffemodel")
+
+# (prototxt, weights) as uint8 buffers, read once by init_models()
+dnn_model_buffers = None
+_models_lock = threading.Lock()
+WARMUP_FRAME_SIZE = 320
+
+def init_models():
+    """Read the DNN model files into memory and check they load (idempotent).
+
+    Safe to call in the gunicorn master (preload_app): it starts no threads
+    and builds no detectors, so forked workers share the buffers (and the
+    imported libraries) copy-on-write and build their nets from memory.
+    """
+    global dnn_model_buffers
+    with _models_lock:
+        if dnn_model_buffers is not None:
+            return
+        buffers = tuple(np.fromfile(path, dtype=np.uint8) for path in (prototxt_path, model_path))
+        cv2.dnn.readNetFromCaffe(*buffers)  # Fail fast on missing / corrupt model files
+        dnn_model_buffers = buffers
+
+def load_dnn_net():
+    """Load a fresh OpenCV DNN net (a net must not be shared between threads)"""
+    if dnn_model_buffers is not None:
+        return cv2.dnn.readNetFromCaffe(*dnn_model_buffers)
+    return cv2.dnn.readNetFromCaffe(prototxt_path, model_path)
+
+class DetectorSet:
+    """One MediaPipe detector + one DNN net, used by a single worker at a time"""
+
+    def __init__(self, mp_thresh):
+        self.mp_thresh = mp_thresh
+        self.face_detector = mp_face_detection.FaceDetection(min_detection_confidence=mp_thresh)
+        self.net = load_dnn_net()
+        self.last_used = time.time()
+
+    def run_once(self, frame):
+        """One inference through both models (the first call per graph is slow)"""
+        self.face_detector.process(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        dnn_confidence(frame, self.net)
+
+    def close(self):
+        try:
+            self.face_detector.close()
+        except Exception as e:
+            print(f"Error closing detector: {e}")
+
+class DetectorPool:
+    """Long-lived detectors keyed by MediaPipe threshold.
+
+    Workers check a DetectorSet out for the duration of one image and hand it
+    back afterwards, so graphs are built once and reused across rows and jobs
+    while no two threads ever run the same detector concurrently.
+    """
+
+    def __init__(self, max_idle=DEFAULT_DETECTOR_POOL_MAX_IDLE):
+        self.max_idle = max_idle
+        self._idle = OrderedDict()  # key -> [DetectorSet, ...]
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self.warmups = 0
+        self.reuses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _key(mp_thresh):
+        return round(float(mp_thresh), 4)
+
+    @contextmanager
+    def acquire(self, mp_thresh):
+        """Check out a DetectorSet for the given threshold"""
+        key = self._key(mp_thresh)
+        detectors = None
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                detectors = idle.pop()
+                self.reuses += 1
+            self._in_use += 1
+
+        if detectors is None:
+            # Build outside the lock: graph setup is the slow part
+            try:
+                detectors = DetectorSet(key)
+            except Exception:
+                with self._lock:
+                    self._in_use -= 1
+                raise
+            with self._lock:
+                self.warmups += 1
+
+        try:
+            yield detectors
+        finally:
+            self._release(key, detectors)
+
+    def _release(self, key, detectors):
+        detectors.last_used = time.time()
+        evicted = []
+        with self._lock:
+            self._in_use -= 1
+            self._idle.setdefault(key, []).append(detectors)
+            self._idle.move_to_end(key)
+
+            # Evict least recently used idle sets beyond the cap
+            while sum(len(v) for v in self._idle.values()) > self.max_idle:
+                oldest_key = min(
+                    (k for k, v in self._idle.items() if v),
+                    key=lambda k: self._idle[k][0].last_used
+                )
+                evicted.append(self._idle[oldest_key].pop(0))
+                if not self._idle[oldest_key]:
+                    del self._idle[oldest_key]
+                self.evictions += 1
+
+        for old in evicted:
+            old.close()
+
+    def warm(self, mp_thresh, count=1, frame=None):
+        """Pre-build detector sets so the first rows don't pay graph setup.
+
+        With a `frame`, every set also runs it once.
+        """
+        # Hold all sets at once so each acquire builds a new one
+        with ExitStack() as stack:
+            sets = [stack.enter_context(self.acquire(mp_thresh)) for _ in range(count)]
+            if frame is not None:
+                for detectors in sets:
+                    detectors.run_once(frame)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'warmups': self.warmups,
+                'reuses': self.reuses,
+                'evictions': self.evictions,
+                'in_use': self._in_use,
+                'idle': sum(len(v) for v in self._idle.values()),
+                'idle_by_threshold': {str(k): len(v) for k, v in self._idle.items()},
+                'max_idle': self.max_idle
+            }
+
+# Detectors are built per process (warm_up / first use), never at import
+detector_pool = DetectorPool()
+
+# ==========================================
+# ========== FACE DETECTION LOGIC ==========
+# ==========================================
+
+# ==========================================
+# ============ STAGE METRICS ===============
+# ==========================================
+
+METRIC_STAGES = ('download', 'decode', 'prefilter', 'mediapipe', 'dnn', 'imwrite', 'checkpoint', 'detect_api')
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram (Prometheus-compatible buckets, seconds)"""
+
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # Last slot is +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile (None if empty)"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for bound, n in zip(LATENCY_BUCKETS, self.counts):
+            cumulative += n
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+    def summary(self):
+        def ms(value):
+            return None if value is None else (round(value * 1000, 2) if value != float('inf') else 'inf')
+        return {
+            'count': self.count,
+            'total_seconds': round(self.total, 3),
+            'mean_ms': round(self.total / self.count * 1000, 2) if self.count else None,
+            'p50_ms': ms(self.quantile(0.5)),
+            'p95_ms': ms(self.quantile(0.95)),
+            'p99_ms': ms(self.quantile(0.99))
+        }
+
+class StageMetrics:
+    """Process-wide and per-job stage latencies plus a few labelled counters.
+
+    Recording is a perf_counter delta and one short critical section, cheap
+    enough to leave on for every row.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages = {stage: LatencyHistogram() for stage in METRIC_STAGES}
+        self.jobs = {}  # job_id -> {stage: LatencyHistogram}
+        self.counters = {}  # (name, label) -> count
+
+    def observe(self, stage, seconds, job_id=None):
+        with self._lock:
+            self.stages[stage].observe(seconds)
+            if job_id is not None:
+                per_job = self.jobs.get(job_id)
+                if per_job is None:
+                    per_job = self.jobs[job_id] = {}
+                hist = per_job.get(stage)
+                if hist is None:
+                    hist = per_job[stage] = LatencyHistogram()
+                hist.observe(seconds)
+
+    def observe_all(self, timings, job_id=None):
+        for stage, seconds in timings.items():
+            self.observe(stage, seconds, job_id)
+
+    @contextmanager
+    def timed(self, stage, job_id=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, job_id)
+
+    def count(self, name, label, n=1):
+        with self._lock:
+            key = (name, label)
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def job_breakdown(self, job_id):
+        """Per-stage summary for one job, with the MediaPipe -> DNN fallback rate"""
+        with self._lock:
+            per_job = self.jobs.get(job_id, {})
+            breakdown = {stage: hist.summary() for stage, hist in per_job.items()}
+        breakdown['dnn_fallback_rate'] = fallback_rate(breakdown.get('mediapipe', {}).get('count', 0),
+                                                       breakdown.get('dnn', {}).get('count', 0))
+        return breakdown
+
+    def forget(self, job_id):
+        with self._lock:
+            self.jobs.pop(job_id, None)
+
+    def snapshot(self):
+        with self._lock:
+            stages = {stage: (list(h.counts), h.total, h.count) for stage, h in self.stages.items()}
+            counters = dict(self.counters)
+        return stages, counters
+
+def fallback_rate(mediapipe_runs, dnn_runs):
+    return round(dnn_runs / mediapipe_runs, 4) if mediapipe_runs else None
+
+stage_metrics = StageMetrics()
+
+def render_prometheus_metrics():
+    """Process-wide metrics in the Prometheus text exposition format"""
+    stages, counters = stage_metrics.snapshot()
+    lines = [
+        '# HELP face_audit_stage_seconds Latency of each processing stage.',
+        '# TYPE face_audit_stage_seconds histogram'
+    ]
+    for stage, (counts, total, count) in stages.items():
+        cumulative = 0
+        for bound, n in zip(LATENCY_BUCKETS + ('+Inf',), counts):
+            cumulative += n
+            lines.append(f'face_audit_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+        lines.append(f'face_audit_stage_seconds_sum{{stage="{stage}"}} {total:.6f}')
+        lines.append(f'face_audit_stage_seconds_count{{stage="{stage}"}} {count}')
+
+    rate = fallback_rate(stages['mediapipe'][2], stages['dnn'][2])
+    lines += [
+        '# HELP face_audit_dnn_fallback_ratio Share of MediaPipe misses re-checked by the DNN.',
+        '# TYPE face_audit_dnn_fallback_ratio gauge',
+        f'face_audit_dnn_fallback_ratio {rate if rate is not None else 0}',
+        '# HELP face_audit_detect_p99_target_seconds Latency goal for single-image /api/detect calls.',
+        '# TYPE face_audit_detect_p99_target_seconds gauge',
+        f'face_audit_detect_p99_target_seconds {DETECT_P99_TARGET_MS / 1000}',
+        '# HELP face_audit_downloads_in_flight Image downloads currently open.',
+        '# TYPE face_audit_downloads_in_flight gauge',
+        f'face_audit_downloads_in_flight {image_fetcher.in_flight}',
+        '# HELP face_audit_downloads_coalesced_total Fetches answered by a download already in flight.',
+        '# TYPE face_audit_downloads_coalesced_total counter',
+        f'face_audit_downloads_coalesced_total {image_fetcher.coalesced}',
+        '# HELP face_audit_artifact_queue_depth NO FACE images waiting for the background writer.',
+        '# TYPE face_audit_artifact_queue_depth gauge',
+        f'face_audit_artifact_queue_depth {artifact_writer.queue_depth()}',
+        '# HELP face_audit_artifacts_total NO FACE evidence writes by outcome.',
+        '# TYPE face_audit_artifacts_total counter'
+    ]
+    totals = dict(artifact_writer.totals)
+    lines += [f'face_audit_artifacts_total{{outcome="{k}"}} {totals[k]}' for k in ('written', 'dropped', 'failed', 'inline')]
+    lines += [
+        '# TYPE face_audit_artifact_bytes_total counter',
+        f'face_audit_artifact_bytes_total {totals["bytes"]}'
+    ]
+
+    # Pipeline queues of the jobs running in this process
+    depths = {}
+    job_states = {}
+    with jobs_lock:
+        for job in jobs.values():
+            job_states[job.get('status')] = job_states.get(job.get('status'), 0) + 1
+            if job.get('status') != 'processing':
+                continue
+            for stage, info in job.get('pipeline', {}).get('stages', {}).items():
+                depths[stage] = depths.get(stage, 0) + info.get('queue_depth', 0)
+    lines += [
+        '# HELP face_audit_queue_depth Tasks waiting in front of each pipeline stage.',
+        '# TYPE face_audit_queue_depth gauge'
+    ]
+    lines += [f'face_audit_queue_depth{{stage="{stage}"}} {n}' for stage, n in depths.items()]
+    lines += [
+        '# HELP face_audit_slot_waiters Stage workers waiting for a global slot.',
+        '# TYPE face_audit_slot_waiters gauge'
+    ]
+    for name, slots in (('download', download_slots), ('inference', inference_slots)):
+        waiting = sum(slots.stats()['waiting_by_job'].values())
+        lines.append(f'face_audit_slot_waiters{{slot="{name}"}} {waiting}')
+    lines += [
+        '# HELP face_audit_jobs Jobs known to this process by status.',
+        '# TYPE face_audit_jobs gauge'
+    ]
+    lines += [f'face_audit_jobs{{status="{status}"}} {n}' for status, n in job_states.items()]
+
+    labels = {'rows_total': 'status', 'download_errors_total': 'reason', 'prefilter_total': 'reason',
+              'detect_images_total': 'status', 'detect_requests_total': 'outcome'}
+    for name, label_name in labels.items():
+        lines.append(f'# TYPE face_audit_{name} counter')
+        for (counter, label), n in sorted(counters.items()):
+            if counter == name:
+                lines.append(f'face_audit_{name}{{{label_name}="{label}"}} {n}')
+    return "\n".join(lines) + "\n"
+
+# ==========================================
+# ========== ASYNC IMAGE FETCHER ===========
+# ==========================================
+
+class FetchError(Exception):
+    """Download failure with a short machine-readable reason (e.g. 'http_404')"""
+
+    def __init__(self, reason, detail="", retryable=False):
+        super().__init__(f"{reason}: {detail}" if detail else reason)
+        self.reason = reason
+        self.detail = detail
+        self.retryable = retryable
+
+class AsyncImageFetcher:
+    """aiohttp fetch engine running on its own event loop thread.
+
+    A single ClientSession keeps keep-alive connections pooled per host, so
+    thousands of URLs on the same bucket reuse connections and TLS sessions
+    instead of handshaking per row. Threads use fetch() (blocking) or
+    run() (returns a concurrent.futures.Future) to schedule work on the loop.
+    """
+
+    def __init__(self, max_connections=FETCH_MAX_CONNECTIONS, max_per_host=FETCH_MAX_PER_HOST,
+                 max_bytes=FETCH_MAX_IMAGE_BYTES, retries=FETCH_RETRIES,
+                 backoff=FETCH_BACKOFF_SECONDS):
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.max_bytes = max_bytes
+        self.retries = retries
+        self.backoff = backoff
+        self.in_flight = 0  # Only touched on the event-loop thread
+        self.coalesced = 0
+        self._inflight_urls = {}  # normalized url -> Future shared by concurrent callers
+        self._loop = None
+        self._session = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="image-fetcher", daemon=True).start()
+            asyncio.run_coroutine_threadsafe(self._open_session(), loop).result()
+            self._loop = loop
+
+    async def _open_session(self):
+        connector = aiohttp.TCPConnector(limit=self.max_connections,
+                                         limit_per_host=self.max_per_host,
+                                         ttl_dns_cache=300)
+        self._session = aiohttp.ClientSession(connector=connector)
+
+    def run(self, coro):
+        """Schedule a coroutine on the fetcher loop"""
+        self._ensure_started()
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def fetch(self, url, timeout=DEFAULT_DOWNLOAD_TIMEOUT):
+        """Blocking fetch for callers outside the event loop"""
+        return self.run(self.fetch_async(url, timeout)).result()
+
+    async def fetch_async(self, url, timeout=DEFAULT_DOWNLOAD_TIMEOUT):
+        """Fetch raw bytes; concurrent requests for the same URL share one download"""
+        key = normalize_image_url(url)
+        shared = self._inflight_urls.get(key)
+        if shared is not None:
+            self.coalesced += 1
+            return await asyncio.shield(shared)
+
+        shared = self._loop.create_future()
+        self._inflight_urls[key] = shared
+        try:
+            data = await self._fetch_with_retries(url, timeout)
+            shared.set_result(data)
+            return data
+        except asyncio.CancelledError:
+            shared.cancel()
+            raise
+        except Exception as e:
+            shared.set_exception(e)
+            shared.exception()  # Retrieved: no "never retrieved" warning when nobody shared it
+            raise
+        finally:
+            del self._inflight_urls[key]
+
+    async def _fetch_with_retries(self, url, timeout):
+        """Fetch raw bytes, retrying transient failures with jittered backoff"""
+        attempt = 0
+        self.in_flight += 1
+        try:
+            while True:
+                try:
+                    return await self._fetch_once(url, timeout)
+                except FetchError as e:
+                    if not e.retryable or attempt >= self.retries:
+                        raise
+                    delay = self.backoff * (2 ** attempt) * (0.5 + random.random() / 2)
+                    attempt += 1
+                    await asyncio.sleep(delay)
+        finally:
+            self.in_flight -= 1
+
+    async def _fetch_once(self, url, timeout):
+        try:
+            async with self._session.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                if response.status >= 500 or response.status == 429:
+                    raise FetchError(f"http_{response.status}", retryable=True)
+                if response.status >= 400:
+                    raise FetchError(f"http_{response.status}")
+
+                if response.content_length and response.content_length > self.max_bytes:
+                    raise FetchError("too_large", f"{response.content_length} bytes")
+
+                chunks = []
+                size = 0
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise FetchError("too_large", f"over {self.max_bytes} bytes")
+                    chunks.append(chunk)
+
+                if size == 0:
+                    raise FetchError("empty_body")
+                return b"".join(chunks)
+        except FetchError:
+            raise
+        except asyncio.TimeoutError:
+            raise FetchError("timeout", f"no response within {timeout}s", retryable=True)
+        except (aiohttp.InvalidURL, ValueError) as e:
+            raise FetchError("invalid_url", str(e))
+        except aiohttp.ClientConnectionError as e:
+            raise FetchError("connection_error", str(e), retryable=True)
+        except aiohttp.ClientError as e:
+            raise FetchError("client_error", str(e))
+
+    def close(self):
+        with self._lock:
+            if self._loop is None:
+                return
+            try:
+                asyncio.run_coroutine_threadsafe(self._session.close(), self._loop).result(timeout=5)
+            except Exception as e:
+                print(f"Error closing image fetcher: {e}")
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop = None
+
+image_fetcher = AsyncImageFetcher()
+atexit.register(image_fetcher.close)
+
+def fetch_image_bytes(url, timeout=DEFAULT_DOWNLOAD_TIMEOUT):
+    """Download raw image bytes from URL (raises FetchError)"""
+    return image_fetcher.fetch(url, timeout)
+
+# SOF markers that carry frame dimensions (baseline, progressive, lossless, ...)
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+REDUCED_DECODE_FLAGS = [
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+]
+
+def jpeg_dimensions(data):
+    """Read (width, height) from a JPEG header without decoding, None if not a JPEG"""
+    if len(data) < 4 or data[0] != 0xFF or data[1] != 0xD8:
+        return None
+    pos = 2
+    while pos + 9 < len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:  # Fill byte
+            pos += 1
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:  # No length field
+            pos += 2
+            continue
+        length = (data[pos + 2] << 8) | data[pos + 3]
+        if marker in JPEG_SOF_MARKERS:
+            height = (data[pos + 5] << 8) | data[pos + 6]
+            width = (data[pos + 7] << 8) | data[pos + 8]
+            return width, height
+        pos += 2 + length
+    return None
+
+def decode_image(data, max_dimension=DEFAULT_MAX_DIMENSION):
+    """Decode raw image bytes into a BGR frame.
+
+    With max_dimension set, JPEGs are decoded at 1/2, 1/4 or 1/8 scale by the
+    decoder itself (the largest reduction that stays at or above the cap),
+    then resized down to the cap, so 12MP selfies never exist at full size.
+    """
+    if not data:
+        return None
+    img_array = np.frombuffer(data, dtype=np.uint8)
+
+    flag = cv2.IMREAD_COLOR
+    if max_dimension:
+        dims = jpeg_dimensions(data)
+        if dims:
+            longest = max(dims)
+            for factor, reduced_flag in REDUCED_DECODE_FLAGS:
+                if longest // factor >= max_dimension:
+                    flag = reduced_flag
+                    break
+
+    image = cv2.imdecode(img_array, flag)
+    if image is None or not max_dimension:
+        return image
+
+    (h, w) = image.shape[:2]
+    scale = max_dimension / float(max(h, w))
+    if scale < 1.0:
+        image = cv2.resize(image, (max(1, int(w * scale)), max(1, int(h * scale))),
+                           interpolation=cv2.INTER_AREA)
+    return image
+
+def download_image(url, timeout=DEFAULT_DOWNLOAD_TIMEOUT):
+    """Download image from URL (None if it can't be fetched or decoded)"""
+    try:
+        return decode_image(fetch_image_bytes(url, timeout))
+    except FetchError:
+        return None
+
+# Pre-filter: cheap statistics that rule a face out before any model runs
+PREFILTER_STATUSES = {
+    'tiny': "NO FACE (TINY)",
+    'blank': "NO FACE (BLANK)",
+    'dark': "NO FACE (DARK)",
+    'blurry': "NO FACE (BLURRY)"
+}
+PREFILTER_SAMPLE_DIM = 128  # Brightness / blur are measured on a thumbnail this size
+
+def prefilter_image(image, config):
+    """Reason key if the frame can't hold a usable face, None to run the detectors"""
+    (h, w) = image.shape[:2]
+    if min(h, w) < config.get('prefilter_min_dim', DEFAULT_PREFILTER_MIN_DIM):
+        return 'tiny'
+
+    scale = PREFILTER_SAMPLE_DIM / float(max(h, w))
+    if scale < 1.0:
+        image = cv2.resize(image, (max(1, int(w * scale)), max(1, int(h * scale))),
+                           interpolation=cv2.INTER_AREA)
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    mean, std = cv2.meanStdDev(gray)
+    if mean[0][0] < config.get('prefilter_dark_mean', DEFAULT_PREFILTER_DARK_MEAN):
+        return 'dark'
+    if std[0][0] < config.get('prefilter_min_std', DEFAULT_PREFILTER_MIN_STD):
+        return 'blank'
+
+    min_blur = config.get('prefilter_min_blur', DEFAULT_PREFILTER_MIN_BLUR)
+    if min_blur and cv2.Laplacian(gray, cv2.CV_64F).var() < min_blur:
+        return 'blurry'
+    return None
+
+def is_noface_status(status):
+    """NO FACE from the detectors or from the pre-filter"""
+    return status == "NO FACE" or status in PREFILTER_STATUSES.values()
+
+def apply_prefilter(image, job_id, id_val, config, data=None):
+    """(status, log_msg) when the pre-filter rejects the frame, else None"""
+    with stage_metrics.timed('prefilter', job_id):
+        reason = prefilter_image(image, config)
+    if reason is None:
+        return None
+    stage_metrics.count('prefilter_total', reason)
+    status = PREFILTER_STATUSES[reason]
+    if config.get('save_images', True):
+        return status, f"Pre-filter: {reason}. {save_noface_evidence(image, job_id, id_val, config, data)}"
+    return status, f"Pre-filter: {reason}"
+
+def detect_with_dnn(image, net, threshold=DEFAULT_DNN_CONF_THRESH):
+    """Detect face using OpenCV DNN (net must be owned by the calling worker)"""
+    return dnn_confidence(image, net) > threshold
+
+def mediapipe_confidence(results):
+    """Best MediaPipe detection score (0.0 when nothing was found)"""
+    if not results.detections:
+        return 0.0
+    return max(float(detection.score[0]) for detection in results.detections)
+
+class DnnBatcher:
+    """Runs DNN fallback images from many workers through one forward() call.
+
+    Workers submit a 300x300 frame and block on a Future for its max
+    confidence. A single thread (with its own net) takes the first waiting
+    image, gathers more for up to max_wait_ms or max_batch images, and maps
+    the SSD output back per image using the batch index in column 0.
+    If the net cannot be loaded, every waiting and later image fails with
+    that error instead of blocking.
+    """
+
+    def __init__(self, max_batch=DEFAULT_DNN_BATCH_SIZE, max_wait_ms=DEFAULT_DNN_BATCH_WAIT_MS,
+                 timeout=DNN_BATCH_RESULT_TIMEOUT):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self.error = None
+        self.batches = 0
+        self.images = 0
+        threading.Thread(target=self._run, name="dnn-batcher", daemon=True).start()
+
+    def max_confidence(self, image):
+        """Highest face confidence for one image (blocks until its batch ran)"""
+        if self.error is not None:
+            raise self.error
+        future = concurrent.futures.Future()
+        self._queue.put((cv2.resize(image, DNN_INPUT_SIZE), future))
+        try:
+            return future.result(timeout=self.timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise RuntimeError(f"DNN batch gave no result within {self.timeout}s")
+
+    def _run(self):
+        try:
+            net = load_dnn_net()
+        except Exception as e:
+            print(f"DNN batcher could not load the model: {e}")
+            self.error = e
+            # Fail whatever is queued now and anything that slips in later
+            while True:
+                _, future = self._queue.get()
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(e)
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            # Skip images whose caller already gave up on them
+            batch = [item for item in batch if item[1].set_running_or_notify_cancel()]
+            if batch:
+                self._forward(net, batch)
+
+    def _forward(self, net, batch):
+        futures = [future for _, future in batch]
+        try:
+            blob = cv2.dnn.blobFromImages([img for img, _ in batch], 1.0, DNN_INPUT_SIZE, DNN_MEAN)
+            net.setInput(blob)
+            detections = net.forward()[0, 0]
+            image_ids = detections[:, 0].astype(int)
+            for i, future in enumerate(futures):
+                confidences = detections[image_ids == i, 2]
+                future.set_result(float(confidences.max()) if confidences.size else 0.0)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+        with self._lock:
+            self.batches += 1
+            self.images += len(batch)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_batch': self.max_batch,
+                'max_wait_ms': self.max_wait * 1000,
+                'batches': self.batches,
+                'images': self.images,
+                'avg_batch': round(self.images / self.batches, 2) if self.batches else 0
+            }
+
+# Shared across jobs so concurrent fallbacks from every job batch together
+dnn_batchers = {}
+dnn_batchers_lock = threading.Lock()
+
+def get_dnn_batcher(config):
+    """Process-wide DnnBatcher for the job's batch settings (None = per-row DNN)"""
+    max_batch = int(config.get('dnn_batch_size', DEFAULT_DNN_BATCH_SIZE))
+    if max_batch <= 1:
+        return None
+    max_wait_ms = float(config.get('dnn_batch_wait_ms', DEFAULT_DNN_BATCH_WAIT_MS))
+    key = (max_batch, max_wait_ms)
+    with dnn_batchers_lock:
+        if key not in dnn_batchers:
+            dnn_batchers[key] = DnnBatcher(max_batch, max_wait_ms)
+        return dnn_batchers[key]
+
+def detect_face(image, config, timings=None):
+    """MediaPipe -> DNN cascade, True if a face was found.
+
+    Seconds spent in each model are stored in `timings` ('mediapipe' /
+    'dnn') when a dict is passed.
+    """
+    return score_face(image, config, timings)[0]
+
+def score_face(image, config, timings=None, pool=None):
+    """MediaPipe -> DNN cascade, returns (face_found, engine, confidence).
+
+    `engine` is the model that gave the verdict and `confidence` its best
+    score. `pool` defaults to the shared detector pool used by jobs.
+    """
+    mp_thresh = config.get('mediapipe_thresh', DEFAULT_MEDIAPIPE_CONF_THRESH)
+    dnn_thresh = config.get('dnn_thresh', DEFAULT_DNN_CONF_THRESH)
+    dnn_batcher = get_dnn_batcher(config)
+    timings = {} if timings is None else timings
+    pool = detector_pool if pool is None else pool
+
+    start = time.perf_counter()
+    image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+    with pool.acquire(mp_thresh) as detectors:
+        # MediaPipe detection (Primary)
+        results = detectors.face_detector.process(image_rgb)
+        timings['mediapipe'] = time.perf_counter() - start
+        if results.detections:
+            return True, 'mediapipe', mediapipe_confidence(results)
+
+        # Fallback to DNN if MediaPipe fails
+        if dnn_batcher is None:
+            start = time.perf_counter()
+            confidence = dnn_confidence(image, detectors.net)
+            timings['dnn'] = time.perf_counter() - start
+            return confidence > dnn_thresh, 'dnn', confidence
+
+    # Batched fallback waits on other rows, so don't hold the detector set
+    start = time.perf_counter()
+    confidence = dnn_batcher.max_confidence(image)
+    timings['dnn'] = time.perf_counter() - start
+    return confidence > dnn_thresh, 'dnn', confidence
+
+NOFACE_PARTIAL_SUFFIX = ".partial.jpg"
+NOFACE_MANIFEST_NAME = ".manifest"  # Append-only save order of a job's images (?since=N offsets)
+
+def record_verdict(face_found, image, job_id, id_val, config, data=None):
+    """Turn a detection result into (status, log_msg), queueing NO FACE evidence.
+
+    `data` is the downloaded file, stored as-is in 'original' artifact mode.
+    """
+    if face_found:
+        return "GOOD", ""
+    else:
+        # Save NO FACE image only if requested
+        if config.get('save_images', True):
+            return "NO FACE", save_noface_evidence(image, job_id, id_val, config, data)
+        else:
+            return "NO FACE", "Image not saved (Config)"
+
+def save_noface_evidence(image, job_id, id_val, config, data=None):
+    """Hand the evidence to the background writer, returns the log message"""
+    path = artifact_writer.save(image, job_id, id_val, config, data)
+    return f"Saved: {path}" if path else "Image dropped (writer busy)"
+
+def noface_image_path(job_id, id_val):
+    return os.path.join(NO_FACE_FOLDER, job_id, f"{id_val}_NOFACE.jpg")
+
+def record_noface_image(path):
+    """Append a finished evidence file to its job folder's manifest.
+
+    One O_APPEND write per line, so lines from writer threads, processes
+    and shard uploads never interleave and earlier offsets never move.
+    """
+    manifest = os.path.join(os.path.dirname(path), NOFACE_MANIFEST_NAME)
+    fd = os.open(manifest, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (os.path.basename(path) + "\n").encode('utf-8'))
+    finally:
+        os.close(fd)
+
+def encode_noface_artifact(image, data, config):
+    """JPEG bytes to store for a NO FACE row, per the job's artifact mode"""
+    mode = config.get('artifact_mode', DEFAULT_ARTIFACT_MODE)
+    if mode == 'original' and data is not None and data[:2] == b'\xff\xd8':
+        return data  # Already a JPEG: no decode / re-encode, smallest file
+
+    params = []
+    if mode != 'full':
+        # 'compact' (and non-JPEG originals): downscale and recompress
+        max_dim = config.get('artifact_max_dimension', DEFAULT_ARTIFACT_MAX_DIMENSION)
+        (h, w) = image.shape[:2]
+        scale = max_dim / float(max(h, w)) if max_dim else 1.0
+        if scale < 1.0:
+            image = cv2.resize(image, (max(1, int(w * scale)), max(1, int(h * scale))),
+                               interpolation=cv2.INTER_AREA)
+        params = [cv2.IMWRITE_JPEG_QUALITY, int(config.get('artifact_quality', DEFAULT_ARTIFACT_QUALITY))]
+    ok, encoded = cv2.imencode('.jpg', image, params)
+    if not ok:
+        raise ValueError("JPEG encode failed")
+    return encoded.tobytes()
+
+def save_noface_image(image, job_id, id_val, config=None, data=None):
+    """Write NO FACE evidence to the job folder, returns (path, bytes written)"""
+    save_path = noface_image_path(job_id, id_val)
+    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    # Write aside and rename so a ZIP streamed mid-job never reads half a file
+    partial_path = save_path[:-len(".jpg")] + NOFACE_PARTIAL_SUFFIX
+    with stage_metrics.timed('imwrite', job_id):
+        payload = encode_noface_artifact(image, data, config or {})
+        with open(partial_path, 'wb') as f:
+            f.write(payload)
+        os.replace(partial_path, save_path)
+        record_noface_image(save_path)
+    return save_path, len(payload)
+
+class ArtifactWriter:
+    """Writes NO FACE evidence on background threads, off the detection path.
+
+    Frames wait in a bounded queue (memory stays capped). When it is full
+    the job's backpressure policy decides: 'block' the caller, 'drop' the
+    image, or write it 'inline' on the caller's thread. flush(job_id) waits
+    until everything queued for a job is on disk.
+    """
+
+    def __init__(self, threads=ARTIFACT_WRITER_THREADS, queue_size=ARTIFACT_QUEUE_SIZE):
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._cond = threading.Condition()
+        self._pending = {}  # job_id -> items not finished yet
+        self._writing = set()  # Target paths queued but not on disk yet
+        self._stats = {}  # job_id -> counters
+        self.totals = {'written': 0, 'dropped': 0, 'failed': 0, 'bytes': 0, 'inline': 0}
+        self.threads = threads
+        self._started_pid = None
+
+    def _ensure_started(self):
+        # Threads start on first use in each process (none exist in a preloaded master)
+        with self._cond:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+        for n in range(self.threads):
+            threading.Thread(target=self._worker, name=f"artifact-writer-{n}", daemon=True).start()
+
+    def save(self, image, job_id, id_val, config, data=None):
+        """Queue one image, returns its final path (None if dropped)"""
+        path = noface_image_path(job_id, id_val)
+        item = ('save', job_id, path, (image, id_val, config, data))
+        return path if self._submit(item, config) else None
+
+    def link(self, job_id, source_id, id_val, config):
+        """Give a duplicate row the evidence of `source_id` once that is written"""
+        path = noface_image_path(job_id, id_val)
+        self._submit(('link', job_id, path, (source_id, id_val)), config)
+
+    def _submit(self, item, config):
+        job_id, path = item[1], item[2]
+        self._ensure_started()
+        self._begin(job_id, path)
+        policy = config.get('artifact_backpressure', DEFAULT_ARTIFACT_BACKPRESSURE)
+        if policy == 'block':
+            self._queue.put(item)
+            return True
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            if policy == 'drop':
+                self._end(job_id, path, 'dropped')
+                return False
+            self._count(job_id, 'inline')
+            self._process(item)  # 'inline': the caller pays for this one
+            return True
+
+    def _begin(self, job_id, path):
+        with self._cond:
+            self._pending[job_id] = self._pending.get(job_id, 0) + 1
+            self._writing.add(path)
+
+    def _end(self, job_id, path, outcome, size=0):
+        with self._cond:
+            self._pending[job_id] -= 1
+            if not self._pending[job_id]:
+                del self._pending[job_id]
+            self._writing.discard(path)
+            self._count_locked(job_id, outcome, size)
+            self._cond.notify_all()
+
+    def _count(self, job_id, outcome):
+        with self._cond:
+            self._count_locked(job_id, outcome)
+
+    def _count_locked(self, job_id, outcome, size=0):
+        stats = self._stats.setdefault(job_id, {'written': 0, 'dropped': 0, 'failed': 0, 'bytes': 0, 'inline': 0})
+        stats[outcome] += 1
+        stats['bytes'] += size
+        self.totals[outcome] += 1
+        self.totals['bytes'] += size
+
+    def _worker(self):
+        while True:
+            self._process(self._queue.get())
+
+    def _process(self, item):
+        kind, job_id, path, args = item
+        outcome, size = 'failed', 0
+        try:
+            if kind == 'save':
+                image, id_val, config, data = args
+                _, size = save_noface_image(image, job_id, id_val, config, data)
+            else:
+                source_id, id_val = args
+                source = noface_image_path(job_id, source_id)
+                with self._cond:
+                    # Written by an earlier queue item, possibly on another thread right now
+                    self._cond.wait_for(lambda: source not in self._writing, timeout=60)
+                link_noface_image(job_id, source_id, id_val)
+            outcome = 'written'
+        except Exception as e:
+            print(f"Artifact writer error ({path}): {e}")
+        finally:
+            self._end(job_id, path, outcome, size)
+
+    def flush(self, job_id, timeout=None):
+        """Block until every image queued for job_id is written (False on timeout)"""
+        with self._cond:
+            return self._cond.wait_for(lambda: job_id not in self._pending, timeout=timeout)
+
+    def job_stats(self, job_id):
+        with self._cond:
+            return dict(self._stats.get(job_id, {}))
+
+    def forget(self, job_id):
+        with self._cond:
+            self._stats.pop(job_id, None)
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+artifact_writer = ArtifactWriter()
+
+def classify_image(image, job_id, id_val, config, data=None):
+    """Run MediaPipe -> DNN cascade on a decoded image, returns (status, log_msg)"""
+    return record_verdict(detect_face(image, config), image, job_id, id_val, config, data)
+
+def process_row(row, job_id, config, image_col='Check-In Photo'):
+    """Process a single row for face detection"""
+    img_url = row.get(image_col)
+    id_val = row.get("id", row.name)
+    
+    # Extract config
+    timeout = config.get('download_timeout', DEFAULT_DOWNLOAD_TIMEOUT)
+
+    if pd.isna(img_url) or str(img_url).strip() == "":
+        return row.name, "Skipped (empty URL)", ""
+
+    try:
+        data = fetch_image_bytes(str(img_url), timeout)
+    except FetchError as e:
+        return row.name, "DOWNLOAD_ERROR", f"Download failed ({e})"
+
+    image = decode_image(data, config.get('max_dimension', DEFAULT_MAX_DIMENSION))
+    if image is None:
+        return row.name, "DOWNLOAD_ERROR", "Download failed (decode_error)"
+
+    rejected = apply_prefilter(image, job_id, id_val, config, data) if config.get('prefilter') else None
+    if rejected:
+        return (row.name,) + rejected
+
+    status, log_msg = classify_image(image, job_id, id_val, config, data)
+    return row.name, status, log_msg
+
+# ==========================================
+# ======== PROCESS-POOL INFERENCE ==========
+# ==========================================
+
+def inference_process_context():
+    """forkserver where available (else spawn): never fork this threaded server"""
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    context = multiprocessing.get_context('forkserver')
+    # The fork server imports only the model code, each process forks from it
+    context.set_forkserver_preload(['inference_worker'])
+    return context
+
+class ProcessInference:
+    """Inference in worker processes so Python-side work doesn't share one GIL.
+
+    The processes run inference_worker.py and load the models once each
+    (initializer). Decoded frames are copied into a SharedMemory block and
+    only its name crosses the process boundary, instead of pickling
+    multi-megabyte arrays through a pipe.
+    """
+
+    def __init__(self, processes):
+        self.processes = processes
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=inference_process_context(),
+            initializer=inference_worker.init_process,
+            initargs=(prototxt_path, model_path, DEFAULT_MEDIAPIPE_CONF_THRESH)
+        )
+
+    def detect(self, image, config, timings=None):
+        image = np.ascontiguousarray(image)
+        shm = shared_memory.SharedMemory(create=True, size=image.nbytes)
+        try:
+            np.ndarray(image.shape, dtype=image.dtype, buffer=shm.buf)[:] = image
+            face_found, worker_timings = self._executor.submit(
+                inference_worker.detect_shared_frame, shm.name, image.shape, image.dtype.str,
+                config.get('mediapipe_thresh', DEFAULT_MEDIAPIPE_CONF_THRESH),
+                config.get('dnn_thresh', DEFAULT_DNN_CONF_THRESH)).result()
+            if timings is not None:
+                timings.update(worker_timings)  # Measured in the worker process
+            return face_found
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+process_inference_pools = {}
+process_inference_lock = threading.Lock()
+
+def get_process_inference(processes):
+    """Process-wide worker pool of the given size (reused across jobs)"""
+    with process_inference_lock:
+        if processes not in process_inference_pools:
+            process_inference_pools[processes] = ProcessInference(processes)
+        return process_inference_pools[processes]
+
+def detect_face_in_process(image, config, processes, timings=None):
+    """detect_face on a worker process; a crashed pool is replaced for next time"""
+    pool = get_process_inference(processes)
+    try:
+        return pool.detect(image, config, timings)
+    except concurrent.futures.process.BrokenProcessPool:
+        with process_inference_lock:
+            if process_inference_pools.get(processes) is pool:
+                del process_inference_pools[processes]
+        pool.shutdown()
+        raise
+
+atexit.register(lambda: [pool.shutdown() for pool in list(process_inference_pools.values())])
+
+# ==========================================
+# ======= SYNCHRONOUS DETECTION API ========
+# ==========================================
+
+# /api/detect answers the check-in app in real time. It has its own warm
+# detectors and inference threads, so bulk jobs (which go through the job
+# scheduler and the global slots) can't starve it, and it can't starve them
+# beyond DETECT_MAX_CONCURRENT cores.
+interactive_detectors = DetectorPool(max_idle=DETECT_MAX_CONCURRENT)
+detect_executor = concurrent.futures.ThreadPoolExecutor(max_workers=DETECT_MAX_CONCURRENT,
+                                                        thread_name_prefix="detect")
+detect_admission = threading.BoundedSemaphore(DETECT_MAX_REQUESTS)
+atexit.register(lambda: detect_executor.shutdown(wait=False, cancel_futures=True))
+
+def decode_base64_image(value):
+    """Raw bytes from a base64 string or data: URI (None if malformed)"""
+    if value.startswith('data:'):
+        value = value.partition(',')[2]
+    try:
+        return base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+
+def detect_image_bytes(index, data, config, started):
+    """Decode -> (pre-filter) -> cascade for one image, returns its verdict dict"""
+    result = {'index': index}
+    image = decode_image(data, config.get('max_dimension', DEFAULT_MAX_DIMENSION)) if data else None
+    if image is None:
+        result.update(status="INVALID_IMAGE", face_found=False, error='decode_error')
+    else:
+        reason = prefilter_image(image, config) if config.get('prefilter') else None
+        if reason:
+            result.update(status=PREFILTER_STATUSES[reason], face_found=False, engine='prefilter')
+        else:
+            face_found, engine, confidence = score_face(image, config, pool=interactive_detectors)
+            result.update(status="GOOD" if face_found else "NO FACE", face_found=face_found,
+                          engine=engine, confidence=round(confidence, 4))
+    result['latency_ms'] = round((time.perf_counter() - started) * 1000, 2)
+    stage_metrics.count('detect_images_total', result['status'])
+    return result
+
+def detect_sources(sources, config):
+    """Yield one verdict per source as soon as it is ready (completion order).
+
+    A source is ('bytes', data) or ('url', url). URLs are fetched on the
+    shared async fetcher and only take an inference thread once downloaded.
+    """
+    started = time.perf_counter()
+    done = queue.Queue()
+
+    def submit(index, data):
+        future = detect_executor.submit(detect_image_bytes, index, data, config, started)
+        future.add_done_callback(lambda f: done.put((index, f)))
+
+    def fetched(index, future):
+        try:
+            submit(index, future.result())
+        except Exception as e:
+            reason = e.reason if isinstance(e, FetchError) else 'fetch_error'
+            stage_metrics.count('detect_images_total', "DOWNLOAD_ERROR")
+            done.put((index, {'index': index, 'status': "DOWNLOAD_ERROR", 'face_found': False,
+                              'error': reason,
+                              'latency_ms': round((time.perf_counter() - started) * 1000, 2)}))
+
+    timeout = config.get('download_timeout', DETECT_DOWNLOAD_TIMEOUT)
+    for index, (kind, value) in enumerate(sources):
+        if kind == 'url':
+            future = image_fetcher.run(image_fetcher.fetch_async(value, timeout))
+            future.add_done_callback(functools.partial(fetched, index))
+        else:
+            submit(index, value)
+
+    for _ in sources:
+        index, outcome = done.get()
+        if isinstance(outcome, dict):
+            yield outcome
+            continue
+        try:
+            yield outcome.result()
+        except Exception as e:
+            yield {'index': index, 'status': "ERROR", 'face_found': False, 'error': str(e)}
+
+# Exact percentiles over recent single-image requests (histogram buckets are too coarse)
+detect_latencies = deque(maxlen=1000)
+
+def observe_detect_latency(seconds):
+    stage_metrics.observe('detect_api', seconds)
+    detect_latencies.append(seconds)
+
+def detect_api_stats():
+    """Recent latency against the p99 target plus current load"""
+    window = sorted(detect_latencies)
+
+    def percentile(q):
+        return round(window[min(len(window) - 1, int(q * len(window)))] * 1000, 2) if window else None
+
+    _, counters = stage_metrics.snapshot()
+    p99 = percentile(0.99)
+    return {
+        'window': len(window),
+        'p50_ms': percentile(0.5),
+        'p95_ms': percentile(0.95),
+        'p99_ms': p99,
+        'p99_target_ms': DETECT_P99_TARGET_MS,
+        'within_target': None if p99 is None else p99 <= DETECT_P99_TARGET_MS,
+        'max_concurrent': DETECT_MAX_CONCURRENT,
+        'max_requests': DETECT_MAX_REQUESTS,
+        'rejected': counters.get(('detect_requests_total', 'busy'), 0),
+        'detectors': interactive_detectors.stats()
+    }
+
+# ==========================================
+# ============= RESULT CACHE ===============
+# ==========================================
+
+class ProcessLocalConnection:
+    """A connection opened on first use in each process.
+
+    Nothing is opened at import, and a process forked from one that already
+    connected (gunicorn preload, inference workers) opens its own instead of
+    sharing the parent's SQLite file handle.
+    """
+
+    def __init__(self, connect):
+        self._connect = connect
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def get(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._conn = self._connect()
+                    self._pid = pid
+        return self._conn
+
+CACHEABLE_STATUSES = ("GOOD", "NO FACE") + tuple(PREFILTER_STATUSES.values())
+
+def normalize_image_url(url):
+    """Canonical form of an image URL (case-insensitive scheme/host, no fragment)"""
+    url = str(url).strip()
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return url
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, ''))
+
+class ResultCache:
+    """SQLite-backed verdict cache with TTL and LRU eviction.
+
+    Keys hash the normalized URL together with every setting that can change
+    the verdict, so a re-audit with different thresholds never reuses stale
+    answers. Only GOOD / NO FACE are cached; errors are always retried.
+    """
+
+    TOUCH_INTERVAL = 60  # Seconds between last_access updates for a hot key
+    EVICT_EVERY = 1000  # Writes between eviction sweeps
+
+    def __init__(self, path=RESULT_CACHE_PATH, max_entries=RESULT_CACHE_MAX_ENTRIES,
+                 ttl_hours=RESULT_CACHE_TTL_HOURS):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_hours * 3600
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._db = ProcessLocalConnection(self._connect)
+
+    @property
+    def _conn(self):
+        return self._db.get()
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS verdicts ("
+            " key TEXT PRIMARY KEY, status TEXT NOT NULL,"
+            " created_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_verdicts_access ON verdicts(last_access)")
+        return conn
+
+    @staticmethod
+    def make_key(url, config):
+        parts = [
+            normalize_image_url(url),
+            f"{float(config.get('mediapipe_thresh', DEFAULT_MEDIAPIPE_CONF_THRESH)):.4f}",
+            f"{float(config.get('dnn_thresh', DEFAULT_DNN_CONF_THRESH)):.4f}",
+        ]
+        # Reduced working resolution can change a verdict, full resolution keeps old keys
+        if config.get('max_dimension'):
+            parts.append(f"maxdim={int(config['max_dimension'])}")
+        if config.get('prefilter'):
+            parts.append("prefilter={},{:.2f},{:.2f},{:.2f}".format(
+                int(config.get('prefilter_min_dim', DEFAULT_PREFILTER_MIN_DIM)),
+                float(config.get('prefilter_min_std', DEFAULT_PREFILTER_MIN_STD)),
+                float(config.get('prefilter_dark_mean', DEFAULT_PREFILTER_DARK_MEAN)),
+                float(config.get('prefilter_min_blur', DEFAULT_PREFILTER_MIN_BLUR))))
+        return hashlib.sha256("|".join(parts).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT status, created_at, last_access FROM verdicts WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            status, created_at, last_access = row
+            if now - created_at > self.ttl_seconds:
+                self._conn.execute("DELETE FROM verdicts WHERE key = ?", (key,))
+                self.misses += 1
+                return None
+
+            if now - last_access > self.TOUCH_INTERVAL:
+                self._conn.execute("UPDATE verdicts SET last_access = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return status
+
+    def put(self, key, status):
+        if status not in CACHEABLE_STATUSES:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO verdicts (key, status, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, status, now, now)
+            )
+            self._writes += 1
+            if self._writes % self.EVICT_EVERY == 0:
+                self._evict(now)
+
+    def _evict(self, now):
+        # Caller holds the lock
+        cur = self._conn.execute("DELETE FROM verdicts WHERE created_at < ?", (now - self.ttl_seconds,))
+        self.evictions += max(cur.rowcount, 0)
+
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM verdicts").fetchone()
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM verdicts WHERE key IN "
+                "(SELECT key FROM verdicts ORDER BY last_access LIMIT ?)", (overflow,)
+            )
+            self.evictions += overflow
+
+    def stats(self):
+        with self._lock:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM verdicts").fetchone()
+            return {
+                'entries': count,
+                'max_entries': self.max_entries,
+                'ttl_hours': self.ttl_seconds / 3600,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+result_cache = ResultCache()
+
+# ==========================================
+# ========== STAGED JOB PIPELINE ===========
+# ==========================================
+
+_PIPELINE_DONE = object()  # Sentinel: no more tasks for this stage
+
+class StagedPipeline:
+    """Worker stages connected by bounded queues.
+
+    Each stage is (name, func, workers[, mode]). In the default 'thread' mode
+    func(task) mutates the task dict in place on one of `workers` threads. In
+    'async' mode func(task) must return a concurrent.futures.Future, and a
+    single pump thread keeps up to `workers` of them in flight (used for the
+    asyncio fetcher). Once a task carries a 'status' it skips the remaining
+    stages and goes straight to the results queue. Bounded queues mean a fast
+    stage blocks instead of piling up decoded frames in memory.
+    """
+
+    def __init__(self, stages, queue_size=DEFAULT_PIPELINE_QUEUE_SIZE, stop_event=None):
+        self.stages = [(stage + ('thread',))[:4] for stage in stages]
+        self.inputs = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self.results = queue.Queue(maxsize=queue_size)
+        self.stop_event = stop_event or threading.Event()
+        self.error = None
+        self._lock = threading.Lock()
+        self._alive = [self._consumers(i) for i in range(len(stages))]
+        self._processed = [0] * len(stages)
+        self._in_flight = [0] * len(stages)
+        self._started = None
+        self._threads = []
+
+    def _consumers(self, stage_idx):
+        """Threads reading a stage's input queue (one pump for async stages)"""
+        _, _, workers, mode = self.stages[stage_idx]
+        return 1 if mode == 'async' else workers
+
+    def start(self, tasks):
+        """Start feeding tasks (any iterable of dicts) through the stages"""
+        self._started = time.time()
+        for stage_idx, (name, _, _, mode) in enumerate(self.stages):
+            target = self._async_pump if mode == 'async' else self._worker
+            for n in range(self._consumers(stage_idx)):
+                t = threading.Thread(target=target, args=(stage_idx,),
+                                     name=f"{name}-{n}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+        feeder = threading.Thread(target=self._feed, args=(tasks,), name="feeder", daemon=True)
+        feeder.start()
+        self._threads.append(feeder)
+
+    def stop(self):
+        """Abandon in-flight work (cancellation)"""
+        self.stop_event.set()
+
+    def _put(self, q, item):
+        # Blocking put that still notices a stop request
+        while not self.stop_event.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q):
+        while not self.stop_event.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _PIPELINE_DONE
+
+    def _feed(self, tasks):
+        try:
+            for task in tasks:
+                if not self._put(self.inputs[0], task):
+                    return
+        except Exception as e:
+            self.error = e
+        for _ in range(self._consumers(0)):
+            self._put(self.inputs[0], _PIPELINE_DONE)
+
+    def _worker(self, stage_idx):
+        func = self.stages[stage_idx][1]
+        in_q = self.inputs[stage_idx]
+
+        while True:
+            task = self._get(in_q)
+            if task is _PIPELINE_DONE:
+                break
+
+            if 'status' not in task:
+                try:
+                    func(task)
+                except Exception as e:
+                    task['status'] = 'SYSTEM_ERROR'
+                    task['log'] = str(e)
+                with self._lock:
+                    self._processed[stage_idx] += 1
+
+            if not self._put(self._next_queue(stage_idx, task), task):
+                return
+
+        self._close_stage(stage_idx)
+
+    def _async_pump(self, stage_idx):
+        submit = self.stages[stage_idx][1]
+        max_in_flight = self.stages[stage_idx][2]
+        in_q = self.inputs[stage_idx]
+        pending = {}
+        input_done = False
+
+        while not self.stop_event.is_set():
+            # Top up in-flight work without blocking while results are due
+            while not input_done and len(pending) < max_in_flight:
+                try:
+                    task = in_q.get_nowait() if pending else in_q.get(timeout=0.1)
+                except queue.Empty:
+                    break
+                if task is _PIPELINE_DONE:
+                    input_done = True
+                elif 'status' in task:
+                    if not self._put(self.results, task):
+                        return
+                else:
+                    pending[submit(task)] = task
+
+            with self._lock:
+                self._in_flight[stage_idx] = len(pending)
+
+            if not pending:
+                if input_done:
+                    break
+                continue
+
+            done, _ = concurrent.futures.wait(pending, timeout=0.1,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                task = pending.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    task['status'] = 'SYSTEM_ERROR'
+                    task['log'] = str(e)
+                with self._lock:
+                    self._processed[stage_idx] += 1
+                if not self._put(self._next_queue(stage_idx, task), task):
+                    return
+
+        if not self.stop_event.is_set():
+            self._close_stage(stage_idx)
+
+    def _next_queue(self, stage_idx, task):
+        if stage_idx == len(self.stages) - 1 or 'status' in task:
+            return self.results
+        return self.inputs[stage_idx + 1]
+
+    def _close_stage(self, stage_idx):
+        # Last consumer out closes the next stage (or the results stream)
+        with self._lock:
+            self._alive[stage_idx] -= 1
+            closing = self._alive[stage_idx] == 0
+        if closing:
+            if stage_idx == len(self.stages) - 1:
+                self._put(self.results, _PIPELINE_DONE)
+            else:
+                for _ in range(self._consumers(stage_idx + 1)):
+                    self._put(self.inputs[stage_idx + 1], _PIPELINE_DONE)
+
+    def iter_results(self):
+        """Yield finished tasks until every stage has drained"""
+        while True:
+            task = self._get(self.results)
+            if task is _PIPELINE_DONE:
+                break
+            yield task
+        if self.error:
+            raise self.error
+
+    def snapshot(self):
+        """Per-stage queue depth and throughput for the status payload"""
+        elapsed = max(time.time() - (self._started or time.time()), 1e-6)
+        with self._lock:
+            processed = list(self._processed)
+            in_flight = list(self._in_flight)
+        stages = {}
+        for idx, (name, _, workers, mode) in enumerate(self.stages):
+            stages[name] = {
+                'workers': workers,
+                'queue_depth': self.inputs[idx].qsize(),
+                'in_flight': in_flight[idx] if mode == 'async' else None,
+                'processed': processed[idx],
+                'rows_per_sec': round(processed[idx] / elapsed, 2)
+            }
+        return {'stages': stages, 'results_queue_depth': self.results.qsize()}
+
+def iter_row_tasks(df, indices, image_col):
+    """Turn pending DataFrame rows into pipeline tasks"""
+    urls = df.loc[indices, image_col]
+    ids = df.loc[indices, 'id'] if 'id' in df.columns else pd.Series(indices, index=indices)
+    for idx, img_url, id_val in zip(indices, urls, ids):
+        task = {'idx': idx, 'id': id_val, 'url': img_url}
+        if pd.isna(img_url) or str(img_url).strip() == "":
+            task['status'] = "Skipped (empty URL)"
+            task['log'] = ""
+        else:
+            task['url'] = str(img_url)
+        yield task
+
+def with_cached_verdicts(tasks, config, cache_stats):
+    """Answer tasks from the result cache before they reach the network"""
+    save_images = config.get('save_images', True)
+    for task in tasks:
+        if 'status' not in task:
+            task['cache_key'] = ResultCache.make_key(task['url'], config)
+            cached = result_cache.get(task['cache_key'])
+            # A NO FACE hit still needs the image when evidence is being saved
+            if cached and not (is_noface_status(cached) and save_images):
+                task['status'] = cached
+                task['log'] = "Cached result"
+                task['cache_hit'] = True
+                cache_stats['hits'] += 1
+            else:
+                cache_stats['misses'] += 1
+        yield task
+
+class RowDeduplicator:
+    """Runs each distinct (normalized) image URL once per job.
+
+    The first row with a URL goes through the pipeline; rows repeating it
+    are held back while it is in flight and get its verdict copied when it
+    finishes (resolve), or straight away if it already has.
+    """
+
+    VERDICT_FIELDS = ('status', 'log', 'error_reason')
+
+    def __init__(self, job_id, config):
+        self.job_id = job_id
+        self.config = config
+        self.save_images = config.get('save_images', True)
+        self.dedup_rows = 0
+        self._lock = threading.Lock()
+        self._pending = {}  # url key -> rows waiting on the first one
+        self._verdicts = {}  # url key -> (source row id, verdict fields)
+
+    def filter(self, tasks):
+        for task in tasks:
+            if 'status' not in task:
+                key = normalize_image_url(task['url'])
+                with self._lock:
+                    done = self._verdicts.get(key)
+                    if done is None and key in self._pending:
+                        self._pending[key].append(task)
+                        self.dedup_rows += 1
+                        continue
+                    if done is None:
+                        self._pending[key] = []
+                        task['dedup_key'] = key
+                    else:
+                        self.dedup_rows += 1
+                if done is not None:
+                    self._copy_verdict(task, *done)
+            yield task
+
+    def resolve(self, task):
+        """Fan a finished row's verdict out to the rows that were waiting on it"""
+        key = task.pop('dedup_key', None)
+        if key is None:
+            return []
+        verdict = {k: task[k] for k in self.VERDICT_FIELDS if k in task}
+        with self._lock:
+            followers = self._pending.pop(key, [])
+            self._verdicts[key] = (task['id'], verdict)
+        for follower in followers:
+            self._copy_verdict(follower, task['id'], verdict)
+        return followers
+
+    def _copy_verdict(self, task, source_id, verdict):
+        task.update(verdict)
+        task['log'] = f"Same image as row {source_id}"
+        if is_noface_status(task['status']) and self.save_images:
+            artifact_writer.link(self.job_id, source_id, task['id'], self.config)
+
+def link_noface_image(job_id, source_id, id_val):
+    """Give a duplicate row its own NO FACE evidence file (hard link, no copy).
+
+    The link shares the source's mtime, so it is placed by the manifest
+    entry written here, not by its timestamp.
+    """
+    source = noface_image_path(job_id, source_id)
+    target = noface_image_path(job_id, id_val)
+    if source == target or not os.path.exists(source) or os.path.exists(target):
+        return
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+    record_noface_image(target)
+
+def build_job_pipeline(job_id, config):
+    """Download -> decode -> inference stages sized for I/O vs CPU work"""
+    timeout = config.get('download_timeout', DEFAULT_DOWNLOAD_TIMEOUT)
+    max_dimension = config.get('max_dimension', DEFAULT_MAX_DIMENSION)
+    stop_event = threading.Event()
+
+    async def fetch_into(task):
+        start = time.perf_counter()
+        try:
+            task['data'] = await image_fetcher.fetch_async(task['url'], timeout)
+        except FetchError as e:
+            task['status'] = "DOWNLOAD_ERROR"
+            task['log'] = f"Download failed ({e})"
+            task['error_reason'] = e.reason
+        finally:
+            download_slots.release()
+            stage_metrics.observe('download', time.perf_counter() - start, job_id)
+
+    def download_stage(task):
+        # Waits its turn for a global download slot (round-robin across jobs)
+        if not download_slots.acquire(job_id, stop_event):
+            stopped = concurrent.futures.Future()
+            stopped.set_result(None)
+            return stopped
+        return image_fetcher.run(fetch_into(task))
+
+    use_prefilter = config.get('prefilter', DEFAULT_PREFILTER)
+    # Original bytes ride along only when they may become NO FACE evidence
+    keep_original = (config.get('save_images', True) and
+                     config.get('artifact_mode', DEFAULT_ARTIFACT_MODE) == 'original')
+
+    def decode_stage(task):
+        data = task.pop('data')
+        with stage_metrics.timed('decode', job_id):
+            image = decode_image(data, max_dimension)
+        if image is None:
+            task['status'] = "DOWNLOAD_ERROR"
+            task['log'] = "Download failed (decode_error)"
+            task['error_reason'] = "decode_error"
+            return
+        raw = data if keep_original else None
+        # Hopeless frames never reach the inference queue
+        rejected = apply_prefilter(image, job_id, task['id'], config, raw) if use_prefilter else None
+        if rejected:
+            task['status'], task['log'] = rejected
+        else:
+            task['image'] = image
+            if raw is not None:
+                task['raw'] = raw
+
+    # Inference is CPU-bound: more workers than cores only adds contention
+    inference_workers = max(1, min(config.get('num_threads', DEFAULT_NUM_THREADS), CPU_COUNT))
+    use_processes = config.get('execution_mode', DEFAULT_EXECUTION_MODE) == 'processes'
+
+    def inference_stage(task):
+        image = task.pop('image')
+        if not inference_slots.acquire(job_id, stop_event):
+            task['status'], task['log'] = 'SYSTEM_ERROR', 'Job stopped'
+            return
+        timings = {}
+        try:
+            if use_processes:
+                # Each stage thread just hands one frame at a time to a worker process
+                face_found = detect_face_in_process(image, config, inference_workers, timings)
+            else:
+                face_found = detect_face(image, config, timings)
+        finally:
+            inference_slots.release()
+        stage_metrics.observe_all(timings, job_id)
+        task['status'], task['log'] = record_verdict(face_found, image, job_id, task['id'], config,
+                                                     task.pop('raw', None))
+
+    return StagedPipeline([
+        ('download', download_stage, config.get('download_workers', DEFAULT_DOWNLOAD_WORKERS), 'async'),
+        ('decode', decode_stage, config.get('decode_workers', DEFAULT_DECODE_WORKERS)),
+        ('inference', inference_stage, inference_workers),
+    ], stop_event=stop_event)
+
+class ShardCoordinator:
+    """Runs a job's rows on shard_worker.py processes / nodes instead of here.
+
+    Drop-in for the staged pipeline (start / iter_results / stop / snapshot).
+    A feeder thread cuts the incoming tasks into CSV shards of `shard_rows`
+    rows (SHARD_COLUMNS) and registers them in the job store; workers lease
+    them over /api/shards/*, heartbeat, and post back one verdict per row.
+    Shards of a worker that stops heartbeating are leased again. Because
+    the job store is shared, any gunicorn worker on the host can serve the
+    shard endpoints. Finished shards come back in completion order as
+    ordinary tasks; the caller writes each status at its original idx.
+
+    Rows that already have a verdict (empty URL, cache hit, duplicate URL)
+    never leave this process.
+    """
+
+    def __init__(self, job_id, config):
+        self.job_id = job_id
+        self.shard_rows = int(config['shard_rows'])
+        self.folder = os.path.join(RESULTS_FOLDER, f"{job_id}_shards")
+        self.stop_event = threading.Event()
+        self.ready = queue.Queue()  # Tasks settled without a worker
+        self.shards = 0
+        self.merged = 0
+        self.cut_done = False
+        self.workers = {}  # worker -> {'shards', 'rows', 'busy_s'}
+        self._started = None
+
+    def start(self, tasks):
+        self._started = time.time()
+        shutil.rmtree(self.folder, ignore_errors=True)
+        os.makedirs(self.folder, exist_ok=True)
+        job_store.add_artifacts(self.job_id, [(self.folder, 'dir')])
+        job_store.delete_shards(self.job_id)  # Left over from before a restart
+        threading.Thread(target=self._cut, args=(tasks,), daemon=True).start()
+
+    def _cut(self, tasks):
+        batch = []
+        try:
+            for task in tasks:
+                if self.stop_event.is_set():
+                    return
+                if 'status' in task:
+                    self.ready.put(task)
+                    continue
+                batch.append(task)
+                if len(batch) >= self.shard_rows:
+                    self._write_shard(batch)
+                    batch = []
+            if batch:
+                self._write_shard(batch)
+        except Exception as e:
+            self.ready.put(e)  # Re-raised by iter_results in the job thread
+        finally:
+            self.cut_done = True
+
+    def _write_shard(self, batch):
+        path = os.path.join(self.folder, f"{self.shards}.csv")
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(SHARD_COLUMNS)
+            writer.writerows([t['idx'], t['id'], t['url'], t.get('cache_key', ''), t.get('dedup_key', '')]
+                             for t in batch)
+        job_store.add_shard(self.job_id, self.shards, batch[0]['idx'], batch[-1]['idx'], len(batch), path)
+        self.shards += 1
+
+    def iter_results(self):
+        """Yield finished tasks; None while waiting, so the caller can publish and check cancellation"""
+        while not self.stop_event.is_set():
+            cut_done = self.cut_done  # Read first: shards cut after this are still counted below
+            while not self.ready.empty():
+                task = self.ready.get_nowait()
+                if isinstance(task, Exception):
+                    raise task
+                yield task
+            finished = job_store.take_finished_shards(self.job_id)
+            for shard, worker, result in finished:
+                yield from self._merge(shard, worker, json.loads(result))
+                self.merged += 1
+            if cut_done and self.merged == self.shards and self.ready.empty():
+                break
+            if not finished:
+                stored = job_store.get_job(self.job_id)
+                if stored and stored['status'] == 'cancelled':
+                    with jobs_lock:
+                        jobs[self.job_id]['status'] = 'cancelled'
+                yield None
+                self.stop_event.wait(SHARD_POLL_SECONDS)
+        self._cleanup()
+
+    def _merge(self, shard, worker, result):
+        verdicts = {idx: (status, reason) for idx, status, reason in result['rows']}
+        stats = self.workers.setdefault(worker, {'shards': 0, 'rows': 0, 'busy_s': 0.0})
+        stats['shards'] += 1
+        stats['rows'] += len(verdicts)
+        stats['busy_s'] = round(stats['busy_s'] + result.get('elapsed_s', 0), 2)
+        # The shard file still has what the worker didn't need back (ids, cache / dedup keys)
+        with open(os.path.join(self.folder, f"{shard}.csv"), newline='', encoding='utf-8') as f:
+            for row in csv.DictReader(f):
+                status, reason = verdicts[int(row['idx'])]
+                task = {'idx': int(row['idx']), 'id': row['id'], 'status': status, 'log': f"Shard {shard} ({worker})"}
+                if reason:
+                    task['error_reason'] = reason
+                for key in ('cache_key', 'dedup_key'):
+                    if row[key]:
+                        task[key] = row[key]
+                yield task
+
+    def _cleanup(self):
+        job_store.delete_shards(self.job_id)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def stop(self):
+        """Abandon the job's shards (cancellation); workers lose their leases"""
+        self.stop_event.set()
+        self._cleanup()
+
+    def snapshot(self):
+        summary = job_store.shard_summary(self.job_id)
+        elapsed = max(time.time() - (self._started or time.time()), 1e-6)
+        rows = sum(w['rows'] for w in self.workers.values())
+        return {
+            'mode': 'sharded',
+            'shard_rows': self.shard_rows,
+            'shards': self.shards,
+            'shards_by_status': summary['by_status'],
+            'in_flight_rows': summary['in_flight_rows'],
+            'releases': summary['releases'],
+            'rows_per_sec': round(rows / elapsed, 2),
+            'workers': {name: dict(w) for name, w in self.workers.items()},
+            'stages': {}
+        }
+
+class JobRowRunner:
+    """Pending rows of a job -> finished rows.
+
+    Chains URL dedup and the verdict cache in front of the staged pipeline
+    (this process) or a ShardCoordinator (shard_worker.py processes, when
+    the job sets `shard_rows`). shard_worker.py uses it to run one shard.
+    """
+
+    def __init__(self, job_id, config, cache_stats):
+        self.config = config
+        self.cache_stats = cache_stats
+        self.dedup = RowDeduplicator(job_id, config) if config.get('dedup_urls', True) else None
+        if config.get('shard_rows'):
+            self.pipeline = ShardCoordinator(job_id, config)
+        else:
+            self.pipeline = build_job_pipeline(job_id, config)
+
+    @property
+    def dedup_rows(self):
+        return self.dedup.dedup_rows if self.dedup else 0
+
+    def start(self, tasks):
+        if self.dedup:
+            # Before the cache, so repeated URLs don't count as misses either
+            tasks = self.dedup.filter(tasks)
+        if self.config.get('use_cache', True):
+            tasks = with_cached_verdicts(tasks, self.config, self.cache_stats)
+        self.pipeline.start(tasks)
+
+    def iter_results(self):
+        """Yield lists of finished rows (a row plus any rows sharing its URL)"""
+        for task in self.pipeline.iter_results():
+            if task is None:
+                yield []  # Sharded job still waiting on its workers
+                continue
+            if 'cache_key' in task and not task.get('cache_hit'):
+                result_cache.put(task['cache_key'], task['status'])
+            # Rows repeating this URL within the job finish together with it
+            yield [task] + self.dedup.resolve(task) if self.dedup else [task]
+
+    def stop(self):
+        self.pipeline.stop()
+
+    def snapshot(self):
+        return self.pipeline.snapshot()
+
+# ==========================================
+# =========== DURABLE JOB STORE ============
+# ==========================================
+
+ACTIVE_JOB_STATUSES = ('queued', 'processing')
+
+class JobStore(abc.ABC):
+    """Durable job metadata, counters and per-row completion.
+
+    SQLiteJobStore is the default. A subclass that implements every
+    abstract method (e.g. a Redis-backed store) can be swapped in via
+    `job_store = MyStore()`.
+    """
+
+    @abc.abstractmethod
+    def save_job(self, job, owner=None):
+        """Upsert a job record (a stored 'cancelled' is never downgraded)"""
+
+    @abc.abstractmethod
+    def get_job(self, job_id):
+        pass
+
+    @abc.abstractmethod
+    def query_jobs(self, statuses=None, since=None, until=None, before=None, limit=50):
+        """One page of jobs, newest first: [(id, uploaded_at, version, job)].
+
+        since / until bound uploaded_at (ISO strings, until exclusive);
+        before is the (uploaded_at, id) of the last job on the previous page.
+        """
+
+    @abc.abstractmethod
+    def count_jobs(self, statuses):
+        pass
+
+    @abc.abstractmethod
+    def job_version(self, job_id):
+        """Counter bumped on every change to the stored job (None if unknown)"""
+
+    @abc.abstractmethod
+    def set_status(self, job_id, status, message=None):
+        pass
+
+    @abc.abstractmethod
+    def record_rows(self, job_id, rows):
+        """Mark [(row_idx, status), ...] as finished"""
+
+    @abc.abstractmethod
+    def completed_rows(self, job_id):
+        """Iterate (row_idx, status) for every finished row"""
+
+    @abc.abstractmethod
+    def heartbeat(self, job_ids, owner):
+        pass
+
+    @abc.abstractmethod
+    def active_jobs(self):
+        """[(job, owner, heartbeat)] for queued / processing jobs, oldest upload first"""
+
+    @abc.abstractmethod
+    def queue_position(self, job_id):
+        """1-based position among 'queued' jobs by upload time (None if not queued)"""
+
+    @abc.abstractmethod
+    def claim_job(self, job_id, owner, expected_owner):
+        """Atomically take over a job if it still belongs to expected_owner"""
+
+    @abc.abstractmethod
+    def add_artifacts(self, job_id, artifacts):
+        """Add [(path, 'file' | 'dir'), ...] to the job's manifest"""
+
+    @abc.abstractmethod
+    def job_artifacts(self, job_id):
+        """[(path, kind)] the job left on disk"""
+
+    @abc.abstractmethod
+    def expired_jobs(self, now, limit):
+        """[(job_id, heartbeat)] past their expires_at, soonest deadline first"""
+
+    @abc.abstractmethod
+    def delete_job(self, job_id):
+        """Drop the job record, its rows and its manifest"""
+
+    @abc.abstractmethod
+    def add_shard(self, job_id, shard, first_idx, last_idx, rows, path):
+        """Register a pending shard (a row range of a sharded job)"""
+
+    @abc.abstractmethod
+    def lease_shard(self, worker, lease_seconds):
+        """Atomically hand a pending or abandoned shard to a worker (dict, or None)"""
+
+    @abc.abstractmethod
+    def get_shard(self, job_id, shard):
+        pass
+
+    @abc.abstractmethod
+    def renew_shard(self, job_id, shard, lease_id, progress, lease_seconds):
+        """Extend a lease; False once it was lost (expired and re-leased, or job stopped)"""
+
+    @abc.abstractmethod
+    def complete_shard(self, job_id, shard, lease_id, result):
+        """Store a leased shard's result (JSON); False if the lease was lost"""
+
+    @abc.abstractmethod
+    def take_finished_shards(self, job_id):
+        """[(shard, worker, result)] completed since the last call, marked merged"""
+
+    @abc.abstractmethod
+    def shard_summary(self, job_id):
+        """{'by_status': {...}, 'in_flight_rows': n, 'releases': n}"""
+
+    @abc.abstractmethod
+    def delete_shards(self, job_id):
+        pass
+
+def job_expiry(job, now=None):
+    """Deadline for a finished job's files (None while it is still active)"""
+    if job.get('status') not in TERMINAL_JOB_STATUSES:
+        return None
+    hours = (job.get('config') or {}).get('retention_hours', MAX_FILE_AGE_HOURS)
+    return (now or time.time()) + float(hours) * 3600
+
+class SQLiteJobStore(JobStore):
+    """SQLite (WAL) job store, safe to share between processes on one host"""
+
+    def __init__(self, path=JOB_STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = ProcessLocalConnection(self._connect)
+
+    @property
+    def _conn(self):
+        return self._db.get()
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY, status TEXT NOT NULL, uploaded_at TEXT,"
+            " owner TEXT, heartbeat REAL, data TEXT NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS job_rows ("
+            " job_id TEXT NOT NULL, idx INTEGER NOT NULL, status TEXT NOT NULL,"
+            " PRIMARY KEY (job_id, idx)) WITHOUT ROWID"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS job_artifacts ("
+            " job_id TEXT NOT NULL, path TEXT NOT NULL, kind TEXT NOT NULL,"
+            " PRIMARY KEY (job_id, path)) WITHOUT ROWID"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS job_shards ("
+            " job_id TEXT NOT NULL, shard INTEGER NOT NULL, first_idx INTEGER, last_idx INTEGER,"
+            " rows INTEGER NOT NULL, path TEXT NOT NULL, status TEXT NOT NULL,"
+            " lease_id TEXT, worker TEXT, lease_until REAL, attempts INTEGER NOT NULL DEFAULT 0,"
+            " progress INTEGER NOT NULL DEFAULT 0, result TEXT,"
+            " PRIMARY KEY (job_id, shard))"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_shards_status ON job_shards(status)")
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]
+        if 'expires_at' not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN expires_at REAL")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_expires ON jobs(expires_at)"
+                           " WHERE expires_at IS NOT NULL")
+        if 'version' not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        # Job history pages: newest first, optionally within one status
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_uploaded ON jobs(uploaded_at, id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_uploaded ON jobs(status, uploaded_at, id)")
+        # Jobs finished before expiry existed get the default retention from now
+        placeholders = ",".join("?" * len(TERMINAL_JOB_STATUSES))
+        conn.execute(
+            f"UPDATE jobs SET expires_at = ? WHERE expires_at IS NULL AND status IN ({placeholders})",
+            (time.time() + MAX_FILE_AGE_HOURS * 3600, *TERMINAL_JOB_STATUSES)
+        )
+        return conn
+
+    @staticmethod
+    def _load(status, data):
+        job = json.loads(data)
+        job['status'] = status
+        return job
+
+    def save_job(self, job, owner=None):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, status, uploaded_at, owner, heartbeat, data, expires_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT(id) DO UPDATE SET"
+                "  status = CASE WHEN jobs.status = 'cancelled' THEN jobs.status ELSE excluded.status END,"
+                "  owner = COALESCE(excluded.owner, jobs.owner),"
+                "  heartbeat = excluded.heartbeat, data = excluded.data, version = jobs.version + 1,"
+                # The retention clock starts once, when the job first finishes
+                "  expires_at = CASE WHEN jobs.status = 'cancelled' OR excluded.expires_at IS NOT NULL"
+                "   THEN COALESCE(jobs.expires_at, excluded.expires_at) END"
+                " WHERE jobs.owner IS NULL OR excluded.owner IS NULL OR jobs.owner = excluded.owner",
+                (job['id'], job['status'], job.get('uploaded_at'), owner, time.time(),
+                 json.dumps(job, default=str), job_expiry(job))
+            )
+
+    def get_job(self, job_id):
+        with self._lock:
+            row = self._conn.execute("SELECT status, data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._load(*row) if row else None
+
+    def query_jobs(self, statuses=None, since=None, until=None, before=None, limit=50):
+        where, params = [], []
+        if since:
+            where.append("uploaded_at >= ?")
+            params.append(since)
+        if until:
+            where.append("uploaded_at < ?")
+            params.append(until)
+        if before:
+            where.append("(uploaded_at < ? OR (uploaded_at = ? AND id < ?))")
+            params += [before[0], before[0], before[1]]
+        # One index range scan per status, merged here, so no query sorts the whole history
+        pages = []
+        with self._lock:
+            for status in statuses or [None]:
+                clauses = where + (["status = ?"] if status else [])
+                sql = ("SELECT id, uploaded_at, version, status, data FROM jobs" + (" WHERE " + " AND ".join(clauses) if clauses else "")
+                       + " ORDER BY uploaded_at DESC, id DESC LIMIT ?")
+                pages += self._conn.execute(sql, params + ([status] if status else []) + [limit]).fetchall()
+        pages.sort(key=lambda row: (row[1] or '', row[0]), reverse=True)
+        return [(row[0], row[1], row[2], self._load(row[3], row[4])) for row in pages[:limit]]
+
+    def count_jobs(self, statuses):
+        placeholders = ",".join("?" * len(statuses))
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM jobs WHERE status IN ({placeholders})",
+                                      tuple(statuses)).fetchone()[0]
+
+    def job_version(self, job_id):
+        with self._lock:
+            row = self._conn.execute("SELECT version FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def set_status(self, job_id, status, message=None):
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return False
+            job = json.loads(row[0])
+            job['status'] = status
+            if message:
+                job['message'] = message
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, data = ?, expires_at = COALESCE(expires_at, ?), version = version + 1"
+                " WHERE id = ?",
+                (status, json.dumps(job, default=str), job_expiry(job), job_id)
+            )
+            return True
+
+    def record_rows(self, job_id, rows):
+        if not rows:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO job_rows (job_id, idx, status) VALUES (?, ?, ?)",
+                [(job_id, int(idx), status) for idx, status in rows]
+            )
+            self._conn.execute("COMMIT")
+
+    def completed_rows(self, job_id):
+        # Page through by idx so millions of rows never sit in memory at once
+        last_idx = -1
+        while True:
+            with self._lock:
+                page = self._conn.execute(
+                    "SELECT idx, status FROM job_rows WHERE job_id = ? AND idx > ? ORDER BY idx LIMIT 10000",
+                    (job_id, last_idx)
+                ).fetchall()
+            if not page:
+                return
+            yield from page
+            last_idx = page[-1][0]
+
+    def heartbeat(self, job_ids, owner):
+        if not job_ids:
+            return
+        with self._lock:
+            self._conn.executemany("UPDATE jobs SET heartbeat = ? WHERE id = ? AND owner = ?",
+                                   [(time.time(), job_id, owner) for job_id in job_ids])
+
+    def active_jobs(self):
+        placeholders = ",".join("?" * len(ACTIVE_JOB_STATUSES))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT status, data, owner, heartbeat FROM jobs WHERE status IN ({placeholders})"
+                " ORDER BY uploaded_at, id",
+                ACTIVE_JOB_STATUSES
+            ).fetchall()
+        return [(self._load(status, data), owner, heartbeat) for status, data, owner, heartbeat in rows]
+
+    def queue_position(self, job_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*) FROM jobs AS q, jobs AS j WHERE j.id = ? AND j.status = 'queued'"
+                " AND q.status = 'queued' AND (q.uploaded_at < j.uploaded_at"
+                "  OR (q.uploaded_at = j.uploaded_at AND q.id <= j.id))",
+                (job_id,)
+            ).fetchone()
+        return row[0] or None
+
+    def claim_job(self, job_id, owner, expected_owner):
+        with self._lock:
+            cur = self._conn.execute(
+                "UPDATE jobs SET owner = ?, heartbeat = ? WHERE id = ? AND owner IS ?",
+                (owner, time.time(), job_id, expected_owner)
+            )
+            return cur.rowcount == 1
+
+    def add_artifacts(self, job_id, artifacts):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO job_artifacts (job_id, path, kind) VALUES (?, ?, ?)",
+                [(job_id, path, kind) for path, kind in artifacts]
+            )
+
+    def job_artifacts(self, job_id):
+        with self._lock:
+            return self._conn.execute("SELECT path, kind FROM job_artifacts WHERE job_id = ?",
+                                      (job_id,)).fetchall()
+
+    def expired_jobs(self, now, limit):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, heartbeat FROM jobs WHERE expires_at IS NOT NULL AND expires_at <= ?"
+                " ORDER BY expires_at LIMIT ?",
+                (now, limit)
+            ).fetchall()
+
+    def delete_job(self, job_id):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            for table, column in (('job_rows', 'job_id'), ('job_artifacts', 'job_id'),
+                                  ('job_shards', 'job_id'), ('jobs', 'id')):
+                self._conn.execute(f"DELETE FROM {table} WHERE {column} = ?", (job_id,))
+            self._conn.execute("COMMIT")
+
+    def add_shard(self, job_id, shard, first_idx, last_idx, rows, path):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO job_shards (job_id, shard, first_idx, last_idx, rows, path, status)"
+                " VALUES (?, ?, ?, ?, ?, ?, 'pending')",
+                (job_id, shard, int(first_idx), int(last_idx), rows, path)
+            )
+
+    def lease_shard(self, worker, lease_seconds):
+        now = time.time()
+        with self._lock:
+            # IMMEDIATE takes the write lock up front: two gunicorn workers can't hand out the same shard
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT s.job_id, s.shard, s.rows, s.attempts FROM job_shards s JOIN jobs j ON j.id = s.job_id"
+                    " WHERE j.status = 'processing'"
+                    "  AND (s.status = 'pending' OR (s.status = 'leased' AND s.lease_until < ?))"
+                    " ORDER BY j.uploaded_at, s.shard LIMIT 1",
+                    (now,)
+                ).fetchone()
+                if row is None:
+                    return None
+                job_id, shard, rows, attempts = row
+                lease_id = uuid.uuid4().hex
+                self._conn.execute(
+                    "UPDATE job_shards SET status = 'leased', lease_id = ?, worker = ?, lease_until = ?,"
+                    " attempts = attempts + 1, progress = 0 WHERE job_id = ? AND shard = ?",
+                    (lease_id, worker, now + lease_seconds, job_id, shard)
+                )
+            finally:
+                self._conn.execute("COMMIT")
+        return {'job_id': job_id, 'shard': shard, 'rows': rows, 'lease_id': lease_id, 'attempt': attempts + 1}
+
+    def get_shard(self, job_id, shard):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT s.rows, s.path, s.status, s.lease_id, s.worker, s.lease_until, j.status"
+                " FROM job_shards s JOIN jobs j ON j.id = s.job_id WHERE s.job_id = ? AND s.shard = ?",
+                (job_id, shard)
+            ).fetchone()
+        if row is None:
+            return None
+        keys = ('rows', 'path', 'status', 'lease_id', 'worker', 'lease_until', 'job_status')
+        return dict(zip(keys, row))
+
+    def renew_shard(self, job_id, shard, lease_id, progress, lease_seconds):
+        with self._lock:
+            cur = self._conn.execute(
+                "UPDATE job_shards SET lease_until = ?, progress = ?"
+                " WHERE job_id = ? AND shard = ? AND lease_id = ? AND status = 'leased'"
+                "  AND (SELECT status FROM jobs WHERE id = ?) = 'processing'",
+                (time.time() + lease_seconds, int(progress), job_id, shard, lease_id, job_id)
+            )
+            return cur.rowcount == 1
+
+    def complete_shard(self, job_id, shard, lease_id, result):
+        with self._lock:
+            cur = self._conn.execute(
+                "UPDATE job_shards SET status = 'done', result = ?, progress = rows, lease_until = NULL"
+                " WHERE job_id = ? AND shard = ? AND lease_id = ? AND status = 'leased'",
+                (result, job_id, shard, lease_id)
+            )
+            return cur.rowcount == 1
+
+    def take_finished_shards(self, job_id):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            rows = self._conn.execute(
+                "SELECT shard, worker, result FROM job_shards WHERE job_id = ? AND status = 'done' ORDER BY shard",
+                (job_id,)
+            ).fetchall()
+            # The result is copied into job_rows by the caller, so drop the JSON here
+            self._conn.executemany(
+                "UPDATE job_shards SET status = 'merged', result = NULL WHERE job_id = ? AND shard = ?",
+                [(job_id, shard) for shard, _, _ in rows]
+            )
+            self._conn.execute("COMMIT")
+        return rows
+
+    def shard_summary(self, job_id):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, COUNT(*), SUM(rows - progress), SUM(attempts) FROM job_shards"
+                " WHERE job_id = ? GROUP BY status",
+                (job_id,)
+            ).fetchall()
+        by_status = {status: count for status, count, _, _ in rows}
+        attempts = sum(n or 0 for _, _, _, n in rows)
+        started = sum(count for status, count, _, _ in rows if status != 'pending')
+        return {
+            'by_status': by_status,
+            'in_flight_rows': sum(left or 0 for status, _, left, _ in rows if status == 'leased'),
+            'releases': max(0, attempts - started)  # Shards handed out again after a worker vanished
+        }
+
+    def delete_shards(self, job_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM job_shards WHERE job_id = ?", (job_id,))
+
+job_store = SQLiteJobStore()
+
+def persist_job(job_id):
+    """Write this process's live view of a job to the durable store"""
+    with jobs_lock:
+        job = jobs.get(job_id)
+        job = dict(job) if job else None
+    if job:
+        job_store.save_job(job, owner=WORKER_ID)
+        job_events.notify(job_id)
+
+def get_job_record(job_id):
+    """Live job from this process, else the durable copy (another worker / finished)"""
+    with jobs_lock:
+        if job_id in jobs:
+            return jobs[job_id].copy()
+    return job_store.get_job(job_id)
+
+# ==========================================
+# ========== NO FACE ZIP STREAMING =========
+# ==========================================
+
+ZIP_READ_CHUNK = 1024 * 1024
+
+class ZipStreamSink:
+    """Write-only, non-seekable file zipfile writes into; the generator drains it.
+
+    zipfile notices there is no tell()/seek() and falls back to data
+    descriptors, so entries never need to be rewritten in place.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def list_noface_images(job_folder):
+    """Saved NO FACE images in save order, so offsets stay stable as the job adds more"""
+    try:
+        with open(os.path.join(job_folder, NOFACE_MANIFEST_NAME), encoding='utf-8') as f:
+            names = f.read().splitlines()
+    except FileNotFoundError:
+        return scan_noface_images(job_folder)
+    # A row saved again (e.g. redone after a restart) keeps its first position
+    seen = set()
+    paths = []
+    for name in names:
+        if name and name not in seen:
+            seen.add(name)
+            paths.append(os.path.join(job_folder, name))
+    return paths
+
+def scan_noface_images(job_folder):
+    """Folders written before the manifest existed: oldest file first"""
+    entries = []
+    with os.scandir(job_folder) as it:
+        for entry in it:
+            if (entry.is_file() and not entry.name.endswith(NOFACE_PARTIAL_SUFFIX)
+                    and entry.name != NOFACE_MANIFEST_NAME):
+                entries.append((entry.stat().st_mtime_ns, entry.name, entry.path))
+    entries.sort()
+    return [path for _, _, path in entries]
+
+def stream_zip(paths):
+    """Yield a ZIP of `paths` chunk by chunk (STORED, JPEGs don't compress)"""
+    sink = ZipStreamSink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for path in paths:
+            try:
+                f = open(path, 'rb')
+            except FileNotFoundError:
+                continue  # Removed by cleanup while we were streaming
+            with f:
+                zinfo = zipfile.ZipInfo.from_file(path, os.path.basename(path))
+                zinfo.compress_type = zipfile.ZIP_STORED
+                with zf.open(zinfo, 'w') as entry:
+                    while True:
+                        chunk = f.read(ZIP_READ_CHUNK)
+                        if not chunk:
+                            break
+                        entry.write(chunk)
+                        yield sink.drain()
+            data = sink.drain()
+            if data:
+                yield data
+    # Central directory is written when the archive closes
+    yield sink.drain()
+
+# ==========================================
+# ========== JOB PROGRESS EVENTS ===========
+# ==========================================
+
+class JobEvents:
+    """Per-job version counters that SSE / long-poll clients block on.
+
+    Job threads bump a job's version after they publish new counters;
+    readers wait on the condition instead of re-reading the job every
+    couple of seconds.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._versions = {}
+
+    def notify(self, job_id):
+        with self._cond:
+            self._versions[job_id] = self._versions.get(job_id, 0) + 1
+            self._cond.notify_all()
+
+    def version(self, job_id):
+        with self._cond:
+            return self._versions.get(job_id, 0)
+
+    def wait(self, job_id, since, timeout):
+        """Block until the job's version moves past `since` (or timeout), return it"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._versions.get(job_id, 0) <= since:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return self._versions.get(job_id, 0)
+
+    def forget(self, job_id):
+        with self._cond:
+            self._versions.pop(job_id, None)
+
+job_events = JobEvents()
+event_stream_slots = threading.BoundedSemaphore(EVENTS_MAX_STREAMS)
+
+def job_status_payload(job_id):
+    """Status dict served to the UI (None if the job is unknown)"""
+    job_data = get_job_record(job_id)
+    if job_data is None:
+        return None
+
+    if job_data.get('status') == 'queued':
+        job_data['queue_position'] = job_scheduler.queue_position(job_id)
+
+    # Calculate progress percentage
+    if job_data.get('rows_to_process', 0) > 0:
+        job_data['progress'] = (job_data['processed'] / job_data['rows_to_process']) * 100
+    else:
+        job_data['progress'] = 0
+    return job_data
+
+def job_local_version(job_id):
+    """(WORKER_ID, event version) if the job runs in this process, else None"""
+    with jobs_lock:
+        if job_id not in jobs:
+            return None
+    return WORKER_ID, job_events.version(job_id)
+
+def make_etag(*parts):
+    return hashlib.sha1(json.dumps(parts, default=str).encode()).hexdigest()[:24]
+
+def job_status_etag(job_id):
+    """ETag of job_status_payload(job_id), None if the job is unknown.
+
+    A job running here changes with its event version (every published
+    update); any other job only when its stored copy is rewritten.
+    """
+    version = job_local_version(job_id)
+    if version is None:
+        version = job_store.job_version(job_id)
+        if version is None:
+            return None
+    return make_etag(job_id, version, job_scheduler.queue_position(job_id))
+
+def jobs_page_etag(rows, view, active_count):
+    """ETag of a /api/jobs page from its (id, uploaded_at, version, ...) rows"""
+    versions = [(row[0], job_local_version(row[0]) or row[2]) for row in rows]
+    return make_etag(view, active_count, versions)
+
+def validated_response(response, tag):
+    """Attach the ETag; clients must revalidate (If-None-Match) before reusing it"""
+    response.set_etag(tag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def encode_jobs_cursor(uploaded_at, job_id):
+    return base64.urlsafe_b64encode(json.dumps([uploaded_at, job_id]).encode()).decode()
+
+def decode_jobs_cursor(cursor):
+    try:
+        uploaded_at, job_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError) as e:
+        raise ValueError(cursor) from e
+    return str(uploaded_at), str(job_id)
+
+def parse_iso_arg(name):
+    """?name= as a normalized ISO timestamp (comparable with uploaded_at), or None"""
+    value = request.args.get(name)
+    return datetime.fromisoformat(value).isoformat() if value else None
+
+def job_event_stream(job_id, max_per_second):
+    """SSE generator: full status first, then only the fields that changed"""
+    min_interval = 1.0 / max_per_second
+    version = job_events.version(job_id)
+    last = job_status_payload(job_id) or {}
+    yield f"id: {version}\nevent: status\ndata: {json.dumps(last, default=str)}\n\n"
+
+    last_sent = time.monotonic()
+    while last.get('status') not in TERMINAL_JOB_STATUSES:
+        with jobs_lock:
+            local = job_id in jobs
+        wait = EVENTS_KEEPALIVE_SECONDS if local else REMOTE_JOB_POLL_SECONDS
+        new_version = job_events.wait(job_id, version, wait)
+        if new_version == version and local:
+            yield ": keepalive\n\n"
+            continue
+
+        # Coalesce: everything that changed during the interval goes out as one delta
+        pause = min_interval - (time.monotonic() - last_sent)
+        if pause > 0:
+            time.sleep(pause)
+        version = job_events.version(job_id)
+        current = job_status_payload(job_id)
+        if current is None:
+            yield "event: gone\ndata: {}\n\n"
+            return
+        delta = {k: v for k, v in current.items() if last.get(k) != v}
+        last = current
+        if delta:
+            yield f"id: {version}\nevent: progress\ndata: {json.dumps(delta, default=str)}\n\n"
+            last_sent = time.monotonic()
+        elif not local:
+            yield ": keepalive\n\n"
+
+# ==========================================
+# ========== CSV INPUT / OUTPUT ============
+# ==========================================
+
+def detect_image_column(columns):
+    """=== SMART COLUMN DETECTION === (None if nothing looks like an image URL)"""
+    # Priority list of exact names (case-insensitive search)
+    priority_names = ['Check-In Photo', 'CheckInPhoto', 'Photo', 'Image', 'Url', 'Link']
+
+    # 1. Exact match (Case Insensitive)
+    col_map = {c.lower(): c for c in columns}
+    for name in priority_names:
+        if name.lower() in col_map:
+            return col_map[name.lower()]
+
+    # 2. Substring match (e.g. "User Photo Url")
+    for col in columns:
+        lower_col = col.lower()
+        if 'photo' in lower_col or 'image' in lower_col or 'url' in lower_col:
+            return col
+
+    return None
+
+def normalize_face_status(df):
+    """Ensure Face_Status exists as clean strings (missing / NaN -> PENDING)"""
+    if 'Face_Status' not in df.columns:
+        df['Face_Status'] = 'PENDING' # Use concrete value instead of empty string
+
+    # Ensure it is string and handle NaNs/nans
+    df["Face_Status"] = df["Face_Status"].fillna('PENDING').astype(str)
+    df["Face_Status"] = df["Face_Status"].replace(['nan', 'NaN', 'None', ''], 'PENDING', regex=False)
+    return df
 
-UPLOAD_FOLDER = os.path.join(DATA_DIR, 'uploads')
-RESULTS_FOLDER = os.path.join(DATA_DIR, 'results')
-NO_FACE_FOLDER = os.path.join(DATA_DIR, 'no_face_images')
-MODEL_FOLDER = os.path.join(BASE_DIR, 'Model') # Model stays in root
-MAX_FILE_AGE_HOURS = 24  # Files older than this will be deleted
+def pending_row_indices(df):
+    """Rows to process (PENDING, blank, or a previous download error)"""
+    status = df["Face_Status"]
+    return df[
+        (status == 'PENDING') |
+        (status.str.strip() == '') |
+        (status == 'DOWNLOAD_ERROR')
+    ].index.tolist()
 
-# Create directories (and the parent DATA_DIR implicitly)
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-os.makedirs(RESULTS_FOLDER, exist_ok=True)
-os.makedirs(NO_FACE_FOLDER, exist_ok=True)
+def detect_csv_encoding(path):
+    """utf-8 if the whole file decodes cleanly, else latin1 (streamed, no full read)"""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                decoder.decode(block)
+            decoder.decode(b'', final=True)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'latin1'
 
-# Processing configuration (DEFAULTS)
-DEFAULT_DOWNLOAD_TIMEOUT = 20
-DEFAULT_MEDIAPIPE_CONF_THRESH = 0.80
-DEFAULT_DNN_CONF_THRESH = 0.70
-DEFAULT_NUM_THREADS = 6
-DEFAULT_BATCH_SIZE = 50
+class InMemoryCsvTable:
+    """Whole CSV held as a DataFrame; each checkpoint rewrites the result file"""
 
-# Global job storage (in production, use Redis or database)
-jobs = {}
-jobs_lock = threading.Lock()
+    def __init__(self, csv_path, result_path):
+        self.result_path = result_path
+        try:
+            self.df = pd.read_csv(csv_path, encoding='utf-8')
+        except UnicodeDecodeError:
+            self.df = pd.read_csv(csv_path, encoding='latin1')
+        self.columns = self.df.columns.tolist()
+        self._pending = []
 
-# ==========================================
-# ========== AUTO-CLEANUP SYSTEM ===========
-# ==========================================
+    def prepare(self):
+        """Normalize Face_Status, returns (total_rows, rows_to_process)"""
+        normalize_face_status(self.df)
+        self._pending = pending_row_indices(self.df)
+        return len(self.df), len(self._pending)
 
-def cleanup_old_files():
-    """Delete files older than MAX_FILE_AGE_HOURS"""
-    now = time.time()
-    cutoff = now - (MAX_FILE_AGE_HOURS * 3600)
-    
-    print(f"[{datetime.now().isoformat()}] Running auto-cleanup...")
-    
-    deleted_count = 0
-    
-    # Folders to clean
-    folders = [UPLOAD_FOLDER, RESULTS_FOLDER, NO_FACE_FOLDER]
-    
-    for folder in folders:
-        if not os.path.exists(folder):
-            continue
-            
-        for root, dirs, files in os.walk(folder, topdown=False):
-            for name in files:
-                filepath = os.path.join(root, name)
-                try:
-                    if os.path.getmtime(filepath) < cutoff:
-                        os.remove(filepath)
-                        deleted_count += 1
-                except Exception as e:
-                    print(f"Error deleting file {filepath}: {e}")
-            
-            # Clean empty directories
-            for name in dirs:
-                dirpath = os.path.join(root, name)
-                try:
-                    # If directory empty (and not one of the main folders), delete it
-                    if not os.listdir(dirpath) and dirpath not in folders:
-                        os.rmdir(dirpath)
-                except Exception as e:
-                    print(f"Error removing dir {dirpath}: {e}")
+    def apply_completed(self, rows):
+        """Restore rows finished before a restart, returns counts by status"""
+        counts = {}
+        done = {}
+        for idx, status in rows:
+            done[idx] = status
+            counts[status] = counts.get(status, 0) + 1
+        if done:
+            self.df.loc[list(done.keys()), "Face_Status"] = list(done.values())
+            self._pending = [idx for idx in self._pending if idx not in done]
+        return counts
 
-    if deleted_count > 0:
-        print(f"[{datetime.now().isoformat()}] Cleanup complete. Deleted {deleted_count} old files.")
+    def iter_tasks(self, image_col):
+        return iter_row_tasks(self.df, self._pending, image_col)
 
-# Initialize Scheduler
-scheduler = BackgroundScheduler()
-scheduler.add_job(func=cleanup_old_files, trigger="interval", hours=1)
-scheduler.start()
+    def record(self, idx, status):
+        self.df.at[idx, "Face_Status"] = status
 
-# Ensure scheduler shuts down when app exits
-import atexit
-atexit.register(lambda: scheduler.shutdown())
+    def checkpoint(self):
+        self.df.to_csv(self.result_path, index=False)
 
-# ==========================================
-# ========== INITIALIZE MODELS =============
-# ==========================================
-mp_face_detection = mp.solutions.face_detection
+    def finalize(self):
+        self.checkpoint()
 
-prototxt_path = os.path.join(MODEL_FOLDER, "deploy.prototxt.txt")
-model_path = os.path.join(MODEL_FOLDER, "res10_300x300_ssd_iter_140000.caffemodel")
-net = cv2.dnn.readNetFromCaffe(prototxt_path, model_path)
+class StreamingCsvTable:
+    """Chunked CSV reader with an append-only status sidecar.
 
-# ==========================================
-# ========== FACE DETECTION LOGIC ==========
-# ==========================================
+    Memory stays flat in the file size: rows are read STREAM_CHUNK_ROWS at a
+    time as the pipeline pulls tasks, finished statuses are appended to the
+    sidecar at each checkpoint (O(batch) I/O), and the result CSV is written
+    once at the end by streaming the input again and overlaying the statuses.
+    """
 
-def download_image(url, timeout=DEFAULT_DOWNLOAD_TIMEOUT):
-    """Download image from URL"""
-    try:
-        response = requests.get(url, timeout=timeout)
-        response.raise_for_status()
-        img_array = np.asarray(bytearray(response.content), dtype=np.uint8)
-        return cv2.imdecode(img_array, cv2.IMREAD_COLOR)
-    except:
-        return None
+    def __init__(self, csv_path, result_path, status_path):
+        self.csv_path = csv_path
+        self.result_path = result_path
+        self.status_path = status_path
+        self.encoding = detect_csv_encoding(csv_path)
+        self.columns = pd.read_csv(csv_path, encoding=self.encoding, nrows=0).columns.tolist()
+        self.total_rows = 0
+        self._batch = []
+        self._done = None
 
-def detect_with_dnn(image, threshold=DEFAULT_DNN_CONF_THRESH):
-    """Detect face using OpenCV DNN"""
-    (h, w) = image.shape[:2]
-    blob = cv2.dnn.blobFromImage(cv2.resize(image, (300, 300)), 1.0,
-                                 (300, 300), (104.0, 177.0, 123.0))
-    net.setInput(blob)
-    detections = net.forward()
-    return np.max(detections[0, 0, :, 2]) > threshold
+    def _chunks(self, **kwargs):
+        return pd.read_csv(self.csv_path, encoding=self.encoding,
+                           chunksize=STREAM_CHUNK_ROWS, **kwargs)
 
-def process_row(row, job_id, config, image_col='Check-In Photo'):
-    """Process a single row for face detection"""
-    img_url = row.get(image_col)
-    id_val = row.get("id", row.name)
-    
-    # Extract config
-    timeout = config.get('download_timeout', DEFAULT_DOWNLOAD_TIMEOUT)
-    mp_thresh = config.get('mediapipe_thresh', DEFAULT_MEDIAPIPE_CONF_THRESH)
-    dnn_thresh = config.get('dnn_thresh', DEFAULT_DNN_CONF_THRESH)
-    save_images = config.get('save_images', True)
+    def prepare(self):
+        """Count rows with a single-column pass, returns (total_rows, rows_to_process)"""
+        total = pending = 0
+        has_status = 'Face_Status' in self.columns
+        for chunk in self._chunks(usecols=['Face_Status'] if has_status else [0]):
+            total += len(chunk)
+            pending += len(pending_row_indices(normalize_face_status(chunk))) if has_status else len(chunk)
+        self.total_rows = total
+        return total, pending
 
-    if pd.isna(img_url) or str(img_url).strip() == "":
-        return row.name, "Skipped (empty URL)", ""
+    def apply_completed(self, rows):
+        """Skip rows finished before a restart (1 byte per row), returns counts by status"""
+        counts = {}
+        self._done = np.zeros(self.total_rows, dtype=bool)
+        for idx, status in rows:
+            self._done[idx] = True
+            counts[status] = counts.get(status, 0) + 1
+            # Re-append so the sidecar is complete even if it lagged the store
+            self._batch.append((idx, status))
+            if len(self._batch) >= STREAM_CHUNK_ROWS:
+                self.checkpoint()
+        self.checkpoint()
+        return counts
 
-    image = download_image(str(img_url), timeout)
+    def iter_tasks(self, image_col):
+        # Chunk indexes continue across chunks, so idx stays the global row number
+        usecols = [image_col] + [c for c in ('id', 'Face_Status') if c in self.columns and c != image_col]
+        for chunk in self._chunks(usecols=usecols):
+            normalize_face_status(chunk)
+            indices = pending_row_indices(chunk)
+            if self._done is not None:
+                indices = [idx for idx in indices if not self._done[idx]]
+            yield from iter_row_tasks(chunk, indices, image_col)
 
-    if image is None:
-        return row.name, "DOWNLOAD_ERROR", "Image could not be downloaded"
+    def record(self, idx, status):
+        self._batch.append((idx, status))
 
-    image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    
-    # MediaPipe detection (Primary)
-    with mp_face_detection.FaceDetection(min_detection_confidence=mp_thresh) as face_detector:
-        results = face_detector.process(image_rgb)
-        face_found = results.detections is not None and len(results.detections) > 0
+    def checkpoint(self):
+        if not self._batch:
+            return
+        with open(self.status_path, 'a', newline='', encoding='utf-8') as f:
+            csv.writer(f).writerows(self._batch)
+        self._batch = []
 
-    # Fallback to DNN if MediaPipe fails
-    if not face_found:
-        face_found = detect_with_dnn(image, dnn_thresh)
+    def _load_status_codes(self):
+        # 2 bytes per row: code 0 keeps the input's own Face_Status
+        codes = np.zeros(self.total_rows, dtype=np.int16)
+        labels = [None]
+        lookup = {}
+        if os.path.exists(self.status_path):
+            for chunk in pd.read_csv(self.status_path, names=['idx', 'status'], header=None,
+                                     dtype={'idx': np.int64, 'status': str}, keep_default_na=False,
+                                     chunksize=STREAM_CHUNK_ROWS * 10):
+                for status in chunk['status'].unique():
+                    if status not in lookup:
+                        lookup[status] = len(labels)
+                        labels.append(status)
+                codes[chunk['idx'].values] = chunk['status'].map(lookup).values
+        return codes, np.array(labels, dtype=object)
 
-    if face_found:
-        return row.name, "GOOD", ""
-    else:
-        # Save NO FACE image only if requested
-        if save_images:
-            job_folder = os.path.join(NO_FACE_FOLDER, job_id)
-            os.makedirs(job_folder, exist_ok=True)
-            save_path = os.path.join(job_folder, f"{id_val}_NOFACE.jpg")
-            cv2.imwrite(save_path, image)
-            return row.name, "NO FACE", f"Saved: {save_path}"
-        else:
-            return row.name, "NO FACE", "Image not saved (Config)"
+    def finalize(self):
+        """Merge input + sidecar into the result CSV (atomic replace)"""
+        self.checkpoint()
+        codes, labels = self._load_status_codes()
+
+        tmp_path = self.result_path + '.tmp'
+        first = True
+        for chunk in self._chunks():
+            normalize_face_status(chunk)
+            chunk_codes = codes[chunk.index.values]
+            mask = chunk_codes > 0
+            if mask.any():
+                chunk.loc[mask, 'Face_Status'] = labels[chunk_codes[mask]]
+            chunk.to_csv(tmp_path, mode='w' if first else 'a', header=first, index=False)
+            first = False
+
+        if first:
+            # Header-only input
+            columns = self.columns + ([] if 'Face_Status' in self.columns else ['Face_Status'])
+            pd.DataFrame(columns=columns).to_csv(tmp_path, index=False)
+        os.replace(tmp_path, self.result_path)
 
 def process_csv_job(job_id, csv_path, original_filename, config):
     """Background job to process CSV file"""
@@ -212,155 +3111,563 @@ def process_csv_job(job_id, csv_path, original_filename, config):
         # Self-healing: Ensure results folder exists
         os.makedirs(RESULTS_FOLDER, exist_ok=True)
         
+        # Cancelled while waiting in the queue (maybe from another process)
+        stored = job_store.get_job(job_id)
         with jobs_lock:
+            if stored and stored['status'] == 'cancelled':
+                jobs[job_id]['status'] = 'cancelled'
+            if jobs[job_id]['status'] == 'cancelled':
+                return
             jobs[job_id]['status'] = 'processing'
-            jobs[job_id]['started_at'] = datetime.now().isoformat()
+            jobs[job_id].setdefault('started_at', datetime.now().isoformat())
+        persist_job(job_id)
         
-        # Load CSV
-        try:
-            df = pd.read_csv(csv_path, encoding='utf-8')
-        except UnicodeDecodeError:
-             df = pd.read_csv(csv_path, encoding='latin1')
+        # Load CSV (streaming mode keeps only a chunk in memory)
+        result_path = os.path.join(RESULTS_FOLDER, f"{job_id}_results.csv")
+        status_path = os.path.join(RESULTS_FOLDER, f"{job_id}_status.csv")
+        job_store.add_artifacts(job_id, [
+            (result_path, 'file'), (result_path + '.tmp', 'file'), (status_path, 'file'),
+            (os.path.join(NO_FACE_FOLDER, job_id), 'dir')
+        ])
+        if config.get('streaming'):
+            table = StreamingCsvTable(csv_path, result_path, status_path)
+        else:
+            table = InMemoryCsvTable(csv_path, result_path)
 
-        # === SMART COLUMN DETECTION ===
-        # Priority list of exact names (case-insensitive search)
-        priority_names = ['Check-In Photo', 'CheckInPhoto', 'Photo', 'Image', 'Url', 'Link']
-        image_col = None
-        
-        # 1. Exact match (Case Insensitive)
-        col_map = {c.lower(): c for c in df.columns}
-        for name in priority_names:
-            if name.lower() in col_map:
-                image_col = col_map[name.lower()]
-                break
-        
-        # 2. Substring match (e.g. "User Photo Url")
-        if not image_col:
-            for col in df.columns:
-                lower_col = col.lower()
-                if 'photo' in lower_col or 'image' in lower_col or 'url' in lower_col:
-                    image_col = col
-                    break
-        
-        # 3. Fallback (Fail if not found)
+        image_col = detect_image_column(table.columns)
         if not image_col:
             with jobs_lock:
                 jobs[job_id]['status'] = 'failed'
                 jobs[job_id]['error'] = 'Could not find an image column (e.g. "Check-In Photo")'
+            persist_job(job_id)
             return
 
         print(f"Job {job_id}: Auto-detected image column: '{image_col}'")
 
-        total_rows = len(df)
-        
-        # Initialize Face_Status if missing
-        if 'Face_Status' not in df.columns:
+        if 'Face_Status' not in table.columns:
             print(f"Job {job_id}: 'Face_Status' column MISSING. Creating it...")
-            df['Face_Status'] = 'PENDING' # Use concrete value instead of empty string
         else:
             print(f"Job {job_id}: 'Face_Status' column FOUND.")
         
         # DEBUG: Print columns to verify
-        print(f"DEBUG {job_id} Columns: {df.columns.tolist()}")
+        print(f"DEBUG {job_id} Columns: {table.columns}")
 
-        # Ensure it is string and handle NaNs/nans
-        df["Face_Status"] = df["Face_Status"].fillna('PENDING').astype(str)
-        df["Face_Status"] = df["Face_Status"].replace(['nan', 'NaN', 'None', ''], 'PENDING', regex=False)
-        
-        # Identify rows to process (PENDING, Failed, or Error)
-        rows_to_process = df[
-            (df["Face_Status"] == 'PENDING') | 
-            (df["Face_Status"].str.strip() == '') |
-            (df["Face_Status"] == 'DOWNLOAD_ERROR')
-        ]
-        
-        processing_indices = rows_to_process.index.tolist()
-        processing_count = len(processing_indices)
+        total_rows, processing_count = table.prepare()
+
+        # Rows finished before a restart are restored, not redone
+        restored = table.apply_completed(job_store.completed_rows(job_id))
+        already_done = sum(restored.values())
+        if already_done:
+            print(f"Job {job_id}: Resuming, {already_done} rows already done.")
         
         with jobs_lock:
             jobs[job_id]['total_rows'] = total_rows
             jobs[job_id]['rows_to_process'] = processing_count
-            jobs[job_id]['processed'] = 0
+            jobs[job_id]['processed'] = already_done
+            error_reasons = dict(jobs[job_id].get('download_errors_by_reason', {})) if already_done else {}
+            cache_stats = {
+                'hits': jobs[job_id].get('cache_hits', 0) if already_done else 0,
+                'misses': jobs[job_id].get('cache_misses', 0) if already_done else 0
+            }
+            dedup_restored = jobs[job_id].get('dedup_rows', 0) if already_done else 0
+        persist_job(job_id)
         
-        if processing_count == 0:
+        if processing_count == already_done:
+            table.finalize()
             with jobs_lock:
                 jobs[job_id]['status'] = 'completed'
+                jobs[job_id]['result_file'] = result_path
+                jobs[job_id]['completed_at'] = datetime.now().isoformat()
                 jobs[job_id]['message'] = 'All rows already processed'
+            persist_job(job_id)
             return
         
         # Counters
-        good_count = 0
-        noface_count = 0
-        download_err_count = 0
-        
-        # Process with threading
-        num_threads = config.get('num_threads', DEFAULT_NUM_THREADS)
+        good_count = restored.get("GOOD", 0)
+        noface_count = sum(n for status, n in restored.items() if is_noface_status(status))
+        prefilter_counts = {status: n for status, n in restored.items() if status in PREFILTER_STATUSES.values()}
+        download_err_count = restored.get("DOWNLOAD_ERROR", 0)
+        batch_size = config.get('batch_size', DEFAULT_BATCH_SIZE)
+        finished_rows = []  # Flushed to the job store at each checkpoint
+        processed = already_done
+        last_checkpoint = already_done
+        last_flush = 0.0
+        # Rows run here, or are handed out in shards to shard_worker.py processes / nodes
+        runner = JobRowRunner(job_id, config, cache_stats)
+
+        def publish_progress():
+            # Counters live in locals; the shared job dict only sees coalesced updates
+            with jobs_lock:
+                jobs[job_id].update({
+                    'processed': processed,
+                    'good_count': good_count,
+                    'noface_count': noface_count,
+                    'download_error_count': download_err_count,
+                    'download_errors_by_reason': dict(error_reasons),
+                    'cache_hits': cache_stats['hits'],
+                    'cache_misses': cache_stats['misses'],
+                    'dedup_rows': dedup_restored + runner.dedup_rows,
+                    'prefilter_counts': dict(prefilter_counts),
+                    'artifacts': artifact_writer.job_stats(job_id),
+                    'pipeline': runner.snapshot(),
+                    'timings': stage_metrics.job_breakdown(job_id)
+                })
+            job_events.notify(job_id)
+
+        def checkpoint():
+            with stage_metrics.timed('checkpoint', job_id):
+                table.checkpoint()
+                job_store.record_rows(job_id, finished_rows)
+                finished_rows.clear()
+            publish_progress()
+            persist_job(job_id)
         
-        with ThreadPoolExecutor(max_workers=num_threads) as executor:
-            future_to_idx = {
-                executor.submit(process_row, row, job_id, config, image_col): original_idx
-                for original_idx, row in df.loc[processing_indices].iterrows()
-            }
-            
-            for future in as_completed(future_to_idx):
-                # CHECK CANCELLATION
-                if jobs[job_id].get('status') == 'cancelled':
-                    print(f"Job {job_id} cancelled by user. Terminating threads...")
-                    executor.shutdown(wait=False, cancel_futures=True)
-                    # Save partial results so far
-                    result_path = os.path.join(RESULTS_FOLDER, f"{job_id}_results.csv")
-                    df.to_csv(result_path, index=False)
-                    return
+        # Process through the download -> decode -> inference pipeline
+        runner.start(table.iter_tasks(image_col))
 
-                original_idx = future_to_idx[future]
-                
-                try:
-                    processing_idx, status, log_msg = future.result()
-                    df.at[original_idx, "Face_Status"] = status
-                    
-                    if status == "GOOD":
-                        good_count += 1
-                    elif status == "NO FACE":
-                        noface_count += 1
-                    elif status == "DOWNLOAD_ERROR":
-                        download_err_count += 1
-                    
-                except Exception as e:
-                    df.at[original_idx, "Face_Status"] = "SYSTEM_ERROR"
-                
-                # Update progress
+        for rows in runner.iter_results():
+            # CHECK CANCELLATION
+            if jobs[job_id].get('status') == 'cancelled':
+                print(f"Job {job_id} cancelled by user. Stopping pipeline...")
+                runner.stop()
+                # Save partial results so far
+                artifact_writer.flush(job_id)
+                checkpoint()
+                with stage_metrics.timed('checkpoint', job_id):
+                    table.finalize()
                 with jobs_lock:
-                    jobs[job_id]['processed'] += 1
-                    jobs[job_id]['good_count'] = good_count
-                    jobs[job_id]['noface_count'] = noface_count
-                    jobs[job_id]['download_error_count'] = download_err_count
-                
-                # Save partial results every BATCH_SIZE rows
-                # We use a temp lock or just overwrite, pandas atomic write is safest but simple overwrite works here
-                # checking against BATCH_SIZE to reduce I/O
-                if jobs[job_id]['processed'] % config.get('batch_size', DEFAULT_BATCH_SIZE) == 0:
-                    result_path = os.path.join(RESULTS_FOLDER, f"{job_id}_results.csv")
-                    df.to_csv(result_path, index=False)
-        
-        # Save FINAL results
-        result_path = os.path.join(RESULTS_FOLDER, f"{job_id}_results.csv")
-        df.to_csv(result_path, index=False)
+                    jobs[job_id]['result_file'] = result_path
+                    jobs[job_id]['timings'] = stage_metrics.job_breakdown(job_id)
+                persist_job(job_id)
+                return
+
+            for row in rows:
+                status = row['status']
+                table.record(row['idx'], status)
+                finished_rows.append((row['idx'], status))
+
+                if status == "GOOD":
+                    good_count += 1
+                elif is_noface_status(status):
+                    noface_count += 1
+                    if status != "NO FACE":
+                        prefilter_counts[status] = prefilter_counts.get(status, 0) + 1
+                elif status == "DOWNLOAD_ERROR":
+                    download_err_count += 1
+                    reason = row.get('error_reason', 'unknown')
+                    error_reasons[reason] = error_reasons.get(reason, 0) + 1
+                    stage_metrics.count('download_errors_total', reason)
+                stage_metrics.count('rows_total', status)
+
+            # Update progress
+            processed += len(rows)
+
+            # Save partial results every BATCH_SIZE rows
+            if processed - last_checkpoint >= batch_size:
+                checkpoint()
+                last_checkpoint = processed
+                last_flush = time.monotonic()
+                # Cancellation may have been requested through another worker
+                stored = job_store.get_job(job_id)
+                if stored and stored['status'] == 'cancelled':
+                    with jobs_lock:
+                        jobs[job_id]['status'] = 'cancelled'
+            elif time.monotonic() - last_flush >= PROGRESS_FLUSH_SECONDS:
+                publish_progress()
+                last_flush = time.monotonic()
+
+        # Save FINAL results (evidence images first, so the ZIP is complete when we say so)
+        artifact_writer.flush(job_id)
+        checkpoint()
+        with stage_metrics.timed('checkpoint', job_id):
+            table.finalize()
         
         with jobs_lock:
             jobs[job_id]['status'] = 'completed'
+            jobs[job_id]['pipeline'] = runner.snapshot()
+            jobs[job_id]['timings'] = stage_metrics.job_breakdown(job_id)
             jobs[job_id]['result_file'] = result_path
             jobs[job_id]['completed_at'] = datetime.now().isoformat()
             jobs[job_id]['message'] = 'Processing completed successfully'
+        persist_job(job_id)
         
     except Exception as e:
         with jobs_lock:
             jobs[job_id]['status'] = 'failed'
             jobs[job_id]['error'] = str(e)
+        persist_job(job_id)
+    finally:
+        # The breakdown already lives in the job record
+        stage_metrics.forget(job_id)
+        artifact_writer.forget(job_id)
+
+# ==========================================
+# ============= JOB SCHEDULER ==============
+# ==========================================
+
+class FairSemaphore:
+    """Counting semaphore that hands permits out round-robin across jobs.
+
+    Waiters queue per job id. Whenever a permit is free it goes to the next
+    job in rotation that has a waiter, so a 100k-row job holding a deep
+    queue of waiters can't starve a 50-row job behind it.
+    """
+
+    def __init__(self, permits):
+        self.permits = permits
+        self._free = permits
+        self._cond = threading.Condition()
+        self._waiting = {}  # job_id -> deque of tickets
+        self._rotation = deque()  # job ids with waiters, next to serve first
+
+    def acquire(self, key, stop_event=None):
+        """Block until a permit is granted (False if stop_event fired first)"""
+        with self._cond:
+            if self._free > 0 and not self._rotation:
+                self._free -= 1
+                return True
+
+            ticket = {'granted': False}
+            if key not in self._waiting:
+                self._waiting[key] = deque()
+                self._rotation.append(key)
+            self._waiting[key].append(ticket)
+            self._dispatch()
+
+            while not ticket['granted']:
+                self._cond.wait(0.1)
+                if not ticket['granted'] and stop_event is not None and stop_event.is_set():
+                    self._withdraw(key, ticket)
+                    return False
+            return True
+
+    def release(self):
+        with self._cond:
+            self._free += 1
+            self._dispatch()
+
+    def _dispatch(self):
+        # Caller holds the condition
+        granted = False
+        while self._free > 0 and self._rotation:
+            key = self._rotation.popleft()
+            tickets = self._waiting[key]
+            tickets.popleft()['granted'] = True
+            self._free -= 1
+            granted = True
+            if tickets:
+                self._rotation.append(key)
+            else:
+                del self._waiting[key]
+        if granted:
+            self._cond.notify_all()
+
+    def _withdraw(self, key, ticket):
+        tickets = self._waiting.get(key)
+        if tickets is None:
+            return
+        tickets.remove(ticket)
+        if not tickets:
+            del self._waiting[key]
+            self._rotation.remove(key)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'permits': self.permits,
+                'in_use': self.permits - self._free,
+                'waiting_by_job': {k: len(v) for k, v in self._waiting.items()}
+            }
+
+download_slots = FairSemaphore(GLOBAL_MAX_DOWNLOADS)
+inference_slots = FairSemaphore(GLOBAL_MAX_INFERENCES)
+
+class JobQueueFull(Exception):
+    """Backlog is over MAX_QUEUED_JOBS, new work should be retried later"""
+
+class JobScheduler:
+    """Runs up to max_running jobs at once and queues the rest (FIFO).
+
+    Only the job runner process uses it to run jobs (see become_job_runner),
+    so its caps and the global slots hold for the whole host. Admission
+    control happens here: when the backlog is full new uploads are
+    rejected up front instead of every running job slowing down.
+    """
+
+    def __init__(self, max_running=MAX_CONCURRENT_JOBS, max_queued=MAX_QUEUED_JOBS):
+        self.max_running = max_running
+        self.max_queued = max_queued
+        self._lock = threading.Lock()
+        self._queue = deque()  # (job_id, args)
+        self._running = set()
+
+    def has_capacity(self):
+        """Room for one more upload, counted in the store (uploads arrive at every process)"""
+        return job_store.count_jobs(ACTIVE_JOB_STATUSES) < self.max_running + self.max_queued
+
+    def submit(self, job_id, args, force=False):
+        """Start now or queue; raises JobQueueFull unless force (resumed jobs)"""
+        with self._lock:
+            if len(self._running) < self.max_running:
+                self._running.add(job_id)
+            elif len(self._queue) >= self.max_queued and not force:
+                raise JobQueueFull(f"{len(self._queue)} jobs already waiting")
+            else:
+                self._queue.append((job_id, args))
+                return
+        self._launch(job_id, args)
+
+    def _launch(self, job_id, args):
+        thread = threading.Thread(target=self._run, args=(job_id, args), name=f"job-{job_id[:8]}")
+        thread.daemon = True
+        thread.start()
+
+    def _run(self, job_id, args):
+        try:
+            process_csv_job(job_id, *args)
+        finally:
+            self._finished(job_id)
+
+    def _finished(self, job_id):
+        with self._lock:
+            self._running.discard(job_id)
+            next_job = None
+            while self._queue and len(self._running) < self.max_running:
+                candidate_id, args = self._queue.popleft()
+                with jobs_lock:
+                    cancelled = jobs.get(candidate_id, {}).get('status') == 'cancelled'
+                if cancelled:
+                    continue
+                self._running.add(candidate_id)
+                next_job = (candidate_id, args)
+                break
+        if next_job:
+            self._launch(*next_job)
+
+    def is_running(self, job_id):
+        with self._lock:
+            return job_id in self._running
+
+    def remove(self, job_id):
+        """Drop a queued (not yet started) job, True if it was waiting"""
+        with self._lock:
+            for entry in self._queue:
+                if entry[0] == job_id:
+                    self._queue.remove(entry)
+                    return True
+        return False
+
+    def queue_position(self, job_id):
+        """1-based position in the waiting queue, None once the job runs"""
+        with self._lock:
+            for position, (queued_id, _) in enumerate(self._queue, start=1):
+                if queued_id == job_id:
+                    return position
+            if job_id in self._running:
+                return None
+        # Waiting in the runner (another process) or not yet handed to it
+        return job_store.queue_position(job_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'running': len(self._running),
+                'max_running': self.max_running,
+                'queued': len(self._queue),
+                'max_queued': self.max_queued
+            }
+
+job_scheduler = JobScheduler()
+
+# ==========================================
+# ============ JOB RECOVERY ================
+# ==========================================
+
+def _owner_is_dead(owner, heartbeat):
+    """Owner process gone (same host: check pid) or lease expired (any host)"""
+    if owner is None:
+        return True
+    host, _, pid = owner.rpartition(':')
+    if host == socket.gethostname() and pid.isdigit():
+        if int(pid) == os.getpid():
+            return False
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+    return heartbeat is None or time.time() - heartbeat > JOB_LEASE_SECONDS
+
+def start_job_thread(job_id, csv_path, original_filename, config, force=False):
+    """Hand a job to the scheduler (starts now or waits its turn)"""
+    job_scheduler.submit(job_id, (csv_path, original_filename, config), force=force)
+
+def resume_interrupted_jobs():
+    """Job runner: take over active jobs nobody runs and start or continue them.
+
+    That is uploads another process stored for the runner (no owner yet)
+    and jobs whose owner died, oldest upload first.
+    """
+    resumed = 0
+    for job, owner, heartbeat in job_store.active_jobs():
+        job_id = job['id']
+        with jobs_lock:
+            if job_id in jobs:
+                continue
+        if not _owner_is_dead(owner, heartbeat):
+            continue
+        if not job.get('csv_path') or not os.path.exists(job['csv_path']):
+            job_store.set_status(job_id, 'failed', 'Upload file missing, cannot resume')
+            continue
+        if not job_store.claim_job(job_id, WORKER_ID, owner):
+            continue  # Another worker got there first
+
+        if owner is not None:
+            job['message'] = 'Resumed after restart'
+            print(f"Job {job_id}: Resuming interrupted job (previous owner {owner})")
+        job['status'] = 'queued'
+        with jobs_lock:
+            jobs[job_id] = job
+        start_job_thread(job_id, job['csv_path'], job.get('original_filename'), job.get('config', {}),
+                         force=True)
+        resumed += 1
+    return resumed
+
+def _job_lease_loop():
+    # Keep leases on our running jobs fresh; take over roles whose process died
+    while True:
+        try:
+            with jobs_lock:
+                running = [jid for jid, j in jobs.items() if j.get('status') in ACTIVE_JOB_STATUSES]
+            job_store.heartbeat(running, WORKER_ID)
+            become_job_runner()
+            start_cleanup_scheduler()
+        except Exception as e:
+            print(f"Job lease loop error: {e}")
+        time.sleep(JOB_HEARTBEAT_SECONDS)
+
+# One job runner per host: the process holding this lock runs every job, so
+# MAX_CONCURRENT_JOBS, MAX_QUEUED_JOBS and the global download / inference
+# slots hold for the host however many gunicorn workers (WEB_CONCURRENCY)
+# accept uploads.
+JOB_RUNNER_LOCK_PATH = os.path.join(DATA_DIR, 'job-runner.lock')
+_job_runner = {'pid': None, 'lock': None}
+
+def is_job_runner():
+    return _job_runner['pid'] == os.getpid()
+
+def become_job_runner():
+    """Run this host's jobs in this process if no other process does (True if so).
+
+    Other processes store uploads as 'queued' with no owner; the runner
+    claims them (and jobs of dead workers) from its intake loop.
+    """
+    if is_job_runner():
+        return True
+    lock_file = lock_host_role(JOB_RUNNER_LOCK_PATH)
+    if lock_file is None:
+        return False
+    _job_runner.update(pid=os.getpid(), lock=lock_file)
+    worker_state['runs_jobs'] = True
+    threading.Thread(target=_job_intake_loop, name="job-intake", daemon=True).start()
+    print(f"Job runner running in process {os.getpid()}")
+    return True
+
+def _job_intake_loop():
+    while True:
+        try:
+            resume_interrupted_jobs()
+        except Exception as e:
+            print(f"Job intake error: {e}")
+        time.sleep(JOB_INTAKE_POLL_SECONDS)
+
+# ==========================================
+# ============ WORKER STARTUP ==============
+# ==========================================
+
+# Importing this module only defines things. A serving process calls
+# start_worker() once: from gunicorn's post_worker_init (gunicorn.conf.py,
+# models preloaded in the master), from __main__, or on its first request.
+worker_state = {'pid': None, 'ready': False, 'startup_seconds': None, 'warmup_seconds': None,
+                'runs_cleanup': False, 'runs_jobs': False, 'error': None}
+_worker_lock = threading.Lock()
+_warming = {'pid': None}  # Process whose background start_worker() is running or done
+_warming_lock = threading.Lock()
+
+def warm_up():
+    """Build this process's detectors and run a dummy frame through each path"""
+    init_models()
+    frame = np.zeros((WARMUP_FRAME_SIZE, WARMUP_FRAME_SIZE, 3), dtype=np.uint8)
+    detector_pool.warm(DEFAULT_MEDIAPIPE_CONF_THRESH, frame=frame)
+    interactive_detectors.warm(DEFAULT_MEDIAPIPE_CONF_THRESH, DETECT_MAX_CONCURRENT, frame=frame)
+    # Default jobs batch their DNN fallbacks on a separate thread with its own net
+    get_dnn_batcher({}).max_confidence(frame)
+
+def start_worker():
+    """Load, warm up and start background threads for this process (idempotent)"""
+    global WORKER_ID
+    with _worker_lock:
+        if worker_state['pid'] == os.getpid():
+            return
+        start = time.perf_counter()
+        WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+        ensure_data_dirs()
+        init_models()
+        warm_start = time.perf_counter()
+        warm_up()
+        warmup_seconds = time.perf_counter() - warm_start
+        runs_jobs = become_job_runner()
+        runs_cleanup = start_cleanup_scheduler()
+        threading.Thread(target=_job_lease_loop, name="job-lease", daemon=True).start()
+        worker_state.update(pid=os.getpid(), ready=True, runs_cleanup=runs_cleanup, runs_jobs=runs_jobs,
+                            startup_seconds=round(time.perf_counter() - start, 3),
+                            warmup_seconds=round(warmup_seconds, 3))
+    print(f"Worker {WORKER_ID} ready in {worker_state['startup_seconds']}s "
+          f"(warm-up {worker_state['warmup_seconds']}s)")
+
+def start_worker_in_background():
+    """Run start_worker() on a thread once per process, for probes that must not block"""
+    with _warming_lock:
+        if _warming['pid'] == os.getpid():
+            return
+        _warming['pid'] = os.getpid()
+    threading.Thread(target=_start_worker_logged, name="worker-start", daemon=True).start()
+
+def _start_worker_logged():
+    try:
+        start_worker()
+        worker_state['error'] = None
+    except Exception as e:
+        print(f"Worker start failed: {e}")
+        worker_state['error'] = str(e)
+        with _warming_lock:
+            _warming['pid'] = None  # The next probe tries again
 
 # ==========================================
 # ============== API ROUTES ================
 # ==========================================
 
+@app.before_request
+def ensure_worker_started():
+    # Plain `gunicorn app:app` / other WSGI servers: the first request starts the worker.
+    # The readiness probe never waits for it, it has to be able to say 503.
+    if worker_state['pid'] != os.getpid() and request.endpoint != 'readiness':
+        start_worker()
+
+@app.route('/ready', methods=['GET'])
+def readiness():
+    """Readiness probe: 200 once this worker has loaded and warmed its models.
+
+    A worker nobody has started yet begins warming up in the background and
+    answers 503 (warming: true) until it is done.
+    """
+    ready = worker_state['ready'] and worker_state['pid'] == os.getpid()
+    if not ready:
+        start_worker_in_background()
+    warming = not ready and _warming['pid'] == os.getpid()
+    return jsonify(dict(worker_state, worker=WORKER_ID, ready=ready, warming=warming)), 200 if ready else 503
+
 @app.route('/')
 def index():
     """Serve the main page"""
@@ -384,6 +3691,10 @@ def upload_csv():
     
     if not file.filename.endswith('.csv'):
         return jsonify({'error': 'Only CSV files are allowed'}), 400
+
+    # Admission control: refuse early rather than slow every running job down
+    if not job_scheduler.has_capacity():
+        return server_busy_response()
     
     # Get Config from Form Data
     try:
@@ -392,9 +3703,38 @@ def upload_csv():
             'mediapipe_thresh': float(request.form.get('mediapipe_thresh', DEFAULT_MEDIAPIPE_CONF_THRESH)),
             'dnn_thresh': float(request.form.get('dnn_thresh', DEFAULT_DNN_CONF_THRESH)),
             'num_threads': int(request.form.get('num_threads', DEFAULT_NUM_THREADS)),
+            'download_workers': int(request.form.get('download_workers', DEFAULT_DOWNLOAD_WORKERS)),
             'batch_size': int(request.form.get('batch_size', DEFAULT_BATCH_SIZE)),
-            'save_images': request.form.get('save_images', 'true').lower() == 'true'
+            'max_dimension': int(request.form.get('max_dimension', DEFAULT_MAX_DIMENSION)),
+            'dnn_batch_size': int(request.form.get('dnn_batch_size', DEFAULT_DNN_BATCH_SIZE)),
+            'dnn_batch_wait_ms': float(request.form.get('dnn_batch_wait_ms', DEFAULT_DNN_BATCH_WAIT_MS)),
+            'execution_mode': request.form.get('execution_mode', DEFAULT_EXECUTION_MODE).lower(),
+            'save_images': request.form.get('save_images', 'true').lower() == 'true',
+            'streaming': request.form.get('streaming', 'auto').lower(),
+            'use_cache': request.form.get('use_cache', 'true').lower() == 'true',
+            'dedup_urls': request.form.get('dedup_urls', 'true').lower() == 'true',
+            'artifact_mode': request.form.get('artifact_mode', DEFAULT_ARTIFACT_MODE),
+            'artifact_max_dimension': int(request.form.get('artifact_max_dimension', DEFAULT_ARTIFACT_MAX_DIMENSION)),
+            'artifact_quality': int(request.form.get('artifact_quality', DEFAULT_ARTIFACT_QUALITY)),
+            'artifact_backpressure': request.form.get('artifact_backpressure', DEFAULT_ARTIFACT_BACKPRESSURE),
+            'prefilter': request.form.get('prefilter', 'false').lower() == 'true',
+            'prefilter_min_dim': int(request.form.get('prefilter_min_dim', DEFAULT_PREFILTER_MIN_DIM)),
+            'prefilter_min_std': float(request.form.get('prefilter_min_std', DEFAULT_PREFILTER_MIN_STD)),
+            'prefilter_dark_mean': float(request.form.get('prefilter_dark_mean', DEFAULT_PREFILTER_DARK_MEAN)),
+            'prefilter_min_blur': float(request.form.get('prefilter_min_blur', DEFAULT_PREFILTER_MIN_BLUR)),
+            'retention_hours': float(request.form.get('retention_hours', MAX_FILE_AGE_HOURS)),
+            'shard_rows': int(request.form.get('shard_rows', DEFAULT_SHARD_ROWS))
         }
+        if config['execution_mode'] not in ('threads', 'processes'):
+            raise ValueError(config['execution_mode'])
+        if config['artifact_mode'] not in ('original', 'compact', 'full'):
+            raise ValueError(config['artifact_mode'])
+        if config['artifact_backpressure'] not in ('block', 'drop', 'inline'):
+            raise ValueError(config['artifact_backpressure'])
+        if not 0 < config['retention_hours'] <= MAX_RETENTION_HOURS:
+            raise ValueError(config['retention_hours'])
+        if config['shard_rows'] < 0:
+            raise ValueError(config['shard_rows'])
     except ValueError:
          return jsonify({'error': 'Invalid configuration values'}), 400
 
@@ -409,63 +3749,139 @@ def upload_csv():
     
     filepath = os.path.join(UPLOAD_FOLDER, filename)
     file.save(filepath)
+
+    # Large files are streamed in chunks unless the user chose explicitly
+    if config['streaming'] == 'auto':
+        config['streaming'] = os.path.getsize(filepath) >= STREAMING_AUTO_BYTES
+    else:
+        config['streaming'] = config['streaming'] == 'true'
     
     # Initialize job
+    job = {
+        'id': job_id,
+        'status': 'queued',
+        'original_filename': file.filename,
+        'csv_path': filepath,
+        'uploaded_at': datetime.now().isoformat(),
+        'config': config,
+        'total_rows': 0,
+        'rows_to_process': 0,
+        'processed': 0,
+        'good_count': 0,
+        'noface_count': 0,
+        'download_error_count': 0,
+        'cache_hits': 0,
+        'cache_misses': 0,
+        'dedup_rows': 0
+    }
+    if not is_job_runner():
+        # Stored without an owner: the job runner process claims it within JOB_INTAKE_POLL_SECONDS
+        job_store.save_job(job)
+        job_store.add_artifacts(job_id, [(filepath, 'file')])
+        position = job_scheduler.queue_position(job_id)
+        return jsonify({
+            'job_id': job_id,
+            'queue_position': position,
+            'message': f'File uploaded successfully. Queued at position {position}.'
+        }), 200
+
     with jobs_lock:
-        jobs[job_id] = {
-            'id': job_id,
-            'status': 'queued',
-            'original_filename': file.filename,
-            'uploaded_at': datetime.now().isoformat(),
-            'config': config,
-            'total_rows': 0,
-            'rows_to_process': 0,
-            'processed': 0,
-            'good_count': 0,
-            'noface_count': 0,
-            'download_error_count': 0
-        }
-    
-    # Start background processing
-    thread = threading.Thread(target=process_csv_job, args=(job_id, filepath, file.filename, config))
-    thread.daemon = True
-    thread.start()
+        jobs[job_id] = job
+    persist_job(job_id)
+    job_store.add_artifacts(job_id, [(filepath, 'file')])
     
+    # Start background processing (or queue it behind running jobs)
+    try:
+        start_job_thread(job_id, filepath, file.filename, config)
+    except JobQueueFull:
+        with jobs_lock:
+            jobs.pop(job_id, None)
+        job_store.set_status(job_id, 'failed', 'Rejected: server busy')
+        os.remove(filepath)
+        return server_busy_response()
+
+    position = job_scheduler.queue_position(job_id)
     return jsonify({
         'job_id': job_id,
-        'message': 'File uploaded successfully. Processing started.'
+        'queue_position': position,
+        'message': 'File uploaded successfully. ' +
+                   (f'Queued at position {position}.' if position else 'Processing started.')
     }), 200
 
+def server_busy_response():
+    response = jsonify({'error': 'Server is busy with other audits, please retry in a few minutes'})
+    response.headers['Retry-After'] = '60'
+    return response, 503
+
 @app.route('/api/status/<job_id>', methods=['GET'])
 def get_job_status(job_id):
-    """Get job processing status"""
-    with jobs_lock:
-        if job_id not in jobs:
+    """Get job processing status (304 when the client's ETag is still current)"""
+    # Tag first: the payload read after it is at least as new as the tag says
+    tag = job_status_etag(job_id)
+    if tag is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if request.if_none_match.contains(tag):
+        return validated_response(Response(status=304), tag)
+
+    job_data = job_status_payload(job_id)
+    if job_data is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return validated_response(jsonify(job_data), tag), 200
+
+@app.route('/api/events/<job_id>', methods=['GET'])
+def job_events_feed(job_id):
+    """Push job progress as Server-Sent Events.
+
+    ?mode=poll turns it into a long-poll instead: pass the last seen
+    ?version=N and the request returns once something newer exists (or
+    after ?timeout= seconds) with the full status plus its version.
+    Streams are capped at EVENTS_MAX_STREAMS per process; past that the
+    answer is 503 with Retry-After and the client should long-poll.
+    """
+    if job_status_payload(job_id) is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    if request.args.get('mode') == 'poll':
+        since = request.args.get('version', -1, type=int)
+        timeout = min(request.args.get('timeout', LONG_POLL_TIMEOUT_SECONDS, type=float),
+                      LONG_POLL_TIMEOUT_SECONDS * 2)
+        with jobs_lock:
+            local = job_id in jobs
+        if not local:
+            # Owned by another worker: nothing will notify us, re-read the store shortly
+            timeout = min(timeout, REMOTE_JOB_POLL_SECONDS)
+        version = job_events.wait(job_id, since, timeout)
+        job_data = job_status_payload(job_id)
+        if job_data is None:
             return jsonify({'error': 'Job not found'}), 404
-        
-        job_data = jobs[job_id].copy()
-    
-    # Calculate progress percentage
-    if job_data.get('rows_to_process', 0) > 0:
-        job_data['progress'] = (job_data['processed'] / job_data['rows_to_process']) * 100
-    else:
-        job_data['progress'] = 0
-    
-    return jsonify(job_data), 200
+        job_data['version'] = version
+        return jsonify(job_data), 200
+
+    if not event_stream_slots.acquire(blocking=False):
+        response = jsonify({'error': 'Too many open event streams', 'fallback': 'mode=poll'})
+        response.headers['Retry-After'] = str(EVENTS_RETRY_AFTER_SECONDS)
+        return response, 503
+    rate = request.args.get('rate', EVENTS_MAX_PER_SECOND, type=float)
+    rate = max(0.2, min(rate, EVENTS_MAX_PER_SECOND))
+    response = Response(job_event_stream(job_id, rate), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # Don't let nginx buffer the stream
+    })
+    # Runs when the stream ends or the client goes away
+    response.call_on_close(event_stream_slots.release)
+    return response
 
 @app.route('/api/download/<job_id>', methods=['GET'])
 def download_results(job_id):
     """Download processed CSV results"""
-    with jobs_lock:
-        if job_id not in jobs:
-            return jsonify({'error': 'Job not found'}), 404
-        
-        job = jobs[job_id]
-        
-        if job['status'] != 'completed':
-            return jsonify({'error': 'Job not completed yet'}), 400
-        
-        result_file = job.get('result_file')
+    job = get_job_record(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    if job['status'] != 'completed':
+        return jsonify({'error': 'Job not completed yet'}), 400
+    
+    result_file = job.get('result_file')
     
     if not result_file or not os.path.exists(result_file):
         return jsonify({'error': 'Result file not found'}), 404
@@ -478,83 +3894,327 @@ def download_results(job_id):
 
 @app.route('/api/download-noface/<job_id>', methods=['GET'])
 def download_noface_images(job_id):
-    """Download NO FACE images as ZIP (Safe Temp File Method)"""
+    """Download NO FACE images as a ZIP built while it streams.
+
+    ?since=N skips the first N images (in save order) so the UI can pull
+    new images while the job is still running; ?until=M stops before
+    image M. X-Next-Offset tells the client where to resume.
+    """
     job_folder = os.path.join(NO_FACE_FOLDER, job_id)
+    since = max(request.args.get('since', 0, type=int), 0)
+    until = request.args.get('until', type=int)
+    incremental = 'since' in request.args
     
     if not os.path.exists(job_folder):
+        if incremental and get_job_record(job_id) is not None:
+            return noface_zip_empty(since)
         return jsonify({'error': 'No images found'}), 404
-    
+
+    paths = list_noface_images(job_folder)
+    selected = paths[since:until]
+
     # Check if there are any files
-    if not os.listdir(job_folder):
+    if not selected:
+        if incremental:
+            return noface_zip_empty(since)
         return jsonify({'error': 'No images to zip'}), 404
 
-    # Generate a secure temp filename
-    zip_filename = f"{job_id}_noface"
-    zip_path = os.path.join(RESULTS_FOLDER, zip_filename) # make_archive adds .zip extension automatically
-    final_zip_path = zip_path + ".zip"
+    next_offset = since + len(selected)
+    filename = f'noface_images_{job_id}.zip'
+    if incremental:
+        filename = f'noface_images_{job_id}_{since + 1}-{next_offset}.zip'
 
+    response = app.response_class(stream_zip(selected), mimetype='application/zip')
+    response.headers.set('Content-Disposition', 'attachment', filename=filename)
+    response.headers['X-Next-Offset'] = str(next_offset)
+    response.headers['X-Image-Count'] = str(len(selected))
+    return response
+
+def noface_zip_empty(since):
+    # Nothing new yet: the client keeps its offset and asks again later
+    response = app.response_class(status=204)
+    response.headers['X-Next-Offset'] = str(since)
+    response.headers['X-Image-Count'] = '0'
+    return response
+
+@app.route('/api/detect', methods=['POST'])
+def detect_images():
+    """Synchronous face check for one image (JSON) or a small batch (NDJSON stream).
+
+    Accepts a raw image body (image/* or application/octet-stream), multipart
+    'image' files, or JSON with 'image' / 'images' (base64) or 'url' / 'urls'.
+    """
+    payload = request.get_json(silent=True) if request.is_json else None
+    options = payload if isinstance(payload, dict) else request.args
     try:
-        # Create ZIP file on disk (Standard robust method)
-        shutil.make_archive(zip_path, 'zip', job_folder)
-        
-        # Stream the file to the user
-        def generate():
-            with open(final_zip_path, 'rb') as f:
-                while True:
-                    chunk = f.read(4096 * 1024) # 4MB chunks
-                    if not chunk:
-                        break
-                    yield chunk
-            
-            # Clean up after streaming is done
-            try:
-                os.remove(final_zip_path)
-            except Exception as e:
-                print(f"Error removing temp zip: {e}")
+        config = {
+            'mediapipe_thresh': float(options.get('mediapipe_thresh', DEFAULT_MEDIAPIPE_CONF_THRESH)),
+            'dnn_thresh': float(options.get('dnn_thresh', DEFAULT_DNN_CONF_THRESH)),
+            'max_dimension': int(options.get('max_dimension', DEFAULT_MAX_DIMENSION)),
+            'download_timeout': min(float(options.get('download_timeout', DETECT_DOWNLOAD_TIMEOUT)),
+                                    DEFAULT_DOWNLOAD_TIMEOUT),
+            'prefilter': str(options.get('prefilter', 'false')).lower() == 'true',
+            'dnn_batch_size': 1  # Never wait on other requests to fill a DNN batch
+        }
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid configuration values'}), 400
 
-        response = app.response_class(
-            generate(),
-            mimetype='application/zip'
-        )
-        response.headers.set('Content-Disposition', 'attachment', filename=f'noface_images_{job_id}.zip')
-        return response
+    # Work out the sources: [('bytes', data) | ('url', url)], batch or single
+    if isinstance(payload, dict):
+        if 'images' in payload or 'urls' in payload:
+            images, urls = payload.get('images') or [], payload.get('urls') or []
+            if not isinstance(images, list) or not isinstance(urls, list):
+                return jsonify({'error': "'images' and 'urls' must be lists"}), 400
+            sources = [('bytes', decode_base64_image(str(v))) for v in images] + [('url', str(v)) for v in urls]
+            batch = True
+        elif payload.get('image'):
+            sources, batch = [('bytes', decode_base64_image(str(payload['image'])))], False
+        elif payload.get('url'):
+            sources, batch = [('url', str(payload['url']))], False
+        else:
+            return jsonify({'error': "Provide 'image', 'images', 'url' or 'urls'"}), 400
+    elif request.files:
+        files = request.files.getlist('image')
+        sources, batch = [('bytes', f.read()) for f in files], len(files) > 1
+    elif request.mimetype.startswith('image/') or request.mimetype == 'application/octet-stream':
+        sources, batch = [('bytes', request.get_data())], False
+    else:
+        return jsonify({'error': 'Send an image body, multipart images or JSON'}), 400
 
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    if not sources:
+        return jsonify({'error': 'No images provided'}), 400
+    if len(sources) > DETECT_MAX_BATCH:
+        return jsonify({'error': f'At most {DETECT_MAX_BATCH} images per request'}), 413
+
+    started = time.perf_counter()
+    if not detect_admission.acquire(timeout=DETECT_ADMISSION_WAIT_MS / 1000):
+        stage_metrics.count('detect_requests_total', 'busy')
+        response = jsonify({'error': 'Detection is at capacity, please retry'})
+        response.headers['Retry-After'] = '1'
+        return response, 503
+    stage_metrics.count('detect_requests_total', 'ok')
+
+    if not batch:
+        try:
+            result = next(detect_sources(sources, config))
+        finally:
+            detect_admission.release()
+        elapsed = time.perf_counter() - started
+        observe_detect_latency(elapsed)
+        response = jsonify(result)
+        response.headers['X-Detect-Latency-Ms'] = f"{elapsed * 1000:.2f}"
+        return response, 400 if result['status'] == "INVALID_IMAGE" else 200
+
+    def generate():
+        for result in detect_sources(sources, config):
+            yield json.dumps(result) + "\n"
+
+    response = Response(generate(), mimetype='application/x-ndjson')
+    response.call_on_close(detect_admission.release)
+    response.headers['X-Detect-Count'] = str(len(sources))
+    response.headers['X-Detect-Queue-Ms'] = f"{(time.perf_counter() - started) * 1000:.2f}"
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def shard_auth_error():
+    """403 response unless the caller sent the configured SHARD_TOKEN"""
+    if SHARD_TOKEN and request.headers.get('X-Shard-Token') != SHARD_TOKEN:
+        return jsonify({'error': 'Invalid shard token'}), 403
+    return None
+
+def leased_shard(job_id, shard, lease_id):
+    """The shard if `lease_id` still holds it, else None"""
+    info = job_store.get_shard(job_id, shard)
+    if info is None or info['status'] != 'leased' or info['lease_id'] != lease_id:
+        return None
+    return info if info['job_status'] == 'processing' else None
+
+def lease_lost_response():
+    return jsonify({'error': 'Lease lost (expired, re-leased or job stopped)'}), 409
+
+@app.route('/api/shards/lease', methods=['POST'])
+def lease_shard():
+    """Hand the next pending (or abandoned) shard to a shard worker, 204 if none"""
+    denied = shard_auth_error()
+    if denied:
+        return denied
+    payload = request.get_json(silent=True) or {}
+    worker = str(payload.get('worker') or request.remote_addr)
+    lease = job_store.lease_shard(worker, SHARD_LEASE_SECONDS)
+    if lease is None:
+        return '', 204
+    job = job_store.get_job(lease['job_id']) or {}
+    # Cache lookups and URL dedup already happened on the coordinator
+    lease['config'] = dict(job.get('config', {}), shard_rows=0, use_cache=False, dedup_urls=False,
+                           streaming=False)
+    lease['lease_seconds'] = SHARD_LEASE_SECONDS
+    return jsonify(lease)
+
+@app.route('/api/shards/<job_id>/<int:shard>/rows', methods=['GET'])
+def shard_rows(job_id, shard):
+    """The shard's rows as CSV (SHARD_COLUMNS)"""
+    denied = shard_auth_error()
+    if denied:
+        return denied
+    info = leased_shard(job_id, shard, request.args.get('lease_id'))
+    if info is None:
+        return lease_lost_response()
+    return send_file(info['path'], mimetype='text/csv')
+
+@app.route('/api/shards/<job_id>/<int:shard>/heartbeat', methods=['POST'])
+def shard_heartbeat(job_id, shard):
+    """Keep a lease alive; 409 tells the worker to stop"""
+    denied = shard_auth_error()
+    if denied:
+        return denied
+    payload = request.get_json(silent=True) or {}
+    try:
+        progress = int(payload.get('processed', 0))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid progress'}), 400
+    if not job_store.renew_shard(job_id, shard, payload.get('lease_id'), progress, SHARD_LEASE_SECONDS):
+        return lease_lost_response()
+    return jsonify({'lease_seconds': SHARD_LEASE_SECONDS})
+
+@app.route('/api/shards/<job_id>/<int:shard>/evidence/<name>', methods=['PUT'])
+def shard_evidence(job_id, shard, name):
+    """Upload one NO FACE evidence image produced by a shard worker"""
+    denied = shard_auth_error()
+    if denied:
+        return denied
+    if (not name.endswith('_NOFACE.jpg') or name != os.path.basename(name) or '\\' in name
+            or name.startswith('.')):
+        return jsonify({'error': 'Invalid evidence file name'}), 400
+    if leased_shard(job_id, shard, request.args.get('lease_id')) is None:
+        return lease_lost_response()
+    save_path = os.path.join(NO_FACE_FOLDER, job_id, name)
+    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    partial_path = save_path[:-len(".jpg")] + NOFACE_PARTIAL_SUFFIX
+    with open(partial_path, 'wb') as f:
+        shutil.copyfileobj(request.stream, f, ZIP_READ_CHUNK)
+    os.replace(partial_path, save_path)
+    record_noface_image(save_path)
+    return jsonify({'saved': name}), 201
+
+@app.route('/api/shards/<job_id>/<int:shard>/complete', methods=['POST'])
+def complete_shard(job_id, shard):
+    """Finish a shard: one [idx, status, error_reason] per row, merged by the coordinator"""
+    denied = shard_auth_error()
+    if denied:
+        return denied
+    payload = request.get_json(silent=True) or {}
+    info = leased_shard(job_id, shard, payload.get('lease_id'))
+    if info is None:
+        return lease_lost_response()
+    rows = payload.get('rows')
+    if not isinstance(rows, list) or len(rows) != info['rows']:
+        return jsonify({'error': f"Expected {info['rows']} rows"}), 400
+    try:
+        rows = [[int(idx), str(status), str(reason) if reason else None] for idx, status, reason in rows]
+        elapsed = float(payload.get('elapsed_s', 0))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid rows'}), 400
+    result = json.dumps({'rows': rows, 'elapsed_s': elapsed})
+    if not job_store.complete_shard(job_id, shard, payload['lease_id'], result):
+        return lease_lost_response()
+    return jsonify({'merged_rows': len(rows)})
 
 @app.route('/api/cancel/<job_id>', methods=['POST'])
 def cancel_job(job_id):
     """Cancel a running job"""
+    job_scheduler.remove(job_id)
     with jobs_lock:
-        if job_id not in jobs:
-            return jsonify({'error': 'Job not found'}), 404
-        
-        # Mark as cancelled so the thread stops
-        jobs[job_id]['status'] = 'cancelled'
-        jobs[job_id]['message'] = 'Job cancelled by user'
+        if job_id in jobs:
+            # Mark as cancelled so the thread stops
+            jobs[job_id]['status'] = 'cancelled'
+            jobs[job_id]['message'] = 'Job cancelled by user'
+    job_events.notify(job_id)
+
+    # The owning worker (maybe another process) sees this at its next checkpoint
+    if not job_store.set_status(job_id, 'cancelled', 'Job cancelled by user'):
+        return jsonify({'error': 'Job not found'}), 404
         
     return jsonify({'message': 'Job cancellation requested'})
 
-@app.route('/api/status/<job_id>', methods=['GET'])
-def check_status(job_id):
-    with jobs_lock:
-        if job_id not in jobs:
-            return jsonify({'error': 'Job not found'}), 404
-        return jsonify(jobs[job_id])
-
 @app.route('/api/jobs', methods=['GET'])
 def list_jobs():
-    """List all jobs"""
+    """One page of job history, newest first.
+
+    ?status=completed,failed and ?since= / ?until= (ISO dates) filter,
+    ?limit= sizes the page (max JOBS_PAGE_MAX) and ?cursor= (next_cursor of
+    the previous page) continues it. ?view=full returns whole job records
+    instead of the summary fields. Answers 304 while the page is unchanged.
+    """
+    try:
+        statuses = [v for v in request.args.get('status', '').split(',') if v]
+        if any(v not in ACTIVE_JOB_STATUSES + TERMINAL_JOB_STATUSES for v in statuses):
+            raise ValueError(statuses)
+        since = parse_iso_arg('since')
+        until = parse_iso_arg('until')
+        limit = min(max(int(request.args.get('limit', JOBS_PAGE_SIZE)), 1), JOBS_PAGE_MAX)
+        before = decode_jobs_cursor(request.args['cursor']) if request.args.get('cursor') else None
+        view = request.args.get('view', 'summary')
+        if view not in ('summary', 'full'):
+            raise ValueError(view)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid filter, limit or cursor'}), 400
+
+    query = dict(statuses=statuses, since=since, until=until, before=before, limit=limit + 1)
+    active_count = job_store.count_jobs(ACTIVE_JOB_STATUSES)
+    rows = job_store.query_jobs(**query)
+    tag = jobs_page_etag(rows, view, active_count)
+    if request.if_none_match.contains(tag):
+        return validated_response(Response(status=304), tag)
+
+    page, more = rows[:limit], len(rows) > limit
+    # Jobs running here have fresher counters than their last checkpoint (only this page is copied)
     with jobs_lock:
-        all_jobs = list(jobs.values())
-    
-    return jsonify(all_jobs), 200
+        page_jobs = [jobs[job_id].copy() if job_id in jobs else job for job_id, _, _, job in page]
+    if view == 'summary':
+        page_jobs = [{k: job[k] for k in JOB_SUMMARY_FIELDS if k in job} for job in page_jobs]
+    return validated_response(jsonify({
+        'jobs': page_jobs,
+        'next_cursor': encode_jobs_cursor(page[-1][1], page[-1][0]) if more else None,
+        'active_count': active_count
+    }), tag), 200
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Process-wide stage latencies, queue depths and counters (Prometheus text format)"""
+    return Response(render_prometheus_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/scheduler', methods=['GET'])
+def scheduler_stats():
+    """Running / queued jobs and global download / inference slot usage"""
+    return jsonify({
+        'jobs': job_scheduler.stats(),
+        'download_slots': download_slots.stats(),
+        'inference_slots': inference_slots.stats()
+    }), 200
+
+@app.route('/api/cache', methods=['GET'])
+def cache_stats():
+    """Result cache size and hit/miss counters"""
+    return jsonify(result_cache.stats()), 200
+
+@app.route('/api/detectors', methods=['GET'])
+def detector_stats():
+    """Detector pool counters (warm-ups, reuses, evictions) and DNN batching"""
+    stats = detector_pool.stats()
+    with dnn_batchers_lock:
+        batchers = list(dnn_batchers.values())
+    stats['dnn_batchers'] = [b.stats() for b in batchers]
+    stats['detect_api'] = detect_api_stats()
+    return jsonify(stats), 200
 
 if __name__ == '__main__':
     print(">> Face Detection API Server Starting...")
     print(f">> Upload folder: {UPLOAD_FOLDER}")
     print(f">> Results folder: {RESULTS_FOLDER}")
     print(f">> No Face folder: {NO_FACE_FOLDER}")
-    print(f">> Models loaded successfully")
+    # With the debug reloader only the serving child starts up, not the file watcher
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_worker()
+        print(f">> Models loaded successfully")
     print(f">> Server running on http://localhost:5000")
     app.run(debug=True, host='0.0.0.0', port=5000)
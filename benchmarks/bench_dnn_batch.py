@@ -0,0 +1,82 @@
+"""
+DNN Fallback Batching Benchmark
+Compares rows/sec of the per-row OpenCV DNN fallback against DnnBatcher
+at several batch sizes, using the same number of inference threads.
+
+Usage:
+    python benchmarks/bench_dnn_batch.py
+    python benchmarks/bench_dnn_batch.py --images 600 --workers 8 --batch-sizes 1,4,8,16,32
+    python benchmarks/bench_dnn_batch.py --image-dir ./my_jpegs --output dnn_batch.json
+"""
+
+import argparse
+import json
+
+from common import load_images, run_threads
+import app
+
+
+def bench_per_row(images, workers):
+    def factory():
+        net = app.load_dnn_net()  # One net per worker, like the detector pool
+
+        def work(chunk):
+            for img in chunk:
+                app.detect_with_dnn(img, net)
+        return work
+    return run_threads(images, workers, factory)
+
+
+def bench_batched(images, workers, batch_size, wait_ms):
+    batcher = app.DnnBatcher(max_batch=batch_size, max_wait_ms=wait_ms)
+
+    def factory():
+        def work(chunk):
+            for img in chunk:
+                batcher.max_confidence(img)
+        return work
+    elapsed = run_threads(images, workers, factory)
+    return elapsed, batcher.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=400)
+    parser.add_argument('--workers', type=int, default=app.DEFAULT_NUM_THREADS)
+    parser.add_argument('--batch-sizes', default='2,4,8,16,32')
+    parser.add_argument('--wait-ms', type=float, default=app.DEFAULT_DNN_BATCH_WAIT_MS)
+    parser.add_argument('--image-dir', default=None)
+    parser.add_argument('--output', default=None, help='Write results as JSON')
+    args = parser.parse_args()
+
+    images = load_images(args.image_dir, args.images)
+    results = []
+
+    # Warm-up so model load / first-run allocations aren't measured
+    bench_per_row(images[:args.workers], args.workers)
+
+    elapsed = bench_per_row(images, args.workers)
+    results.append({'mode': 'per_row', 'batch_size': 1, 'seconds': elapsed,
+                    'rows_per_sec': len(images) / elapsed})
+
+    for batch_size in [int(b) for b in args.batch_sizes.split(',') if b.strip()]:
+        elapsed, stats = bench_batched(images, args.workers, batch_size, args.wait_ms)
+        results.append({'mode': 'batched', 'batch_size': batch_size, 'seconds': elapsed,
+                        'rows_per_sec': len(images) / elapsed, 'avg_batch': stats['avg_batch']})
+
+    baseline = results[0]['rows_per_sec']
+    print(f"\n{len(images)} images, {args.workers} workers, wait {args.wait_ms} ms")
+    print(f"{'mode':<10}{'batch':>7}{'avg':>7}{'rows/s':>10}{'speedup':>9}")
+    for r in results:
+        print(f"{r['mode']:<10}{r['batch_size']:>7}{r.get('avg_batch', 1):>7}"
+              f"{r['rows_per_sec']:>10.1f}{r['rows_per_sec'] / baseline:>8.2f}x")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'images': len(images), 'workers': args.workers, 'wait_ms': args.wait_ms,
+                       'results': results}, f, indent=2)
+        print(f"\nSaved {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+"""
+End-to-End Audit Pipeline Benchmark (offline)
+Starts a local image server (benchmarks/image_server.py), writes audit CSVs
+shaped like Sample_test_file.csv, and runs process_csv_job on them for every
+combination of the sweep. Each run happens in a fresh Python process, so
+peak RSS and CPU time belong to that configuration alone.
+
+Reported per run: rows/sec, p50/p95/p99 per-row latency (row entering the
+pipeline -> verdict), peak RSS, CPU seconds and average cores busy, plus
+the job's own per-stage timing breakdown.
+
+Usage:
+    python benchmarks/bench_pipeline.py --rows 1000 --output base.json
+    python benchmarks/bench_pipeline.py --rows 1000,10000,100000 --threads 2,6 \\
+        --batch-sizes 50,500 --save-images true,false --latency-ms 40 --error-rate 0.02
+    python benchmarks/bench_pipeline.py --rows 1000 --output new.json --baseline base.json
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import REPO_ROOT, load_images, write_audit_csv
+from image_server import ImageServer, encode_images
+
+RESULT_MARKER = 'BENCH_RESULT '
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+def run_child(spec):
+    """One configuration, inside its own process (see --child)"""
+    os.environ['JOB_STORE_PATH'] = os.path.join(spec['workdir'], 'jobs.sqlite3')
+    import app
+
+    app.RESULTS_FOLDER = os.path.join(spec['workdir'], 'results')
+    app.NO_FACE_FOLDER = os.path.join(spec['workdir'], 'no_face_images')
+    os.makedirs(app.RESULTS_FOLDER, exist_ok=True)
+
+    # Per-row latency: stamp rows as they enter the pipeline, measure when they leave
+    latencies = []
+    iter_row_tasks = app.iter_row_tasks
+
+    def timed_row_tasks(*args, **kwargs):
+        for task in iter_row_tasks(*args, **kwargs):
+            task['bench_t0'] = time.perf_counter()
+            yield task
+
+    class TimedPipeline(app.StagedPipeline):
+        def iter_results(self):
+            for task in super().iter_results():
+                latencies.append(time.perf_counter() - task['bench_t0'])
+                yield task
+
+    app.iter_row_tasks = timed_row_tasks
+    app.StagedPipeline = TimedPipeline
+
+    config = dict(spec['config'])
+    job_id = 'bench'
+    app.jobs[job_id] = {
+        'id': job_id, 'status': 'queued', 'original_filename': 'bench.csv',
+        'uploaded_at': time.strftime('%Y-%m-%dT%H:%M:%S'), 'config': config,
+        'total_rows': 0, 'rows_to_process': 0, 'processed': 0,
+        'good_count': 0, 'noface_count': 0, 'download_error_count': 0
+    }
+
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    app.process_csv_job(job_id, spec['csv_path'], 'bench.csv', config)
+    elapsed = time.perf_counter() - start
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+
+    job = app.jobs[job_id]
+    cpu_seconds = (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime)
+    return {
+        'status': job['status'],
+        'error': job.get('error'),
+        'rows': job['processed'],
+        'elapsed_s': round(elapsed, 3),
+        'rows_per_sec': round(job['processed'] / elapsed, 2),
+        'latency_ms': {f'p{q}': round(percentile(latencies, q) * 1000, 2) if latencies else None
+                       for q in (50, 95, 99)},
+        'peak_rss_mb': round(usage_after.ru_maxrss / 1024, 1),  # ru_maxrss is KiB on Linux
+        'cpu_seconds': round(cpu_seconds, 2),
+        'cpu_cores_busy': round(cpu_seconds / elapsed, 2),
+        'counts': {k: job.get(k, 0) for k in ('good_count', 'noface_count', 'download_error_count')},
+        'timings': job.get('timings', {})
+    }
+
+
+def run_config(rows, csv_path, config, workdir):
+    spec = {'csv_path': csv_path, 'config': config, 'workdir': workdir}
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--child'], input=json.dumps(spec),
+                          capture_output=True, text=True, cwd=REPO_ROOT)
+    for line in reversed(proc.stdout.splitlines()):
+        if line.startswith(RESULT_MARKER):
+            return json.loads(line[len(RESULT_MARKER):])
+    sys.exit(f"Benchmark run failed (rows={rows}, config={config}):\n{proc.stderr[-3000:]}")
+
+
+def parse_list(value, cast=int):
+    return [cast(v) for v in value.split(',') if v]
+
+
+def parse_bool(value):
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def compare(results, baseline_path):
+    """Print rows/sec and p95 change against a previous JSON report"""
+    with open(baseline_path) as f:
+        baseline = {json.dumps(r['params'], sort_keys=True): r for r in json.load(f)['runs']}
+    print(f"\nAgainst {baseline_path}:")
+    for run in results:
+        old = baseline.get(json.dumps(run['params'], sort_keys=True))
+        if not old:
+            continue
+        speed = run['rows_per_sec'] / old['rows_per_sec'] - 1 if old['rows_per_sec'] else 0
+        p95_old, p95_new = old['latency_ms']['p95'], run['latency_ms']['p95']
+        flag = '  <-- slower' if speed < -0.05 else ''
+        print(f"  {run['params']}: rows/s {speed:+.1%}, p95 {p95_old} -> {p95_new} ms{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--rows', default='1000,10000,100000', help='CSV sizes to generate')
+    parser.add_argument('--threads', default='2,6', help='num_threads values')
+    parser.add_argument('--batch-sizes', default='50', help='batch_size (checkpoint interval) values')
+    parser.add_argument('--save-images', default='true,false', help='save_images values')
+    parser.add_argument('--image-dir', default=None, help='Serve real JPEGs instead of synthetic frames')
+    parser.add_argument('--image-size', default='640x480', help='Synthetic frame size WxH')
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--jitter-ms', type=float, default=10)
+    parser.add_argument('--error-rate', type=float, default=0.01)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='Write results as JSON')
+    parser.add_argument('--baseline', default=None, help='Earlier --output file to compare against')
+    args = parser.parse_args()
+
+    if args.child:
+        result = run_child(json.load(sys.stdin))
+        print(RESULT_MARKER + json.dumps(result))
+        return
+
+    width, height = (int(v) for v in args.image_size.split('x'))
+    frames = load_images(args.image_dir, 16, seed=args.seed, size=(height, width))
+    server = ImageServer(encode_images(frames), args.latency_ms, args.jitter_ms, args.error_rate, seed=args.seed)
+    server.start()
+
+    workdir = tempfile.mkdtemp(prefix='face-audit-bench-')
+    sweep = list(itertools.product(parse_list(args.rows), parse_list(args.threads),
+                                   parse_list(args.batch_sizes), parse_list(args.save_images, parse_bool)))
+    results = []
+    print(f"\n{len(sweep)} runs, images from {server.base_url}, work dir {workdir}")
+    print(f"{'rows':>8}{'threads':>8}{'batch':>7}{'save':>6}{'rows/s':>10}{'p50 ms':>9}{'p95 ms':>9}"
+          f"{'p99 ms':>9}{'RSS MB':>8}{'cores':>7}")
+    try:
+        csv_paths = {}
+        for rows, threads, batch_size, save_images in sweep:
+            if rows not in csv_paths:
+                csv_paths[rows] = write_audit_csv(os.path.join(workdir, f'audit_{rows}.csv'), rows,
+                                                  server.url, seed=args.seed)
+            params = {'rows': rows, 'num_threads': threads, 'batch_size': batch_size, 'save_images': save_images}
+            config = {'num_threads': threads, 'batch_size': batch_size, 'save_images': save_images,
+                      'download_timeout': 10, 'use_cache': False}
+            run_dir = tempfile.mkdtemp(dir=workdir)
+            run = dict(run_config(rows, csv_paths[rows], config, run_dir), params=params)
+            shutil.rmtree(run_dir, ignore_errors=True)
+            results.append(run)
+            lat = run['latency_ms']
+            print(f"{rows:>8}{threads:>8}{batch_size:>7}{str(save_images):>6}{run['rows_per_sec']:>10.1f}"
+                  f"{str(lat['p50']):>9}{str(lat['p95']):>9}{str(lat['p99']):>9}{run['peak_rss_mb']:>8.0f}{run['cpu_cores_busy']:>7.2f}")
+    finally:
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.baseline:
+        compare(results, args.baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'server': {'image_dir': args.image_dir, 'image_size': args.image_size,
+                           'latency_ms': args.latency_ms, 'jitter_ms': args.jitter_ms,
+                           'error_rate': args.error_rate, 'seed': args.seed},
+                'runs': results
+            }, f, indent=2)
+        print(f"\nSaved {args.output}")
+
+
+if __name__ == '__main__':
+    main()
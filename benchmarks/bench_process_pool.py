@@ -0,0 +1,78 @@
+"""
+Thread vs Process Inference Scaling Benchmark
+Runs the full MediaPipe -> DNN cascade (incl. the Python-side work around
+it) with N inference threads in one process, and with N worker processes
+fed through shared memory, for N = 1, 2, 4, ... up to the core count.
+
+Usage:
+    python benchmarks/bench_process_pool.py
+    python benchmarks/bench_process_pool.py --images 2000 --cores 1,2,4,8,16,32 --output scaling.json
+"""
+
+import argparse
+import json
+import os
+
+from common import load_images, run_threads
+import app
+
+
+def default_core_steps():
+    steps, n = [], 1
+    while n < app.CPU_COUNT:
+        steps.append(n)
+        n *= 2
+    return steps + [app.CPU_COUNT]
+
+
+def bench(images, workers, mode, config):
+    def factory():
+        def work(chunk):
+            for img in chunk:
+                if mode == 'processes':
+                    app.detect_face_in_process(img, config, workers)
+                else:
+                    app.detect_face(img, config)
+        return work
+
+    # Warm-up: fork workers / build detector sets outside the timed run
+    run_threads(images[:workers * 2], workers, factory)
+    return run_threads(images, workers, factory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=600)
+    parser.add_argument('--cores', default=None, help='Comma separated worker counts (default: 1,2,4..cpu_count)')
+    parser.add_argument('--image-dir', default=None)
+    parser.add_argument('--output', default=None, help='Write results as JSON')
+    args = parser.parse_args()
+
+    images = load_images(args.image_dir, args.images)
+    steps = [int(c) for c in args.cores.split(',')] if args.cores else default_core_steps()
+    config = {'dnn_batch_size': 1}
+
+    results = []
+    print(f"\n{len(images)} images, {app.CPU_COUNT} cores available")
+    print(f"{'workers':>8}{'threads r/s':>14}{'processes r/s':>16}{'ratio':>8}")
+    for workers in steps:
+        t_elapsed = bench(images, workers, 'threads', config)
+        p_elapsed = bench(images, workers, 'processes', config)
+        row = {
+            'workers': workers,
+            'threads_rows_per_sec': len(images) / t_elapsed,
+            'processes_rows_per_sec': len(images) / p_elapsed,
+        }
+        results.append(row)
+        print(f"{workers:>8}{row['threads_rows_per_sec']:>14.1f}{row['processes_rows_per_sec']:>16.1f}"
+              f"{row['processes_rows_per_sec'] / row['threads_rows_per_sec']:>7.2f}x")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'images': len(images), 'cpu_count': app.CPU_COUNT, 'pid': os.getpid(),
+                       'results': results}, f, indent=2)
+        print(f"\nSaved {args.output}")
+
+
+if __name__ == '__main__':
+    main()
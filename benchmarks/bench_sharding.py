@@ -0,0 +1,203 @@
+"""
+Sharded Job Scaling Benchmark (one Linux box)
+Starts a local image server and a coordinator (gunicorn -c gunicorn.conf.py),
+then runs the same audit CSV as a sharded job (`shard_rows`) with 1, 2, 4...
+shard_worker.py processes, plus one unsharded run for reference. Workers
+are started and warmed up before each upload, so the numbers are steady
+state throughput, not model loading.
+
+Reported per run: wall time from upload to 'completed', rows/sec, speedup
+over one worker, parallel efficiency (speedup / workers), and how many
+shards had to be leased again.
+
+Usage:
+    python benchmarks/bench_sharding.py --rows 5000 --workers 1,2,4,8
+    python benchmarks/bench_sharding.py --rows 20000 --shard-rows 500 --latency-ms 40 --output sharding.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+from common import REPO_ROOT, load_images, write_audit_csv
+from image_server import ImageServer, encode_images
+from bench_startup import free_port, http
+
+
+def start_coordinator(port, threads, wait_seconds):
+    command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--workers', '1',
+               '--threads', str(threads), '--bind', f'127.0.0.1:{port}', 'app:app']
+    proc = subprocess.Popen(command, cwd=REPO_ROOT, env=dict(os.environ, PYTHONUNBUFFERED='1'),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, start_new_session=True)
+    deadline = time.perf_counter() + wait_seconds
+    while time.perf_counter() < deadline:
+        if proc.poll() is not None:
+            sys.exit(f"Coordinator exited early:\n{proc.stderr.read().decode()[-3000:]}")
+        status, _ = http('GET', f"http://127.0.0.1:{port}/ready", timeout=wait_seconds)
+        if status == 200:
+            return proc
+        time.sleep(0.1)
+    stop_process(proc)
+    sys.exit(f"Coordinator not ready within {wait_seconds}s")
+
+
+def start_workers(coordinator, processes, wait_seconds):
+    """shard_worker.py --processes N, returned once every process has warmed up"""
+    command = [sys.executable, 'shard_worker.py', '--coordinator', coordinator, '--processes', str(processes),
+               '--poll', '0.2']
+    proc = subprocess.Popen(command, cwd=REPO_ROOT, env=dict(os.environ, PYTHONUNBUFFERED='1'),
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, start_new_session=True)
+    ready = threading.Semaphore(0)
+
+    def drain():
+        # Keep reading so the workers never block on a full pipe
+        for line in proc.stdout:
+            if 'Waiting for shards' in line:
+                ready.release()
+
+    threading.Thread(target=drain, daemon=True).start()
+    deadline = time.monotonic() + wait_seconds
+    for _ in range(processes):
+        if not ready.acquire(timeout=max(0, deadline - time.monotonic())):
+            stop_process(proc)
+            sys.exit(f"{processes} shard workers not ready within {wait_seconds}s")
+    return proc
+
+
+def stop_process(proc):
+    os.killpg(proc.pid, signal.SIGTERM)
+    try:
+        proc.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+
+
+def run_job(base, csv_path, config, timeout):
+    """Upload, wait for the job to finish, return (elapsed seconds, final status)"""
+    start = time.perf_counter()
+    with open(csv_path, 'rb') as f:
+        response = requests.post(f"{base}/api/upload", files={'file': ('bench.csv', f, 'text/csv')},
+                                 data={k: str(v).lower() if isinstance(v, bool) else v for k, v in config.items()})
+    response.raise_for_status()
+    job_id = response.json()['job_id']
+    while time.perf_counter() - start < timeout:
+        job = requests.get(f"{base}/api/status/{job_id}").json()
+        if job['status'] in ('completed', 'failed', 'cancelled'):
+            return time.perf_counter() - start, job
+        time.sleep(0.2)
+    requests.post(f"{base}/api/cancel/{job_id}")
+    sys.exit(f"Job {job_id} did not finish within {timeout}s")
+
+
+def summarize(label, workers, elapsed, job, one_worker_rate):
+    rows = job.get('processed', 0)
+    rate = rows / elapsed if elapsed else 0
+    speedup = rate / one_worker_rate if one_worker_rate else None
+    pipeline = job.get('pipeline', {})
+    return {
+        'run': label,
+        'workers': workers,
+        'status': job['status'],
+        'error': job.get('error'),
+        'rows': rows,
+        'elapsed_s': round(elapsed, 3),
+        'rows_per_sec': round(rate, 2),
+        'speedup': round(speedup, 2) if speedup else None,
+        'efficiency': round(speedup / workers, 2) if speedup and workers else None,
+        'releases': pipeline.get('releases'),
+        'rows_by_worker': {name: w['rows'] for name, w in pipeline.get('workers', {}).items()},
+        'counts': {k: job.get(k, 0) for k in ('good_count', 'noface_count', 'download_error_count')}
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--workers', default='1,2,4', help='Shard worker process counts to try')
+    parser.add_argument('--shard-rows', type=int, default=250)
+    parser.add_argument('--num-threads', type=int, default=2, help='Inference threads in each worker process')
+    parser.add_argument('--no-local', action='store_true', help='Skip the unsharded reference run')
+    parser.add_argument('--coordinator-threads', type=int, default=16)
+    parser.add_argument('--image-dir', default=None, help='Serve real JPEGs instead of synthetic frames')
+    parser.add_argument('--image-size', default='640x480', help='Synthetic frame size WxH')
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--jitter-ms', type=float, default=10)
+    parser.add_argument('--error-rate', type=float, default=0.01)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=3600, help='Seconds to wait for one job')
+    parser.add_argument('--wait', type=float, default=180, help='Seconds to wait for processes to start')
+    parser.add_argument('--output', default=None, help='Write results as JSON')
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.image_size.split('x'))
+    frames = load_images(args.image_dir, 16, seed=args.seed, size=(height, width))
+    server = ImageServer(encode_images(frames), args.latency_ms, args.jitter_ms, args.error_rate, seed=args.seed)
+    server.start()
+    workdir = tempfile.mkdtemp(prefix='face-audit-shards-')
+    csv_path = write_audit_csv(os.path.join(workdir, 'audit.csv'), args.rows, server.url, seed=args.seed)
+
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    coordinator = start_coordinator(port, args.coordinator_threads, args.wait)
+    # Same detection settings everywhere; jobs only differ in where the rows run.
+    # Short retention: the coordinator removes the benchmark's files itself.
+    config = {'num_threads': args.num_threads, 'use_cache': False, 'save_images': True,
+              'download_timeout': 10, 'retention_hours': 1}
+    results = []
+    print(f"\n{args.rows} rows, {args.shard_rows} rows per shard, images from {server.base_url}")
+    print(f"{'run':>10}{'workers':>9}{'elapsed s':>11}{'rows/s':>10}{'speedup':>9}{'efficiency':>12}{'re-leased':>11}")
+    try:
+        if not args.no_local:
+            elapsed, job = run_job(base, csv_path, dict(config, shard_rows=0), args.timeout)
+            run = summarize('local', 0, elapsed, job, None)
+            results.append(run)
+            print(f"{'local':>10}{'-':>9}{run['elapsed_s']:>11.2f}{run['rows_per_sec']:>10.1f}")
+
+        one_worker_rate = None
+        for workers in (int(n) for n in args.workers.split(',') if n):
+            proc = start_workers(base, workers, args.wait)
+            try:
+                elapsed, job = run_job(base, csv_path, dict(config, shard_rows=args.shard_rows), args.timeout)
+            finally:
+                stop_process(proc)
+            if one_worker_rate is None and workers == 1:
+                one_worker_rate = job.get('processed', 0) / elapsed
+            run = summarize('sharded', workers, elapsed, job, one_worker_rate)
+            results.append(run)
+            print(f"{'sharded':>10}{workers:>9}{run['elapsed_s']:>11.2f}{run['rows_per_sec']:>10.1f}"
+                  f"{str(run['speedup']):>9}{str(run['efficiency']):>12}{str(run['releases']):>11}")
+            if run['status'] != 'completed':
+                print(f"  job ended '{run['status']}': {run['error']}")
+    finally:
+        stop_process(coordinator)
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'params': {'rows': args.rows, 'shard_rows': args.shard_rows, 'num_threads': args.num_threads,
+                           'image_dir': args.image_dir, 'image_size': args.image_size,
+                           'latency_ms': args.latency_ms, 'jitter_ms': args.jitter_ms,
+                           'error_rate': args.error_rate, 'seed': args.seed},
+                'runs': results
+            }, f, indent=2)
+        print(f"\nSaved {args.output}")
+
+
+if __name__ == '__main__':
+    main()
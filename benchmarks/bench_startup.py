@@ -0,0 +1,193 @@
+"""
+Worker Startup Benchmark (gunicorn)
+Starts the app under gunicorn and reports time-to-first-response, the
+latency of the first real detection, and per-worker memory.
+
+Scenarios:
+    lazy       gunicorn app:app (no config): every worker imports app.py itself
+               and warms up on its first request
+    preload    gunicorn -c gunicorn.conf.py: imports and model files loaded once in
+               the master (shared copy-on-write), workers warm up before serving
+    baseline   gunicorn app:app run in --baseline-dir (e.g. an older checkout:
+               `git worktree add ../before <commit>`)
+
+Memory is read from /proc (Linux): RSS counts shared pages in every process,
+PSS splits them between the processes sharing them, so PSS shows what
+copy-on-write sharing saves.
+
+Usage:
+    python benchmarks/bench_startup.py --workers 4
+    python benchmarks/bench_startup.py --workers 4 --baseline-dir ../before --output startup.json
+"""
+
+import argparse
+import base64
+import concurrent.futures
+import json
+import os
+import platform
+import signal
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+import cv2
+import numpy as np
+
+from common import REPO_ROOT
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def http(method, url, body=None, timeout=60):
+    """(status, body) or (None, None) while nothing is listening"""
+    request = urllib.request.Request(url, data=body, method=method,
+                                     headers={'Content-Type': 'application/json'} if body else {})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+    except (urllib.error.URLError, ConnectionError, socket.timeout):
+        return None, None
+
+
+def memory_mb(pid):
+    """(rss, pss) in MB for one process"""
+    values = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            key, _, rest = line.partition(':')
+            if key in ('Rss', 'Pss'):
+                values[key] = int(rest.split()[0]) / 1024  # kB
+    return round(values.get('Rss', 0), 1), round(values.get('Pss', 0), 1)
+
+
+def child_pids(pid):
+    pids = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # Field 4 is the parent pid (after the parenthesised command name)
+                if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                    pids.append(int(entry))
+        except (OSError, IndexError, ValueError):
+            continue
+    return pids
+
+
+def detect_payload():
+    frame = np.full((480, 640, 3), 128, dtype=np.uint8)
+    jpeg = cv2.imencode('.jpg', frame)[1].tobytes()
+    return json.dumps({'image': base64.b64encode(jpeg).decode()}).encode()
+
+
+def run_scenario(name, command, cwd, workers, port, warm_requests, wait_seconds):
+    base = f"http://127.0.0.1:{port}"
+    env = dict(os.environ, PYTHONUNBUFFERED='1')
+    start = time.perf_counter()
+    proc = subprocess.Popen(command, cwd=cwd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            start_new_session=True)
+    try:
+        # Time to first response: the first 200 for the dashboard page
+        first_response = None
+        while time.perf_counter() - start < wait_seconds:
+            if proc.poll() is not None:
+                sys.exit(f"{name}: gunicorn exited early:\n{proc.stderr.read().decode()[-3000:]}")
+            status, _ = http('GET', base + '/', timeout=wait_seconds)
+            if status == 200:
+                first_response = time.perf_counter() - start
+                break
+            time.sleep(0.05)
+        if first_response is None:
+            sys.exit(f"{name}: no response within {wait_seconds}s")
+
+        # First real inference (baseline checkouts may not have /api/detect)
+        t = time.perf_counter()
+        status, _ = http('POST', base + '/api/detect', detect_payload(), timeout=wait_seconds)
+        first_detect_ms = round((time.perf_counter() - t) * 1000, 1) if status == 200 else None
+
+        # Spread requests so every worker has served (and, if lazy, loaded) before measuring memory
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers * 2) as pool:
+            list(pool.map(lambda _: http('GET', base + '/', timeout=wait_seconds), range(warm_requests)))
+
+        master_rss, master_pss = memory_mb(proc.pid)
+        worker_memory = [memory_mb(pid) for pid in child_pids(proc.pid)]
+        rss = [m[0] for m in worker_memory]
+        pss = [m[1] for m in worker_memory]
+        return {
+            'scenario': name,
+            'workers': len(worker_memory),
+            'first_response_s': round(first_response, 3),
+            'first_detect_ms': first_detect_ms,
+            'master_rss_mb': master_rss,
+            'worker_rss_mb': round(sum(rss) / len(rss), 1) if rss else None,
+            'worker_pss_mb': round(sum(pss) / len(pss), 1) if pss else None,
+            'total_pss_mb': round(master_pss + sum(pss), 1)
+        }
+    finally:
+        os.killpg(proc.pid, signal.SIGTERM)
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--scenarios', default='lazy,preload', help='lazy, preload (baseline is added by --baseline-dir)')
+    parser.add_argument('--baseline-dir', default=None, help='Checkout to run as the "baseline" scenario')
+    parser.add_argument('--warm-requests', type=int, default=None, help='Requests spread over workers (default 10 per worker)')
+    parser.add_argument('--wait', type=float, default=180, help='Seconds to wait for the first response')
+    parser.add_argument('--output', default=None, help='Write results as JSON')
+    args = parser.parse_args()
+
+    gunicorn = [sys.executable, '-m', 'gunicorn', '--workers', str(args.workers), '--threads', str(args.threads)]
+    empty_config = ['--config', os.devnull]  # Don't pick up ./gunicorn.conf.py
+    scenarios = []
+    if args.baseline_dir:
+        scenarios.append(('baseline', gunicorn + empty_config, os.path.abspath(args.baseline_dir)))
+    for name in args.scenarios.split(','):
+        if name == 'lazy':
+            scenarios.append((name, gunicorn + empty_config, REPO_ROOT))
+        elif name == 'preload':
+            scenarios.append((name, gunicorn + ['--config', 'gunicorn.conf.py'], REPO_ROOT))
+        elif name:
+            sys.exit(f"Unknown scenario: {name}")
+
+    results = []
+    print(f"{'scenario':>10}{'workers':>9}{'first resp s':>14}{'1st detect ms':>15}{'worker RSS':>12}"
+          f"{'worker PSS':>12}{'total PSS':>11}")
+    for name, command, cwd in scenarios:
+        port = free_port()
+        run = run_scenario(name, command + ['--bind', f'127.0.0.1:{port}', 'app:app'], cwd, args.workers, port,
+                           args.warm_requests or args.workers * 10, args.wait)
+        results.append(run)
+        print(f"{name:>10}{run['workers']:>9}{run['first_response_s']:>14.2f}{str(run['first_detect_ms']):>15}"
+              f"{str(run['worker_rss_mb']):>12}{str(run['worker_pss_mb']):>12}{run['total_pss_mb']:>11}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'runs': results
+            }, f, indent=2)
+        print(f"\nSaved {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Shared helpers for the benchmark scripts (image loading, thread fan-out,
+synthetic audit CSVs).
+"""
+
+import csv
+import datetime
+import glob
+import os
+import sys
+import threading
+import time
+
+import cv2
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+
+def load_images(image_dir, count, seed=0, size=(960, 1280)):
+    """Real JPEGs from a folder (cycled), or synthetic frames of the given size"""
+    if image_dir:
+        paths = sorted(glob.glob(os.path.join(image_dir, '*.jpg')) + glob.glob(os.path.join(image_dir, '*.jpeg')))
+        frames = [cv2.imread(p) for p in paths]
+        frames = [f for f in frames if f is not None]
+        if not frames:
+            sys.exit(f"No readable JPEGs in {image_dir}")
+    else:
+        rng = np.random.default_rng(seed)
+        frames = [rng.integers(0, 255, size + (3,), dtype=np.uint8) for _ in range(16)]
+    return [frames[i % len(frames)] for i in range(count)]
+
+
+def run_threads(items, workers, fn_factory):
+    """Split items across worker threads (fn_factory() -> fn(chunk)), return elapsed seconds"""
+    chunks = [items[i::workers] for i in range(workers)]
+    threads = [threading.Thread(target=fn_factory(), args=(chunk,)) for chunk in chunks]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start
+
+
+def write_audit_csv(path, rows, url_for, seed=0):
+    """CSV shaped like Sample_test_file.csv with `rows` check-ins, photo URL = url_for(n)"""
+    rng = np.random.default_rng(seed)
+    users = rng.integers(100, 1000, rows)
+    start = datetime.date(2025, 12, 1)
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Unique Id', 'User ID', 'Check-In Date', 'Check-In Photo', 'Face_Status'])
+        for n in range(rows):
+            day = start + datetime.timedelta(days=n % 28)
+            writer.writerow([n + 1, int(users[n]), day.isoformat(), url_for(n), ''])
+    return path
@@ -0,0 +1,117 @@
+"""
+Local Image Server (no network needed)
+Serves JPEGs over HTTP with configurable latency, jitter and error rate so
+the download -> decode -> inference pipeline can be benchmarked offline.
+Every URL gets the same answer on every run (latency and errors are
+derived from the path and the seed), which keeps runs comparable.
+
+    /img/<n>.jpg   image n (cycled over the loaded set)
+
+Usage:
+    python benchmarks/image_server.py --port 8099 --latency-ms 50 --error-rate 0.02
+    python benchmarks/image_server.py --image-dir samples/ --port 8099
+"""
+
+import argparse
+import http.server
+import random
+import threading
+import time
+
+import cv2
+
+from common import load_images
+
+
+def encode_images(frames, quality=90):
+    """JPEG-encode decoded frames once up front"""
+    return [cv2.imencode('.jpg', f, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes() for f in frames]
+
+
+class ImageServer:
+    """Threaded HTTP server on 127.0.0.1 serving a fixed set of JPEG bodies"""
+
+    def __init__(self, images, latency_ms=0, jitter_ms=0, error_rate=0.0, seed=0, port=0):
+        self.images = images
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.seed = seed
+        self.port = port
+        self.requests = 0
+        self._server = None
+
+    def start(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # Keep-alive, like S3
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.requests += 1
+                rng = random.Random(f"{server.seed}:{self.path}")
+                delay = server.latency_ms + rng.uniform(-server.jitter_ms, server.jitter_ms)
+                if delay > 0:
+                    time.sleep(delay / 1000)
+
+                name = self.path.split('?')[0].rsplit('/', 1)[-1]
+                if not name.endswith('.jpg') or not name[:-4].isdigit():
+                    return self._send(404, b'')
+                if rng.random() < server.error_rate:
+                    # Mix of transient (retried) and permanent failures
+                    return self._send(503 if rng.random() < 0.5 else 404, b'')
+                self._send(200, server.images[int(name[:-4]) % len(server.images)], 'image/jpeg')
+
+            def _send(self, code, body, content_type='application/octet-stream'):
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self.base_url
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def url(self, n):
+        return f"{self.base_url}/img/{n}.jpg"
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--image-dir', default=None, help='Serve real JPEGs instead of synthetic frames')
+    parser.add_argument('--image-size', default='640x480', help='Synthetic frame size WxH')
+    parser.add_argument('--images', type=int, default=16, help='Distinct images to serve')
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.image_size.split('x'))
+    frames = load_images(args.image_dir, args.images, size=(height, width))
+    server = ImageServer(encode_images(frames), args.latency_ms, args.jitter_ms, args.error_rate, port=args.port)
+    print(f"Serving {len(server.images)} images at {server.start()}/img/<n>.jpg (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+Downscale Accuracy vs Speed Report
+Runs a labelled local image set through decode + MediaPipe/DNN at full
+resolution and at several max_dimension caps, then reports how many
+verdicts changed, accuracy against the labels, and time per image.
+
+The image folder must contain one sub-folder per label:
+    labelled/
+        face/     *.jpg   (expected GOOD)
+        noface/   *.jpg   (expected NO FACE)
+
+Usage:
+    python benchmarks/report_downscale.py labelled/
+    python benchmarks/report_downscale.py labelled/ --dims 1920,1280,960,640 --output downscale.json
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+LABELS = {'face': 'GOOD', 'noface': 'NO FACE'}
+
+
+def load_set(root):
+    items = []
+    for label, expected in LABELS.items():
+        for path in sorted(glob.glob(os.path.join(root, label, '*'))):
+            if path.lower().endswith(('.jpg', '.jpeg', '.png')):
+                with open(path, 'rb') as f:
+                    items.append({'path': path, 'expected': expected, 'data': f.read()})
+    if not items:
+        sys.exit(f"No images found under {root}/face or {root}/noface")
+    return items
+
+
+def run_setting(items, max_dimension, config):
+    verdicts = {}
+    decode_time = 0.0
+    infer_time = 0.0
+    pixels = 0
+    for item in items:
+        t0 = time.perf_counter()
+        image = app.decode_image(item['data'], max_dimension)
+        t1 = time.perf_counter()
+        if image is None:
+            verdicts[item['path']] = 'DECODE_ERROR'
+            continue
+        status, _ = app.classify_image(image, 'downscale-report', 'x', config)
+        t2 = time.perf_counter()
+        verdicts[item['path']] = status
+        decode_time += t1 - t0
+        infer_time += t2 - t1
+        pixels += image.shape[0] * image.shape[1]
+
+    n = len(items)
+    correct = sum(1 for item in items if verdicts[item['path']] == item['expected'])
+    return {
+        'max_dimension': max_dimension,
+        'accuracy': correct / n,
+        'decode_ms': decode_time / n * 1000,
+        'inference_ms': infer_time / n * 1000,
+        'total_ms': (decode_time + infer_time) / n * 1000,
+        'mean_megapixels': pixels / n / 1e6,
+        'verdicts': verdicts,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('image_dir')
+    parser.add_argument('--dims', default='1920,1280,960,640,480')
+    parser.add_argument('--mediapipe-thresh', type=float, default=app.DEFAULT_MEDIAPIPE_CONF_THRESH)
+    parser.add_argument('--dnn-thresh', type=float, default=app.DEFAULT_DNN_CONF_THRESH)
+    parser.add_argument('--output', default=None, help='Write full report (incl. per-image verdicts) as JSON')
+    args = parser.parse_args()
+
+    items = load_set(args.image_dir)
+    config = {
+        'mediapipe_thresh': args.mediapipe_thresh,
+        'dnn_thresh': args.dnn_thresh,
+        'save_images': False,
+        'dnn_batch_size': 1,
+    }
+
+    # Warm the detector pool so graph setup isn't charged to the first setting
+    run_setting(items[:1], 0, config)
+
+    settings = [0] + [int(d) for d in args.dims.split(',') if d.strip()]
+    results = [run_setting(items, dim, config) for dim in settings]
+    baseline = results[0]
+
+    print(f"\n{len(items)} labelled images from {args.image_dir}")
+    print(f"{'max_dim':>8}{'MP':>7}{'acc':>8}{'changed':>9}{'decode':>9}{'infer':>9}{'total':>9}{'speedup':>9}")
+    for r in results:
+        changed = [p for p, v in r['verdicts'].items() if v != baseline['verdicts'][p]]
+        r['changed_vs_full'] = changed
+        label = 'full' if r['max_dimension'] == 0 else str(r['max_dimension'])
+        print(f"{label:>8}{r['mean_megapixels']:>7.2f}{r['accuracy']:>8.1%}{len(changed):>9}"
+              f"{r['decode_ms']:>8.1f}ms{r['inference_ms']:>7.1f}ms{r['total_ms']:>7.1f}ms"
+              f"{baseline['total_ms'] / r['total_ms']:>8.2f}x")
+
+    for r in results[1:]:
+        for path in r['changed_vs_full']:
+            print(f"  max_dim={r['max_dimension']}: {path}: "
+                  f"{baseline['verdicts'][path]} -> {r['verdicts'][path]}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'image_dir': args.image_dir, 'images': len(items), 'config': config,
+                       'results': results}, f, indent=2)
+        print(f"\nSaved {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+"""
+Gunicorn settings for the Face Audit API
+
+    gunicorn -c gunicorn.conf.py app:app
+
+app.py (MediaPipe, OpenCV, pandas) is imported and the model files are read
+once in the master, then shared copy-on-write by the forked workers. Each
+worker builds its own detectors and runs a warm-up inference before it
+accepts requests, so the first request after a deploy isn't the slow one.
+Only one process on the host runs the cleanup scheduler, and only one (the
+job runner) runs audit jobs: the others store uploads for it. So
+MAX_CONCURRENT_JOBS and the global download / inference slots hold for the
+host whatever WEB_CONCURRENCY is, and extra workers only add request
+handling (status, downloads, /api/detect).
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))  # Jobs still run in one of them (see above)
+# SSE streams each hold a thread; app.py caps them at EVENTS_MAX_STREAMS (default 4) per
+# worker so the rest stay free for requests, and sends extra clients to long-poll
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+timeout = 120
+preload_app = True
+
+
+def when_ready(server):
+    # Master, after the app is imported and before any worker is forked
+    import app as face_app
+    face_app.init_models()
+
+
+def post_worker_init(worker):
+    # Worker, before it starts accepting connections
+    import app as face_app
+    face_app.start_worker()
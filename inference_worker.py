@@ -0,0 +1,75 @@
+"""
+Inference Worker Processes
+Code run by the processes behind execution_mode 'processes' (app.ProcessInference).
+They are started by forkserver / spawn rather than forked from the API
+server, so they never inherit its threads, locks or SQLite connections.
+This module is all they import: OpenCV, MediaPipe and the two models.
+The API server imports it too, for the shared DNN helpers.
+"""
+
+from collections import OrderedDict
+from multiprocessing import shared_memory
+import time
+
+import cv2
+import mediapipe as mp
+import numpy as np
+
+DNN_INPUT_SIZE = (300, 300)
+DNN_MEAN = (104.0, 177.0, 123.0)
+MAX_FACE_DETECTORS = 4  # MediaPipe detectors kept per process (one per threshold)
+
+_net = None
+_face_detectors = OrderedDict()  # threshold -> FaceDetection, least recently used first
+
+
+def dnn_confidence(image, net):
+    """Highest face confidence from OpenCV DNN (net must be owned by the calling worker)"""
+    blob = cv2.dnn.blobFromImage(cv2.resize(image, DNN_INPUT_SIZE), 1.0,
+                                 DNN_INPUT_SIZE, DNN_MEAN)
+    net.setInput(blob)
+    detections = net.forward()
+    return float(np.max(detections[0, 0, :, 2]))
+
+
+def init_process(prototxt_path, model_path, mp_thresh):
+    """Pool initializer: load the DNN net and the default MediaPipe detector once"""
+    global _net
+    _net = cv2.dnn.readNetFromCaffe(prototxt_path, model_path)
+    face_detector(mp_thresh)
+
+
+def face_detector(mp_thresh):
+    key = round(float(mp_thresh), 4)
+    if key in _face_detectors:
+        _face_detectors.move_to_end(key)
+        return _face_detectors[key]
+    _face_detectors[key] = mp.solutions.face_detection.FaceDetection(min_detection_confidence=key)
+    while len(_face_detectors) > MAX_FACE_DETECTORS:
+        _face_detectors.popitem(last=False)[1].close()
+    return _face_detectors[key]
+
+
+def detect_shared_frame(shm_name, shape, dtype, mp_thresh, dnn_thresh):
+    """MediaPipe -> DNN cascade on a frame in shared memory, returns (face_found, timings).
+
+    One image at a time per process, DNN batching would only add latency.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    image = None
+    try:
+        image = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        timings = {}
+        start = time.perf_counter()
+        results = face_detector(mp_thresh).process(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+        timings['mediapipe'] = time.perf_counter() - start
+        if results.detections:
+            return True, timings
+
+        start = time.perf_counter()
+        confidence = dnn_confidence(image, _net)
+        timings['dnn'] = time.perf_counter() - start
+        return confidence > dnn_thresh, timings
+    finally:
+        del image  # Release the buffer view before closing the mapping
+        shm.close()
@@ -0,0 +1,200 @@
+"""
+Shard Worker
+Runs the rows of sharded audit jobs (uploads with `shard_rows` > 0). Start
+as many as you like, on this machine or on other nodes: each process leases
+a shard from the coordinator (the API server that accepted the upload),
+runs it through the same download -> decode -> detect pipeline as a local
+job, uploads the NO FACE evidence and posts one verdict per row back. The
+coordinator merges them into the job's CSV in the original row order.
+
+A worker heartbeats while it works. If it dies or loses the network, its
+shard is handed to another worker once the lease runs out
+(SHARD_LEASE_SECONDS on the coordinator).
+
+Usage:
+    python shard_worker.py --coordinator http://10.0.0.5:5000
+    python shard_worker.py --coordinator http://127.0.0.1:5000 --processes 4
+    SHARD_TOKEN=secret python shard_worker.py --coordinator http://10.0.0.5:5000 --exit-when-idle 30
+"""
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+import pandas as pd
+import requests
+
+import app
+
+
+class LeaseLost(Exception):
+    """The coordinator took the shard back (lease expired, or the job stopped)"""
+
+
+class ShardClient:
+    """The coordinator's /api/shards endpoints"""
+
+    def __init__(self, coordinator, token=None):
+        self.base = coordinator.rstrip('/')
+        self.session = requests.Session()
+        if token:
+            self.session.headers['X-Shard-Token'] = token
+
+    def _url(self, lease, action):
+        return f"{self.base}/api/shards/{lease['job_id']}/{lease['shard']}/{action}"
+
+    @staticmethod
+    def _check(response):
+        if response.status_code == 409:
+            raise LeaseLost(response.text)
+        response.raise_for_status()
+        return response
+
+    def lease(self, worker):
+        response = self._check(self.session.post(f"{self.base}/api/shards/lease", json={'worker': worker},
+                                                 timeout=30))
+        return None if response.status_code == 204 else response.json()
+
+    def download_rows(self, lease, path):
+        with self.session.get(self._url(lease, 'rows'), params={'lease_id': lease['lease_id']},
+                              stream=True, timeout=60) as response:
+            self._check(response)
+            with open(path, 'wb') as f:
+                for chunk in response.iter_content(64 * 1024):
+                    f.write(chunk)
+
+    def heartbeat(self, lease, processed):
+        self._check(self.session.post(self._url(lease, 'heartbeat'), timeout=30,
+                                      json={'lease_id': lease['lease_id'], 'processed': processed}))
+
+    def upload_evidence(self, lease, path):
+        with open(path, 'rb') as f:
+            self._check(self.session.put(self._url(lease, f"evidence/{os.path.basename(path)}"),
+                                         params={'lease_id': lease['lease_id']}, data=f, timeout=60))
+
+    def complete(self, lease, rows, elapsed):
+        self._check(self.session.post(self._url(lease, 'complete'), timeout=120,
+                                      json={'lease_id': lease['lease_id'], 'rows': rows, 'elapsed_s': elapsed}))
+
+
+def run_shard(client, lease, workdir):
+    """Process one leased shard end to end"""
+    job_id, config = lease['job_id'], lease['config']
+    start = time.perf_counter()
+    rows_path = os.path.join(workdir, 'rows.csv')
+    client.download_rows(lease, rows_path)
+    # Ids stay text, so evidence file names match what the coordinator expects
+    df = pd.read_csv(rows_path, index_col='idx', dtype={'id': str, 'url': str}, keep_default_na=False)
+
+    runner = app.JobRowRunner(job_id, config, {'hits': 0, 'misses': 0})
+    results = []
+    done = threading.Event()
+    lost = threading.Event()
+
+    def keep_lease():
+        while not done.wait(lease['lease_seconds'] / 3):
+            try:
+                client.heartbeat(lease, len(results))
+            except LeaseLost:
+                lost.set()
+                runner.stop()
+                return
+            except requests.RequestException as e:
+                print(f"Heartbeat failed (retrying): {e}")
+
+    heartbeat = threading.Thread(target=keep_lease, daemon=True)
+    evidence_dir = os.path.join(app.NO_FACE_FOLDER, job_id)
+    try:
+        runner.start(app.iter_row_tasks(df, list(df.index), 'url'))
+        heartbeat.start()
+        for rows in runner.iter_results():
+            results.extend([int(row['idx']), row['status'], row.get('error_reason')] for row in rows)
+            if lost.is_set():
+                break
+        if lost.is_set():
+            raise LeaseLost(f"shard {lease['shard']} of job {job_id}")
+
+        # Evidence first: the coordinator may zip the job as soon as the shard is merged
+        app.artifact_writer.flush(job_id)
+        if os.path.isdir(evidence_dir):
+            for path in app.list_noface_images(evidence_dir):
+                client.upload_evidence(lease, path)
+        client.complete(lease, results, round(time.perf_counter() - start, 3))
+        return len(results)
+    finally:
+        done.set()
+        runner.stop()
+        app.artifact_writer.forget(job_id)
+        app.stage_metrics.forget(job_id)
+        shutil.rmtree(evidence_dir, ignore_errors=True)
+
+
+def worker_loop(coordinator, token, poll_seconds, exit_when_idle):
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    workdir = tempfile.mkdtemp(prefix='shard-worker-')
+    # Evidence is written locally, uploaded, then removed
+    app.NO_FACE_FOLDER = os.path.join(workdir, 'no_face_images')
+    app.warm_up()
+    client = ShardClient(coordinator, token)
+    idle_since = time.monotonic()
+    print(f"[{worker}] Waiting for shards from {coordinator}")
+    try:
+        while True:
+            try:
+                lease = client.lease(worker)
+            except requests.RequestException as e:
+                print(f"[{worker}] Coordinator unreachable: {e}")
+                lease = None
+            if lease is None:
+                if exit_when_idle and time.monotonic() - idle_since >= exit_when_idle:
+                    return
+                time.sleep(poll_seconds)
+                continue
+
+            label = f"job {lease['job_id'][:8]} shard {lease['shard']} (attempt {lease['attempt']})"
+            try:
+                start = time.perf_counter()
+                rows = run_shard(client, lease, workdir)
+                print(f"[{worker}] {label}: {rows} rows in {time.perf_counter() - start:.1f}s")
+            except LeaseLost:
+                print(f"[{worker}] {label}: lease lost, dropping it")
+            except Exception as e:
+                # The lease runs out and the coordinator hands the shard to someone else
+                print(f"[{worker}] {label}: failed: {e}")
+            idle_since = time.monotonic()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--coordinator', default=os.environ.get('SHARD_COORDINATOR', 'http://127.0.0.1:5000'),
+                        help='Base URL of the API server that owns the jobs')
+    parser.add_argument('--processes', type=int, default=1, help='Worker processes to run on this node')
+    parser.add_argument('--token', default=os.environ.get('SHARD_TOKEN'), help='Must match SHARD_TOKEN on the coordinator')
+    parser.add_argument('--poll', type=float, default=1.0, help='Seconds between lease attempts when idle')
+    parser.add_argument('--exit-when-idle', type=float, default=0, help='Exit after this many idle seconds (0 = never)')
+    args = parser.parse_args()
+
+    loop_args = (args.coordinator, args.token, args.poll, args.exit_when_idle)
+    if args.processes <= 1:
+        worker_loop(*loop_args)
+        return
+    procs = [multiprocessing.Process(target=worker_loop, args=loop_args) for _ in range(args.processes)]
+    for proc in procs:
+        proc.start()
+    try:
+        for proc in procs:
+            proc.join()
+    except KeyboardInterrupt:
+        for proc in procs:
+            proc.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -5,7 +5,9 @@
 
 const API_BASE = window.location.origin;
 let currentJobId = null;
-let statusCheckInterval = null;
+let eventSource = null;  // SSE stream for the active job
+let longPollJobId = null;  // Set while the long-poll fallback is running
+let jobState = {};  // Latest status, progress deltas are merged into it
 
 // ==========================================
 // DOM ELEMENTS
@@ -35,6 +37,7 @@ const errorCount = document.getElementById('errorCount');
 const downloadCsvBtn = document.getElementById('downloadCsvBtn');
 const downloadImagesBtn = document.getElementById('downloadImagesBtn');
 const downloadProgressBtn = document.getElementById('downloadProgressBtn');
+const downloadNewImagesBtn = document.getElementById('downloadNewImagesBtn');
 const newJobBtn = document.getElementById('newJobBtn');
 const resultsSummary = document.getElementById('resultsSummary');
 
@@ -151,7 +154,28 @@ uploadBtn.addEventListener('click', async (e) => {
         formData.append('mediapipe_thresh', document.getElementById('mpThresh')?.value || 0.80);
         formData.append('dnn_thresh', document.getElementById('dnnThresh')?.value || 0.65);
         formData.append('num_threads', document.getElementById('numThreads')?.value || 6);
+        formData.append('execution_mode', document.getElementById('executionMode')?.value || 'threads');
+        formData.append('download_workers', document.getElementById('downloadWorkers')?.value || 64);
         formData.append('batch_size', document.getElementById('batchSize')?.value || 50);
+        formData.append('max_dimension', document.getElementById('maxDimension')?.value || 0);
+        formData.append('dnn_batch_size', document.getElementById('dnnBatchSize')?.value || 8);
+
+        const useCacheCheckbox = document.getElementById('useCache');
+        formData.append('use_cache', useCacheCheckbox ? useCacheCheckbox.checked : true);
+
+        const prefilterCheckbox = document.getElementById('prefilter');
+        formData.append('prefilter', prefilterCheckbox ? prefilterCheckbox.checked : false);
+        formData.append('prefilter_min_dim', document.getElementById('prefilterMinDim')?.value || 40);
+        formData.append('prefilter_min_std', document.getElementById('prefilterMinStd')?.value || 6);
+        formData.append('prefilter_dark_mean', document.getElementById('prefilterDarkMean')?.value || 15);
+        formData.append('prefilter_min_blur', document.getElementById('prefilterMinBlur')?.value || 0);
+
+        formData.append('artifact_mode', document.getElementById('artifactMode')?.value || 'original');
+        formData.append('artifact_max_dimension', document.getElementById('artifactMaxDimension')?.value || 1024);
+        formData.append('artifact_quality', document.getElementById('artifactQuality')?.value || 80);
+        formData.append('artifact_backpressure', document.getElementById('artifactBackpressure')?.value || 'block');
+        formData.append('retention_hours', document.getElementById('retentionHours')?.value || 24);
+        formData.append('shard_rows', document.getElementById('shardRows')?.value || 0);
 
         const saveImagesCheckbox = document.getElementById('saveImages');
         formData.append('save_images', saveImagesCheckbox ? saveImagesCheckbox.checked : false);
@@ -199,51 +223,97 @@ uploadBtn.addEventListener('click', async (e) => {
 // ==========================================
 
 function startStatusChecking() {
-    if (statusCheckInterval) {
-        clearInterval(statusCheckInterval);
-    }
+    stopStatusUpdates();
+
+    const jobId = currentJobId;
+    jobState = {};
 
-    // Check immediately
-    checkJobStatus();
+    // Prefer a pushed event stream; fall back to long-polling
+    if (window.EventSource) {
+        eventSource = new EventSource(`${API_BASE}/api/events/${jobId}`);
 
-    // Then check every 2 seconds
-    statusCheckInterval = setInterval(checkJobStatus, 2000);
+        eventSource.addEventListener('status', (e) => {
+            jobState = JSON.parse(e.data);
+            handleJobStatus(jobState);
+        });
+        eventSource.addEventListener('progress', (e) => {
+            // Deltas only carry the fields that changed
+            Object.assign(jobState, JSON.parse(e.data));
+            handleJobStatus(jobState);
+        });
+        eventSource.addEventListener('gone', () => handleJobLost());
+        eventSource.onerror = () => {
+            if (eventSource && eventSource.readyState === EventSource.CLOSED) {
+                // Stream refused (server at its stream cap, 404, proxy without streaming): switch to long-poll
+                eventSource = null;
+                longPollJobStatus(jobId);
+            }
+        };
+    } else {
+        longPollJobStatus(jobId);
+    }
 }
 
-async function checkJobStatus() {
-    if (!currentJobId) return;
+function stopStatusUpdates() {
+    if (eventSource) {
+        eventSource.close();
+        eventSource = null;
+    }
+    longPollJobId = null;
+}
 
-    try {
-        const response = await fetch(`${API_BASE}/api/status/${currentJobId}`);
-
-        // Handle 404 (Job might be expired/deleted if server restarted)
-        if (response.status === 404) {
-            clearInterval(statusCheckInterval);
-            localStorage.removeItem('activeJobId');
-            localStorage.removeItem('activeJobName');
-            alert('This job session has expired or was lost (Server Restart). Please upload again.');
-            resetToUpload();
-            return;
-        }
+async function longPollJobStatus(jobId) {
+    longPollJobId = jobId;
+    let version = -1;
 
-        const data = await response.json();
+    while (longPollJobId === jobId) {
+        try {
+            const response = await fetch(`${API_BASE}/api/events/${jobId}?mode=poll&version=${version}`);
 
-        if (response.ok) {
-            updateProcessingUI(data);
-
-            if (data.status === 'completed') {
-                clearInterval(statusCheckInterval);
-                // Don't clear LocalStorage yet, user might refresh on results page
-                showResults(data);
-            } else if (data.status === 'failed') {
-                clearInterval(statusCheckInterval);
-                alert('Processing failed: ' + (data.error || 'Unknown error'));
-                localStorage.removeItem('activeJobId'); // Clear on fail
-                resetToUpload();
+            if (response.status === 404) {
+                handleJobLost();
+                return;
+            }
+
+            const data = await response.json();
+            if (response.ok && longPollJobId === jobId) {
+                version = data.version;
+                jobState = data;
+                handleJobStatus(data);
             }
+        } catch (error) {
+            console.error('Status check error:', error);
+            await new Promise(resolve => setTimeout(resolve, 2000));
         }
-    } catch (error) {
-        console.error('Status check error:', error);
+    }
+}
+
+function handleJobLost() {
+    // Job might be expired/deleted if server restarted
+    stopStatusUpdates();
+    localStorage.removeItem('activeJobId');
+    localStorage.removeItem('activeJobName');
+    alert('This job session has expired or was lost (Server Restart). Please upload again.');
+    resetToUpload();
+}
+
+function handleJobStatus(data) {
+    updateProcessingUI(data);
+
+    if (data.status === 'completed') {
+        stopStatusUpdates();
+        // Don't clear LocalStorage yet, user might refresh on results page
+        showResults(data);
+        loadJobsHistory();
+    } else if (data.status === 'failed') {
+        stopStatusUpdates();
+        alert('Processing failed: ' + (data.error || 'Unknown error'));
+        localStorage.removeItem('activeJobId'); // Clear on fail
+        resetToUpload();
+        loadJobsHistory();
+    } else if (data.status === 'cancelled') {
+        stopStatusUpdates();
+        loadJobsHistory();
     }
 }
 
@@ -252,7 +322,11 @@ function updateProcessingUI(data) {
     const total = data.rows_to_process || 0;
     const progress = data.progress || 0;
 
-    progressText.textContent = `${processed} / ${total} images processed`;
+    if (data.status === 'queued' && data.queue_position) {
+        progressText.textContent = `Queued — position ${data.queue_position}, waiting for a free slot`;
+    } else {
+        progressText.textContent = `${processed} / ${total} images processed`;
+    }
     progressPercentage.textContent = `${Math.round(progress)}%`;
     progressBar.style.width = `${progress}%`;
 
@@ -307,6 +381,37 @@ if (downloadProgressBtn) {
     });
 }
 
+if (downloadNewImagesBtn) {
+    // Pulls only the NO FACE images saved since the last pull of this job
+    downloadNewImagesBtn.addEventListener('click', async () => {
+        if (!currentJobId) return;
+
+        const offsetKey = `nofaceOffset_${currentJobId}`;
+        const since = parseInt(localStorage.getItem(offsetKey) || '0', 10);
+        const url = `${API_BASE}/api/download-noface/${currentJobId}?since=${since}`;
+
+        try {
+            // HEAD only reports how far the archive would reach
+            const response = await fetch(url, { method: 'HEAD' });
+            const next = parseInt(response.headers.get('X-Next-Offset') || since, 10);
+
+            if (response.status === 204 || next <= since) {
+                alert('No new No-Face images since your last download.');
+                return;
+            }
+            if (!response.ok) {
+                alert('Could not download images right now.');
+                return;
+            }
+
+            localStorage.setItem(offsetKey, next);
+            window.location.href = `${url}&until=${next}`;
+        } catch (error) {
+            console.error('Image download error:', error);
+        }
+    });
+}
+
 // ==========================================
 // CUSTOM MODAL LOGIC
 // ==========================================
@@ -368,7 +473,7 @@ if (cancelJobBtn) {
                                 confirmText: 'OK',
                                 cancelText: null, // Hide cancel button
                                 onConfirm: () => {
-                                    if (statusCheckInterval) clearInterval(statusCheckInterval);
+                                    stopStatusUpdates();
                                     resetToUpload();
                                 }
                             });
@@ -395,6 +500,7 @@ newJobBtn.addEventListener('click', () => {
 });
 
 function resetToUpload() {
+    stopStatusUpdates();
     currentJobId = null;
     localStorage.removeItem('activeJobId');
     localStorage.removeItem('activeJobName');
@@ -421,12 +527,26 @@ function resetToUpload() {
 // JOBS HISTORY
 // ==========================================
 
+// History pages come from /api/jobs (summary fields, newest first). The
+// refresh revalidates the first page with its ETag, so an unchanged history
+// costs a 304 and no re-render.
+const JOBS_PAGE_SIZE = 20;
+let jobsHistoryEtag = null;
+let jobsHistoryCursor = null;
+
 async function loadJobsHistory() {
     try {
-        const response = await fetch(`${API_BASE}/api/jobs`);
-        const jobs = await response.json();
+        const headers = jobsHistoryEtag ? { 'If-None-Match': jobsHistoryEtag } : {};
+        const response = await fetch(`${API_BASE}/api/jobs?limit=${JOBS_PAGE_SIZE}`, { headers, cache: 'no-store' });
+        if (response.status === 304) {
+            return;
+        }
+        const page = await response.json();
+        jobsHistoryEtag = response.headers.get('ETag');
+        jobsHistoryCursor = page.next_cursor;
+        activeJobs.textContent = page.active_count;
 
-        if (jobs.length === 0) {
+        if (page.jobs.length === 0) {
             jobsList.innerHTML = `
                 <div class="empty-state">
                     <svg viewBox="0 0 24 24" fill="none" stroke="currentColor">
@@ -436,24 +556,35 @@ async function loadJobsHistory() {
                     <p>No jobs yet. Upload a CSV file to get started!</p>
                 </div>
             `;
-            activeJobs.textContent = '0';
             return;
         }
 
-        // Count active jobs
-        const active = jobs.filter(j => j.status === 'processing' || j.status === 'queued').length;
-        activeJobs.textContent = active;
-
-        // Sort by upload time (newest first)
-        jobs.sort((a, b) => new Date(b.uploaded_at) - new Date(a.uploaded_at));
-
-        jobsList.innerHTML = jobs.map(job => createJobItem(job)).join('');
+        jobsList.innerHTML = page.jobs.map(job => createJobItem(job)).join('') + olderJobsButton();
 
     } catch (error) {
         console.error('Failed to load jobs:', error);
     }
 }
 
+async function loadOlderJobs() {
+    if (!jobsHistoryCursor) return;
+    try {
+        const cursor = encodeURIComponent(jobsHistoryCursor);
+        const response = await fetch(`${API_BASE}/api/jobs?limit=${JOBS_PAGE_SIZE}&cursor=${cursor}`);
+        const page = await response.json();
+        jobsHistoryCursor = page.next_cursor;
+        document.getElementById('olderJobsBtn')?.remove();
+        jobsList.insertAdjacentHTML('beforeend', page.jobs.map(job => createJobItem(job)).join('') + olderJobsButton());
+    } catch (error) {
+        console.error('Failed to load older jobs:', error);
+    }
+}
+
+function olderJobsButton() {
+    return jobsHistoryCursor ?
+        `<button class="btn btn-outline" id="olderJobsBtn" onclick="loadOlderJobs()">Show older jobs</button>` : '';
+}
+
 function createJobItem(job) {
     const statusClass = job.status === 'completed' ? 'completed' :
         job.status === 'processing' || job.status === 'queued' ? 'processing' :
@@ -490,8 +621,8 @@ document.addEventListener('DOMContentLoaded', () => {
     loadJobsHistory();
     checkForActiveJob();
 
-    // Refresh jobs every 10 seconds
-    setInterval(loadJobsHistory, 10000);
+    // Job progress is pushed; the history list only needs an occasional refresh
+    setInterval(loadJobsHistory, 30000);
 });
 
 function checkForActiveJob() {